@@ -0,0 +1,59 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+"""
+Compare presigning with a new boto3 S3 client per URL, as done before
+clients were cached, with a reused client, as `S3ClientCache` does.
+
+    python bench/bench_s3_clients.py [iterations]
+
+Requires boto3, no AWS access is needed to presign.
+"""
+import sys
+import timeit
+
+import boto3
+from botocore.config import Config
+
+
+ACCESS_KEY = 'AKIDEXAMPLE'
+SECRET_KEY = 'wJalrXUtnFEMI/K7MDENG+bPxRfiCYEXAMPLEKEY'
+TOKEN = 'FwoGZXIvYXdzEBYaDH/abc+def=='
+BUCKET = 'my-bucket'
+KEY = '1/org/pkg/file name.csv'
+REGION = 'eu-west-2'
+
+
+def _create_client():
+    # same arguments as `clients._create_client`
+    return boto3.client(
+        's3',
+        aws_access_key_id=ACCESS_KEY,
+        aws_secret_access_key=SECRET_KEY,
+        aws_session_token=TOKEN,
+        region_name=REGION,
+        config=Config(signature_version='s3v4'),
+    )
+
+
+def _presign(client):
+    return client.generate_presigned_url('get_object', Params={'Bucket': BUCKET, 'Key': KEY}, ExpiresIn=3600)
+
+
+def _report(name, seconds, iterations):
+    print(f'{name:<32} {seconds / iterations * 1e3:8.3f} ms/url')
+
+
+def main(iterations):
+    # the first client loads the service model from disk, leave it out
+    client = _create_client()
+    _presign(client)
+
+    fresh = timeit.timeit(lambda: _presign(_create_client()), number=iterations)
+    cached = timeit.timeit(lambda: _presign(client), number=iterations)
+    _report('new client per url', fresh, iterations)
+    _report('cached client', cached, iterations)
+    print(f'{"speedup":<32} {fresh / cached:8.1f}x')
+
+
+if __name__ == '__main__':
+    main(int(sys.argv[1]) if len(sys.argv) > 1 else 1000)
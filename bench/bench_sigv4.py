@@ -0,0 +1,66 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+"""
+Compare the native SigV4 presigner with boto3's `generate_presigned_url`.
+
+    python bench/bench_sigv4.py [iterations]
+
+boto3 is optional, without it only the native presigner is timed.
+"""
+import os
+import sys
+import timeit
+from datetime import datetime
+
+# run from a checkout, without installing the extension
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+
+from ckanext.cloudstorage.sigv4 import presign_get_object, presign_upload_part
+
+
+ACCESS_KEY = 'AKIDEXAMPLE'
+SECRET_KEY = 'wJalrXUtnFEMI/K7MDENG+bPxRfiCYEXAMPLEKEY'
+TOKEN = 'FwoGZXIvYXdzEBYaDH/abc+def=='
+BUCKET = 'my-bucket'
+KEY = '1/org/pkg/file name.csv'
+REGION = 'eu-west-2'
+
+
+def _report(name, seconds, iterations):
+    print(f'{name:<32} {seconds / iterations * 1e6:8.1f} us/url')
+
+
+def main(iterations):
+    now = datetime.utcnow()
+    _report('native get_object', timeit.timeit(
+        lambda: presign_get_object(BUCKET, KEY, ACCESS_KEY, SECRET_KEY, TOKEN, REGION, now=now),
+        number=iterations), iterations)
+    _report('native upload_part', timeit.timeit(
+        lambda: presign_upload_part(BUCKET, KEY, 'upload-id', 7, ACCESS_KEY, SECRET_KEY, TOKEN, REGION, now=now),
+        number=iterations), iterations)
+
+    try:
+        import boto3
+        from botocore.config import Config
+    except ImportError:
+        print('boto3 is not installed, skipping')
+        return
+    client = boto3.client(
+        's3',
+        aws_access_key_id=ACCESS_KEY,
+        aws_secret_access_key=SECRET_KEY,
+        aws_session_token=TOKEN,
+        region_name=REGION,
+        config=Config(signature_version='s3v4'),
+    )
+    _report('boto3 get_object', timeit.timeit(
+        lambda: client.generate_presigned_url('get_object', Params={'Bucket': BUCKET, 'Key': KEY}),
+        number=iterations), iterations)
+    _report('boto3 upload_part', timeit.timeit(
+        lambda: client.generate_presigned_url('upload_part', Params={
+            'Bucket': BUCKET, 'Key': KEY, 'UploadId': 'upload-id', 'PartNumber': 7}),
+        number=iterations), iterations)
+
+
+if __name__ == '__main__':
+    main(int(sys.argv[1]) if len(sys.argv) > 1 else 10000)
@@ -0,0 +1,89 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+import base64
+import hashlib
+import io
+import re
+from typing import Iterable, Optional
+
+
+_MD5_ETAG_RE = re.compile(r'^"?([0-9a-fA-F]{32})"?$')
+
+
+class ChecksumReader(object):
+    """
+    Read-only file wrapper feeding every byte read through it to running
+    MD5 and SHA-256 digests, so uploads are checksummed without a second
+    pass over the data.
+
+    The wrapper is deliberately not seekable: the digests are only correct
+    if the file is read once, in order. `tell` reports the bytes read so
+    far, which parallel uploaders (ex: azure-storage-blob) ask for before
+    reading blocks in order.
+    """
+    def __init__(self, fileobj):
+        self._fileobj = fileobj
+        self._md5 = hashlib.md5()
+        self._sha256 = hashlib.sha256()
+        self.size = 0
+
+    def read(self, size: int = -1) -> bytes:
+        data = self._fileobj.read(size)
+        self.update(data)
+        return data
+
+    def tell(self) -> int:
+        return self.size
+
+    def seekable(self) -> bool:
+        return False
+
+    def seek(self, offset: int, whence: int = io.SEEK_SET):
+        raise io.UnsupportedOperation('checksummed streams are not seekable')
+
+    def update(self, data: bytes):
+        self._md5.update(data)
+        self._sha256.update(data)
+        self.size += len(data)
+
+    @property
+    def md5(self) -> str:
+        return self._md5.hexdigest()
+
+    @property
+    def sha256(self) -> str:
+        return self._sha256.hexdigest()
+
+    def as_resource_fields(self) -> dict:
+        return {
+            'size': self.size,
+            'hash': self.sha256,
+            'md5': self.md5,
+        }
+
+
+def content_md5(data: bytes) -> str:
+    """The base64 encoded MD5 digest expected by the Content-MD5 header."""
+    return base64.b64encode(hashlib.md5(data).digest()).decode('ascii')
+
+
+def etag_md5(etag: str) -> Optional[str]:
+    """The MD5 digest an ETag consists of, `None` if it is not one."""
+    match = _MD5_ETAG_RE.match(etag)
+    return match.group(1).lower() if match else None
+
+
+def multipart_md5(etags: Iterable[str]) -> Optional[str]:
+    """
+    The checksum S3 reports as the ETag of an object uploaded in parts: the
+    MD5 of the concatenated part MD5s, followed by the number of parts.
+
+    Returns `None` if a part ETag is not an MD5 digest (ex: SSE-KMS).
+    """
+    digests = []
+    for etag in etags:
+        digest = etag_md5(etag)
+        if digest is None:
+            return None
+        digests.append(bytes.fromhex(digest))
+    return f'{hashlib.md5(b"".join(digests)).hexdigest()}-{len(digests)}'
@@ -1,12 +1,18 @@
 # -*- coding: utf-8 -*-
 import logging
+import signal
 import sys
 
 import click
 from ckan.lib.jobs import Worker
 
 import ckanext.cloudstorage.utils as utils
+from .config import config
+from .rekey import Checkpoint, rekey_resources
+from .multipart_cleanup import clean_multipart_uploads, schedule_clean_multipart_job
 from .sync import schedule_s3_sync_job
+from .sync.sync import handle_s3_events
+from .sync.worker import SyncWorker
 
 
 logger = logging.getLogger(__name__)
@@ -25,11 +31,89 @@ def sync():
     schedule_s3_sync_job()
 
 
+@cloudstorage.command('sync-worker')
+def sync_worker():
+    """Consume the S3 event queue continuously.
+
+    SIGTERM or Ctrl-C stop the worker once the current batch is handled,
+    a second one stops it right away.
+    """
+    worker = SyncWorker.from_config(handle_s3_events)
+
+    def stop(signum, frame):
+        signal.signal(signal.SIGTERM, signal.SIG_DFL)
+        signal.signal(signal.SIGINT, signal.default_int_handler)
+        worker.stop()
+
+    signal.signal(signal.SIGTERM, stop)
+    signal.signal(signal.SIGINT, stop)
+    worker.run()
+
+
 @cloudstorage.command()
 def initdb():
+    """Reinitialize database tables.
+    """
     utils.initdb()
 
 
+@cloudstorage.command()
+def upgradedb():
+    """Upgrade database tables to the current schema, keeping their rows.
+    """
+    utils.upgradedb()
+    click.secho('DB tables are upgraded', fg='green')
+
+
+@cloudstorage.command('clean-multipart')
+@click.option('--dry-run', is_flag=True, help='Only count the uploads to remove.')
+@click.option('--enqueue', is_flag=True, help='Run the cleanup in a background job.')
+def clean_multipart(dry_run, enqueue):
+    """Abort expired multipart uploads, including the ones unknown to CKAN.
+    """
+    if enqueue:
+        job_id = schedule_clean_multipart_job()
+        click.secho(f'Enqueued job {job_id}' if job_id else 'A cleanup job is already queued', fg='green')
+        return
+
+    result = clean_multipart_uploads(dry_run=dry_run)
+    if dry_run:
+        click.secho('{total} expired uploads would be removed, {orphans} unknown to CKAN'.format(**result))
+        return
+    click.secho(
+        '{removed} of {total} expired uploads removed, {orphans} unknown to CKAN'.format(**result),
+        fg='red' if result['errors'] else 'green',
+    )
+    for error in result['errors']:
+        click.secho(error, fg='red')
+
+
+@cloudstorage.command()
+@click.option('--checkpoint', default='cloudstorage-rekey.checkpoint', show_default=True,
+              help='File recording the last resource handled, to resume from.')
+@click.option('--batch-size', default=100, show_default=True, help='Resources updated per commit.')
+@click.option('--concurrency', type=int, help='Objects copied at once, defaults to the upload concurrency.')
+@click.option('--keep-source', is_flag=True, help='Keep the objects at their old key.')
+@click.option('--dry-run', is_flag=True, help='Only count the objects to move.')
+def rekey(checkpoint, batch_size, concurrency, keep_source, dry_run):
+    """Move uploaded objects to the latest key format with server-side copies.
+    """
+    def report(stats):
+        click.echo(str(stats))
+
+    stats = rekey_resources(
+        Checkpoint(checkpoint),
+        batch_size=batch_size,
+        concurrency=concurrency or max(config.upload_concurrency, 1),
+        delete_source=not keep_source,
+        dry_run=dry_run,
+        on_batch=report,
+    )
+    click.secho(str(stats), fg='red' if stats.errors else 'green')
+    for error in stats.errors:
+        click.secho(error, fg='red')
+
+
 @cloudstorage.command('fix-cors')
 @click.argument('domains', nargs=-1)
 def fix_cors(domains):
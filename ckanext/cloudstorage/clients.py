@@ -0,0 +1,142 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+import logging
+import threading
+from typing import Optional
+
+from .config import config
+from .credentials import resolve_aws_credentials
+
+
+logger = logging.getLogger(__name__)
+
+
+class S3ClientCache:
+    """
+    Process-wide cache of boto3 S3 clients.
+
+    Building a client loads the botocore service model, which is far more
+    expensive than the presign or delete call made with it. Clients are
+    thread-safe once created, so a single client is shared by all threads
+    for a given region and set of credentials.
+
+    Clients built from the shared AWS credentials are dropped as soon as
+    those credentials are rotated.
+    """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._clients = {}
+        self._generation = 0
+        self.hits = 0
+        self.misses = 0
+
+    def get(self, region: Optional[str] = None):
+        region = region or config.aws_bucket_region
+        aws = resolve_aws_credentials()
+        generation = aws.generation
+        credentials = (aws.access_key, aws.secret_key, aws.token)
+
+        key = (region,) + credentials
+        with self._lock:
+            if generation != self._generation:
+                logger.debug("aws credentials rotated, dropping %i s3 clients", len(self._clients))
+                self._clients = {}
+                self._generation = generation
+
+            client = self._clients.get(key)
+            if client is not None:
+                self.hits += 1
+                return client
+
+            self.misses += 1
+            # boto3's default session is not thread-safe, build under the lock
+            client = self._clients[key] = _create_client(region, *credentials)
+            return client
+
+    def clear(self):
+        with self._lock:
+            self._clients = {}
+
+    def stats(self) -> dict:
+        with self._lock:
+            return {
+                'hits': self.hits,
+                'misses': self.misses,
+                'clients': len(self._clients),
+            }
+
+
+def _create_client(region, access_key, secret_key, token):
+    import boto3
+    from botocore.config import Config
+    # botocore still presigns with SigV2 in some regions by default, SigV4
+    # matches the native presigner and works in every region
+    return boto3.client(
+        's3',
+        aws_access_key_id=access_key,
+        aws_secret_access_key=secret_key,
+        aws_session_token=token,
+        region_name=region,
+        config=Config(signature_version='s3v4'),
+    )
+
+
+class AzureServiceCache:
+    """
+    Process-wide cache of the azure-storage `BlockBlobService`.
+
+    The service keeps a pooled HTTP session, and the SDK itself shares it
+    between the threads of parallel block uploads, so one service is used
+    by all threads as long as the account and block size do not change.
+    """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._service = None
+        self._key = None
+        self.hits = 0
+        self.misses = 0
+
+    def get(self):
+        key = (
+            config.driver_options['key'],
+            config.driver_options['secret'],
+            config.azure_block_size,
+        )
+        with self._lock:
+            if self._service is not None and self._key == key:
+                self.hits += 1
+                return self._service
+
+            self.misses += 1
+            self._service = _create_blob_service(*key)
+            self._key = key
+            return self._service
+
+    def clear(self):
+        with self._lock:
+            self._service = None
+            self._key = None
+
+    def stats(self) -> dict:
+        with self._lock:
+            return {
+                'hits': self.hits,
+                'misses': self.misses,
+                'clients': int(self._service is not None),
+            }
+
+
+def _create_blob_service(account_name, account_key, block_size):
+    from azure.storage import blob as azure_blob
+    service = azure_blob.BlockBlobService(account_name, account_key)
+    service.MAX_BLOCK_SIZE = block_size
+    return service
+
+
+s3_clients = S3ClientCache()
+config.on_reload(s3_clients.clear)
+
+azure_services = AzureServiceCache()
+config.on_reload(azure_services.clear)
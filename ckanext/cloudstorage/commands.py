@@ -12,10 +12,12 @@ Commands:
     - fix-cors       Update CORS rules where possible.
     - migrate        Upload local storage to the remote.
     - initdb         Reinitalize database tables.
+    - upgradedb      Upgrade database tables, keeping their rows.
 Usage:
     cloudstorage fix-cors <domains>... [--c=<config>]
     cloudstorage migrate <path_to_storage> [<resource_id>] [--c=<config>]
     cloudstorage initdb [--c=<config>]
+    cloudstorage upgradedb [--c=<config>]
 Options:
     -c=<config>       The CKAN configuration file.
 """
@@ -35,6 +37,8 @@ class PasterCommand(CkanCommand):
             _migrate(args)
         elif args['initdb']:
             _initdb()
+        elif args['upgradedb']:
+            _upgradedb()
 
 
 def _migrate(args):
@@ -51,3 +55,8 @@ def _fix_cors(args):
 def _initdb():
     utils.initdb()
     print("DB tables are reinitialized")
+
+
+def _upgradedb():
+    utils.upgradedb()
+    print("DB tables are upgraded")
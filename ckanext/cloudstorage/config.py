@@ -1,10 +1,139 @@
 from ast import literal_eval
-from typing import Optional
+from dataclasses import dataclass
+from datetime import timedelta
+from types import MappingProxyType
+from typing import Any, Callable, List, Mapping, Optional, Tuple
 
 from ckan.plugins import toolkit
 
 
+@dataclass(frozen=True)
+class ConfigSnapshot:
+    """
+    The ckanext-cloudstorage options, parsed once from the CKAN config.
+    """
+    driver_name: str
+    driver_options: Mapping[str, Any]
+    container_name: str
+    aws_access_key_id: Optional[str]
+    aws_secret_access_key: Optional[str]
+    aws_bucket_region: Optional[str]
+    use_secure_urls: bool
+    leave_files: bool
+    guess_mimetype: bool
+    queue_region: Optional[str]
+    queue_url: Optional[str]
+    use_fake_events: bool
+    sync_wait_time: int
+    sync_visibility_timeout: int
+    max_multipart_lifetime: timedelta
+    datapusher_formats: Tuple[str, ...]
+    presigned_url_cache_size: int
+    presigned_url_cache_redis: bool
+    presigned_url_min_validity: float
+    presigner: str
+    local_container: bool
+    credentials_refresh_margin: int
+    credentials_background_refresh: bool
+    credentials_redis: bool
+    proxy_downloads: bool
+    proxy_chunk_size: int
+    upload_part_size: int
+    upload_concurrency: int
+    upload_part_retries: int
+    azure_max_connections: int
+    azure_block_size: int
+    multipart_direct_upload: bool
+    multipart_max_part_size: int
+    multipart_cleanup_concurrency: int
+    multipart_cleanup_rate: float
+    multipart_finish_in_background: bool
+    multipart_finish_timeout: int
+
+    @classmethod
+    def from_ckan_config(cls, ckan_config) -> 'ConfigSnapshot':
+        driver_options = literal_eval(ckan_config.get('ckanext.cloudstorage.driver_options', '{}'))
+        return cls(
+            driver_name=ckan_config['ckanext.cloudstorage.driver'],
+            driver_options=MappingProxyType(driver_options),
+            container_name=ckan_config['ckanext.cloudstorage.container_name'],
+            aws_access_key_id=driver_options.get('key'),
+            aws_secret_access_key=driver_options.get('secret'),
+            aws_bucket_region=driver_options.get('region'),
+            use_secure_urls=toolkit.asbool(ckan_config.get('ckanext.cloudstorage.use_secure_urls', True)),
+            leave_files=toolkit.asbool(ckan_config.get('ckanext.cloudstorage.leave_files', False)),
+            guess_mimetype=toolkit.asbool(ckan_config.get('ckanext.cloudstorage.guess_mimetype', True)),
+            queue_region=ckan_config.get('ckanext.cloudstorage.sync.queue_region'),
+            queue_url=ckan_config.get('ckanext.cloudstorage.sync.queue_url'),
+            use_fake_events=toolkit.asbool(ckan_config.get('ckanext.cloudstorage.sync.use_fake_events', False)),
+            sync_wait_time=int(ckan_config.get('ckanext.cloudstorage.sync.wait_time', 20)),
+            sync_visibility_timeout=int(ckan_config.get('ckanext.cloudstorage.sync.visibility_timeout', 120)),
+            max_multipart_lifetime=timedelta(float(ckan_config.get('ckanext.cloudstorage.max_multipart_lifetime', 7))),
+            datapusher_formats=tuple(ckan_config.get('ckanext.cloudstorage.datapusher.formats', '').split()),
+            presigned_url_cache_size=int(ckan_config.get('ckanext.cloudstorage.presigned_url_cache.size', 0)),
+            presigned_url_cache_redis=toolkit.asbool(ckan_config.get('ckanext.cloudstorage.presigned_url_cache.redis', False)),
+            presigned_url_min_validity=float(ckan_config.get('ckanext.cloudstorage.presigned_url_cache.min_validity', 0.5)),
+            presigner=ckan_config.get('ckanext.cloudstorage.presigner', 'boto3'),
+            local_container=toolkit.asbool(ckan_config.get('ckanext.cloudstorage.local_container', False)),
+            credentials_refresh_margin=int(ckan_config.get('ckanext.cloudstorage.credentials.refresh_margin', 60)),
+            credentials_background_refresh=toolkit.asbool(ckan_config.get('ckanext.cloudstorage.credentials.background_refresh', False)),
+            credentials_redis=toolkit.asbool(ckan_config.get('ckanext.cloudstorage.credentials.redis', False)),
+            proxy_downloads=toolkit.asbool(ckan_config.get('ckanext.cloudstorage.proxy_downloads', False)),
+            proxy_chunk_size=int(ckan_config.get('ckanext.cloudstorage.proxy_chunk_size', 64 * 1024)),
+            upload_part_size=int(ckan_config.get('ckanext.cloudstorage.upload.part_size', 64 * 1024 * 1024)),
+            upload_concurrency=int(ckan_config.get('ckanext.cloudstorage.upload.concurrency', 4)),
+            upload_part_retries=int(ckan_config.get('ckanext.cloudstorage.upload.part_retries', 3)),
+            azure_max_connections=int(ckan_config.get('ckanext.cloudstorage.azure.max_connections', 4)),
+            azure_block_size=int(ckan_config.get('ckanext.cloudstorage.azure.block_size', 4 * 1024 * 1024)),
+            multipart_direct_upload=toolkit.asbool(
+                ckan_config.get('ckanext.cloudstorage.multipart.direct_upload', False)),
+            multipart_max_part_size=int(
+                ckan_config.get('ckanext.cloudstorage.multipart.max_part_size', 256 * 1024 * 1024)),
+            multipart_cleanup_concurrency=int(
+                ckan_config.get('ckanext.cloudstorage.multipart.cleanup_concurrency', 8)),
+            multipart_cleanup_rate=float(
+                ckan_config.get('ckanext.cloudstorage.multipart.cleanup_rate', 50)),
+            multipart_finish_in_background=toolkit.asbool(
+                ckan_config.get('ckanext.cloudstorage.multipart.finish_in_background', True)),
+            multipart_finish_timeout=int(
+                ckan_config.get('ckanext.cloudstorage.multipart.finish_timeout', 60)),
+        )
+
+
 class Config:
+    def __init__(self):
+        self._snapshot = None
+        self._reload_callbacks: List[Callable[[], None]] = []
+
+    @property
+    def snapshot(self) -> ConfigSnapshot:
+        """
+        The parsed configuration. Built on first access if the plugin has
+        not been configured yet.
+        """
+        snapshot = self._snapshot
+        if snapshot is None:
+            snapshot = self.reload()
+        return snapshot
+
+    def reload(self, ckan_config=None) -> ConfigSnapshot:
+        """
+        Parse the configuration again and notify everything that caches
+        objects built from it (drivers, clients, ...).
+
+        :param ckan_config: The CKAN config, defaults to `toolkit.config`.
+        """
+        self._snapshot = ConfigSnapshot.from_ckan_config(
+            toolkit.config if ckan_config is None else ckan_config
+        )
+        for callback in self._reload_callbacks:
+            callback()
+        return self._snapshot
+
+    def on_reload(self, callback: Callable[[], None]):
+        """Register a callback invoked every time the configuration is reloaded."""
+        self._reload_callbacks.append(callback)
+
     @property
     def driver_name(self) -> str:
         """
@@ -17,15 +146,15 @@ class Config:
             This value is used to lookup the apache-libcloud driver to use
             based on the Provider enum.
         """
-        return toolkit.config['ckanext.cloudstorage.driver']
+        return self.snapshot.driver_name
 
     @property
-    def driver_options(self) -> dict:
+    def driver_options(self) -> Mapping[str, Any]:
         """
-        A dictionary of options ckanext-cloudstorage has been configured to
-        pass to the apache-libcloud driver.
+        A read-only dictionary of options ckanext-cloudstorage has been
+        configured to pass to the apache-libcloud driver.
         """
-        return literal_eval(toolkit.config.get('ckanext.cloudstorage.driver_options', '{}'))
+        return self.snapshot.driver_options
 
     @property
     def container_name(self) -> str:
@@ -33,19 +162,19 @@ class Config:
         The name of the container (also called buckets on some providers)
         ckanext-cloudstorage is configured to use.
         """
-        return toolkit.config["ckanext.cloudstorage.container_name"]
+        return self.snapshot.container_name
 
     @property
     def aws_access_key_id(self) -> Optional[str]:
-        return self.driver_options.get('key')
+        return self.snapshot.aws_access_key_id
 
     @property
     def aws_secret_access_key(self) -> Optional[str]:
-        return self.driver_options.get('secret')
+        return self.snapshot.aws_secret_access_key
 
     @property
     def aws_bucket_region(self) -> Optional[str]:
-        return self.driver_options.get('region')
+        return self.snapshot.aws_bucket_region
 
     @property
     def use_secure_urls(self) -> bool:
@@ -53,7 +182,7 @@ class Config:
         `True` if ckanext-cloudstroage is configured to generate secure
         one-time URLs to resources, `False` otherwise.
         """
-        return toolkit.asbool(toolkit.config.get('ckanext.cloudstorage.use_secure_urls', True))
+        return self.snapshot.use_secure_urls
 
     @property
     def leave_files(self) -> bool:
@@ -62,19 +191,35 @@ class Config:
         provider instead of removing them when a resource/package is deleted,
         otherwise `False`.
         """
-        return toolkit.asbool(toolkit.config.get('ckanext.cloudstorage.leave_files', False))
+        return self.snapshot.leave_files
 
     @property
-    def queue_region(self) -> str:
-        return toolkit.config["ckanext.cloudstorage.sync.queue_region"]
+    def queue_region(self) -> Optional[str]:
+        return self.snapshot.queue_region
 
     @property
-    def queue_url(self) -> str:
-        return toolkit.config["ckanext.cloudstorage.sync.queue_url"]
+    def queue_url(self) -> Optional[str]:
+        return self.snapshot.queue_url
 
     @property
     def use_fake_events(self) -> bool:
-        return toolkit.asbool(toolkit.config.get("ckanext.cloudstorage.sync.use_fake_events", False))
+        return self.snapshot.use_fake_events
+
+    @property
+    def sync_wait_time(self) -> int:
+        """
+        Seconds a poll of the sync queue waits for messages (SQS long
+        polling, at most 20).
+        """
+        return self.snapshot.sync_wait_time
+
+    @property
+    def sync_visibility_timeout(self) -> int:
+        """
+        Seconds the messages received by the sync worker stay hidden from
+        other consumers, extended while they are being handled.
+        """
+        return self.snapshot.sync_visibility_timeout
 
     @property
     def guess_mimetype(self) -> bool:
@@ -82,7 +227,187 @@ class Config:
         `True` if ckanext-cloudstorage is configured to guess mime types,
         `False` otherwise.
         """
-        return toolkit.asbool(toolkit.config.get('ckanext.cloudstorage.guess_mimetype', True))
+        return self.snapshot.guess_mimetype
+
+    @property
+    def max_multipart_lifetime(self) -> timedelta:
+        """
+        How long an unfinished multipart upload is kept before
+        `cloudstorage_clean_multipart` aborts it.
+        """
+        return self.snapshot.max_multipart_lifetime
+
+    @property
+    def datapusher_formats(self) -> Tuple[str, ...]:
+        """
+        Resource formats submitted to the datapusher once a multipart upload
+        is finished.
+        """
+        return self.snapshot.datapusher_formats
+
+    @property
+    def presigned_url_cache_size(self) -> int:
+        """
+        Maximum number of signed download URLs kept in memory by each
+        process. `0` disables the cache.
+        """
+        return self.snapshot.presigned_url_cache_size
+
+    @property
+    def presigned_url_cache_redis(self) -> bool:
+        """
+        `True` if signed download URLs are also shared between processes
+        through redis, otherwise `False`.
+        """
+        return self.snapshot.presigned_url_cache_redis
+
+    @property
+    def presigned_url_min_validity(self) -> float:
+        """
+        Fraction of the requested lifetime a cached URL must still be valid
+        for to be reused.
+        """
+        return self.snapshot.presigned_url_min_validity
+
+    @property
+    def presigner(self) -> str:
+        """
+        How S3 download URLs are signed: `boto3` (default) or `native`, which
+        signs with the built-in SigV4 implementation without a boto3 client.
+        """
+        return self.snapshot.presigner
+
+    @property
+    def local_container(self) -> bool:
+        """
+        `True` if the libcloud container is built from the configuration
+        instead of being fetched from the provider on every request. The
+        container is then validated once when the plugin is configured.
+        """
+        return self.snapshot.local_container
+
+    @property
+    def credentials_refresh_margin(self) -> int:
+        """
+        Number of seconds before their expiry AWS credentials are renewed.
+        """
+        return self.snapshot.credentials_refresh_margin
+
+    @property
+    def credentials_background_refresh(self) -> bool:
+        """
+        `True` if AWS credentials are renewed by a background thread in each
+        process instead of by the first request that needs them.
+        """
+        return self.snapshot.credentials_background_refresh
+
+    @property
+    def credentials_redis(self) -> bool:
+        """
+        `True` if AWS credentials are shared between processes through
+        redis, so that only one of them calls STS at a time.
+        """
+        return self.snapshot.credentials_redis
+
+    @property
+    def proxy_downloads(self) -> bool:
+        """
+        `True` if downloads are streamed through CKAN instead of redirecting
+        the client to the provider, otherwise `False`.
+        """
+        return self.snapshot.proxy_downloads
+
+    @property
+    def proxy_chunk_size(self) -> int:
+        """
+        Size in bytes of the chunks read from the provider when proxying
+        downloads.
+        """
+        return self.snapshot.proxy_chunk_size
+
+    @property
+    def upload_part_size(self) -> int:
+        """
+        Size in bytes of the parts of server-side multipart uploads. Files
+        larger than a single part are uploaded in parts.
+        """
+        return self.snapshot.upload_part_size
+
+    @property
+    def upload_concurrency(self) -> int:
+        """
+        Number of parts of a server-side multipart upload sent at once.
+        """
+        return self.snapshot.upload_concurrency
+
+    @property
+    def upload_part_retries(self) -> int:
+        """
+        Number of times a failed part of a server-side multipart upload is
+        retried before the upload is aborted.
+        """
+        return self.snapshot.upload_part_retries
+
+    @property
+    def azure_max_connections(self) -> int:
+        """
+        Number of blocks uploaded at once when a blob is uploaded with the
+        azure-storage SDK.
+        """
+        return self.snapshot.azure_max_connections
+
+    @property
+    def azure_block_size(self) -> int:
+        """Size in bytes of the blocks of blobs uploaded with the azure-storage SDK."""
+        return self.snapshot.azure_block_size
+
+    @property
+    def multipart_direct_upload(self) -> bool:
+        """
+        Whether browsers upload the parts of multipart uploads straight to
+        S3 with presigned URLs, instead of through `upload_multipart`.
+        """
+        return self.snapshot.multipart_direct_upload
+
+    @property
+    def multipart_max_part_size(self) -> int:
+        """
+        Largest part size in bytes browsers may pick for multipart uploads,
+        unless the file would not fit in 10,000 parts otherwise.
+        """
+        return self.snapshot.multipart_max_part_size
+
+    @property
+    def multipart_cleanup_concurrency(self) -> int:
+        """
+        Number of expired multipart uploads aborted at once by the cleanup.
+        """
+        return self.snapshot.multipart_cleanup_concurrency
+
+    @property
+    def multipart_cleanup_rate(self) -> float:
+        """
+        Most multipart uploads aborted per second by the cleanup, `0` for no
+        limit.
+        """
+        return self.snapshot.multipart_cleanup_rate
+
+    @property
+    def multipart_finish_in_background(self) -> bool:
+        """
+        Whether the resource updates after a multipart upload run in a
+        background job when a CKAN worker is running, instead of in the
+        `finish_multipart` request.
+        """
+        return self.snapshot.multipart_finish_in_background
+
+    @property
+    def multipart_finish_timeout(self) -> int:
+        """
+        Seconds the background job of a finished multipart upload may wait
+        for a worker before `multipart_status` reports it as failed.
+        """
+        return self.snapshot.multipart_finish_timeout
 
 
 config = Config()
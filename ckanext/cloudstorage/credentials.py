@@ -0,0 +1,225 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+import json
+import logging
+import os
+import random
+import threading
+import time
+from datetime import datetime, timedelta
+from typing import NamedTuple, Optional
+
+from ckan.lib.redis import connect_to_redis
+
+from .config import config
+from .distributed_lock import distributed_lock, LockError
+
+
+logger = logging.getLogger(__name__)
+
+EXPIRES_FORMAT = '%Y-%m-%dT%H:%M:%SZ'
+REDIS_KEY = 'cloudstorage:aws-credentials'
+
+
+class AwsCredentials(NamedTuple):
+    access_key: str
+    secret_key: str
+    token: Optional[str]
+    expires: datetime
+    """UTC time after which the credentials must be fetched again."""
+
+    generation: int
+    """Incremented every time new credentials are fetched."""
+
+    def is_expired(self) -> bool:
+        return self.expires < datetime.utcnow()
+
+    def as_driver_options(self) -> dict:
+        """The credentials in the format expected by the libcloud S3 driver."""
+        return {
+            'key': self.access_key,
+            'secret': self.secret_key,
+            'token': self.token,
+            'expires': self.expires.strftime(EXPIRES_FORMAT),
+        }
+
+
+class AwsCredentialStore:
+    """
+    Process-wide holder for the AWS credentials used when no static key is
+    configured in the driver options.
+
+    Credentials are renewed `credentials_refresh_margin` seconds before they
+    expire, either by the first request that notices it or, when enabled,
+    by a background thread so requests never wait on STS. With redis
+    sharing enabled, a single process of the fleet fetches new credentials
+    and the others pick them up from redis.
+
+    TTL max 900 seconds for IAM role session
+    https://docs.aws.amazon.com/IAM/latest/UserGuide/id_roles_use.html#id_roles_use_view-role-max-session
+    """
+    ttl = timedelta(seconds=900)
+    retry_delay = 10
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._credentials = None
+        self._generation = 0
+        self._refresher_pid = None
+
+    @property
+    def generation(self) -> int:
+        return self._generation
+
+    def get(self) -> AwsCredentials:
+        """
+        Return the current credentials, fetching new ones if they are
+        missing or about to expire.
+        """
+        if config.credentials_background_refresh and self._refresher_pid != os.getpid():
+            self._start_refresher()
+
+        credentials = self._credentials
+        if credentials is None or self._is_stale(credentials):
+            with self._lock:
+                # another thread may have refreshed while we were waiting
+                credentials = self._credentials
+                if credentials is None or self._is_stale(credentials):
+                    credentials = self._refresh()
+        return credentials
+
+    def _is_stale(self, credentials: AwsCredentials) -> bool:
+        margin = timedelta(seconds=config.credentials_refresh_margin)
+        return credentials.expires - margin < datetime.utcnow()
+
+    def _refresh(self) -> AwsCredentials:
+        shared = self._load_shared() if config.credentials_redis else None
+        if shared is not None:
+            return self._publish(*shared)
+
+        if not config.credentials_redis:
+            return self._publish(*self._fetch())
+
+        try:
+            with distributed_lock('aws-credentials', blocking_timeout=5, timeout=30):
+                # the lock holder before us may have stored new credentials
+                shared = self._load_shared()
+                if shared is None:
+                    shared = self._fetch()
+                    self._store_shared(*shared)
+        except LockError:
+            logger.warning("unable to acquire aws credentials lock, fetching credentials directly")
+            shared = self._fetch()
+        return self._publish(*shared)
+
+    def _publish(self, access_key, secret_key, token, expires) -> AwsCredentials:
+        current = self._credentials
+        unchanged = current is not None and (current.access_key, current.token) == (access_key, token)
+        if not unchanged:
+            self._generation += 1
+        self._credentials = AwsCredentials(
+            access_key=access_key,
+            secret_key=secret_key,
+            token=token,
+            expires=expires,
+            generation=self._generation,
+        )
+        if not unchanged:
+            logger.debug("published aws credentials, generation %i", self._generation)
+        return self._credentials
+
+    def _fetch(self):
+        import boto3
+        session = boto3.Session(
+            aws_access_key_id=config.aws_access_key_id,
+            aws_secret_access_key=config.aws_secret_access_key,
+        )
+        frozen_credentials = session.get_credentials().get_frozen_credentials()
+        logger.debug("fetched aws credentials")
+        return (
+            frozen_credentials.access_key,
+            frozen_credentials.secret_key,
+            frozen_credentials.token,
+            datetime.utcnow() + self.ttl,
+        )
+
+    def _load_shared(self):
+        try:
+            value = connect_to_redis().get(REDIS_KEY)
+        except Exception:
+            logger.exception("unable to read aws credentials from redis")
+            return None
+        if value is None:
+            return None
+
+        data = json.loads(value)
+        expires = datetime.strptime(data['expires'], EXPIRES_FORMAT)
+        margin = timedelta(seconds=config.credentials_refresh_margin)
+        if expires - margin < datetime.utcnow():
+            return None
+        return data['key'], data['secret'], data['token'], expires
+
+    def _store_shared(self, access_key, secret_key, token, expires):
+        ttl = int((expires - datetime.utcnow()).total_seconds())
+        if ttl < 1:
+            return
+        value = json.dumps({
+            'key': access_key,
+            'secret': secret_key,
+            'token': token,
+            'expires': expires.strftime(EXPIRES_FORMAT),
+        })
+        try:
+            connect_to_redis().set(REDIS_KEY, value, ex=ttl)
+        except Exception:
+            logger.exception("unable to store aws credentials in redis")
+
+    def _start_refresher(self):
+        with self._lock:
+            # threads do not survive a fork, every worker needs its own
+            if self._refresher_pid == os.getpid():
+                return
+            self._refresher_pid = os.getpid()
+            thread = threading.Thread(
+                target=self._run_refresher,
+                name='cloudstorage-aws-credentials',
+                daemon=True,
+            )
+            thread.start()
+
+    def _run_refresher(self):
+        margin = config.credentials_refresh_margin
+        while True:
+            credentials = self._credentials
+            if credentials is not None:
+                # spread the refreshes of a fleet over half of the margin
+                delay = (credentials.expires - datetime.utcnow()).total_seconds()
+                delay -= margin * random.uniform(0.5, 1)
+                if delay > 0:
+                    time.sleep(delay)
+
+            try:
+                with self._lock:
+                    self._refresh()
+            except Exception:
+                logger.exception("unable to refresh aws credentials")
+                time.sleep(self.retry_delay)
+
+
+aws_credentials = AwsCredentialStore()
+
+
+def resolve_aws_credentials() -> AwsCredentials:
+    """
+    The static key configured in the driver options if any, otherwise the
+    shared credentials of the process.
+    """
+    if config.aws_access_key_id:
+        return AwsCredentials(
+            access_key=config.aws_access_key_id,
+            secret_key=config.aws_secret_access_key,
+            token=None,
+            expires=datetime.max,
+            generation=0,
+        )
+    return aws_credentials.get()
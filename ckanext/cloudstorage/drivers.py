@@ -0,0 +1,122 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+import logging
+import threading
+import weakref
+
+from libcloud.storage.types import Provider
+from libcloud.storage.providers import get_driver
+
+from .config import config
+
+
+logger = logging.getLogger(__name__)
+
+CREDENTIAL_OPTIONS = ('key', 'secret', 'token', 'expires')
+
+
+def _freeze(value):
+    if isinstance(value, dict):
+        return tuple(sorted((k, _freeze(v)) for k, v in value.items()))
+    if isinstance(value, (list, tuple, set)):
+        return tuple(_freeze(v) for v in value)
+    return value
+
+
+def _refresh_credentials(driver, driver_options: dict) -> bool:
+    """
+    Swap the credentials of an AWS driver without dropping its connection.
+
+    Returns `False` if the driver does not support in place updates.
+    """
+    connection = driver.connection
+    if not hasattr(connection, 'token'):
+        return False
+
+    key, secret = driver_options.get('key'), driver_options.get('secret')
+    driver.key, driver.secret = key, secret
+    driver.token = driver_options.get('token')
+    connection.user_id, connection.key = key, secret
+    connection.token = driver.token
+    signer = getattr(connection, 'signer', None)
+    if signer is not None:
+        signer.access_key, signer.access_secret = key, secret
+    return True
+
+
+class DriverRegistry:
+    """
+    Process-wide registry of apache-libcloud storage drivers.
+
+    Drivers are keyed by the driver name and the non-credential driver
+    options, so the connection of a driver (and its keep-alive pool) is
+    reused across requests. libcloud connections keep per-request state and
+    are not safe to share between threads, so each thread gets its own
+    driver for a given key.
+
+    Every driver remembers the credential generation it was built with. When
+    a newer generation is requested the credentials are updated in place
+    instead of building a new driver.
+    """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._local = threading.local()
+        self._drivers = weakref.WeakSet()
+        self.hits = 0
+        self.misses = 0
+        self.refreshes = 0
+
+    def get(self, driver_name: str, driver_options: dict, generation: int = 0):
+        key = (driver_name, _freeze({
+            k: v for k, v in driver_options.items()
+            if k not in CREDENTIAL_OPTIONS
+        }))
+        drivers = self._thread_drivers()
+        entry = drivers.get(key)
+
+        if entry is not None and entry[1] == generation:
+            self._count('hits')
+            return entry[0]
+
+        if entry is not None and _refresh_credentials(entry[0], driver_options):
+            self._count('refreshes')
+            drivers[key] = (entry[0], generation)
+            return entry[0]
+
+        self._count('misses')
+        logger.debug("creating new %s driver, registry stats: %s", driver_name, self.stats())
+        driver = get_driver(getattr(Provider, driver_name))(**driver_options)
+        drivers[key] = (driver, generation)
+        with self._lock:
+            self._drivers.add(driver)
+        return driver
+
+    def clear(self):
+        """Drop every driver. Threads will build new ones on their next request."""
+        with self._lock:
+            self._local = threading.local()
+            self._drivers = weakref.WeakSet()
+
+    def stats(self) -> dict:
+        with self._lock:
+            return {
+                'hits': self.hits,
+                'misses': self.misses,
+                'refreshes': self.refreshes,
+                'drivers': len(self._drivers),
+            }
+
+    def _thread_drivers(self) -> dict:
+        local = self._local
+        if not hasattr(local, 'drivers'):
+            local.drivers = {}
+        return local.drivers
+
+    def _count(self, counter: str):
+        with self._lock:
+            setattr(self, counter, getattr(self, counter) + 1)
+
+
+registry = DriverRegistry()
+config.on_reload(registry.clear)
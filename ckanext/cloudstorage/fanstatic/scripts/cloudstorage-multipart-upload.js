@@ -9,18 +9,44 @@ ckan.module('cloudstorage-multipart-upload', function($, _) {
                 resource_update: _('Resource has been updated.'),
                 undefined_upload_id: _('Undefined uploadId.'),
                 upload_completed: _('Upload completed. You will be redirected in few seconds...'),
-                unable_to_finish: _('Unable to finish multipart upload')
+                unable_to_finish: _('Unable to finish multipart upload'),
+                still_processing: _('The file is uploaded, the dataset is still being updated. Check it again in a few minutes.')
             }
         },
 
-        _partNumber: 1,
+        // Number of part URLs requested at once in direct uploads
+        _signBatchSize: 20,
+        // The number of parts in flight adapts to the measured throughput
+        // between these bounds
+        _minConcurrency: 1,
+        _maxConcurrency: 8,
+        _initialConcurrency: 3,
+        _partRetries: 4,
+        // Parts are sized so that one takes about this long to upload at the
+        // throughput observed during previous uploads
+        _partSeconds: 10,
+        // milliseconds between checks of a finished upload, and number of
+        // checks before giving up waiting
+        _finishPollInterval: 1000,
+        _finishPollAttempts: 120,
+        _minPartSize: 5 * 1024 * 1024,
+        _rateStorageKey: 'cloudstorage-multipart-rate',
 
         _uploadId: null,
+        _partSize: null,
+        _direct: false,
+        // part number -> true for the parts uploaded in this page
+        _completedParts: null,
+        // {partNumber, ETag} of the direct uploads not reported to CKAN yet
+        _pendingParts: null,
+        _partUrls: null,
+        _signing: null,
         _packageId: null,
         _resourceId: null,
         _uploadSize: null,
         _uploadName: null,
         _uploadedParts: null,
+        _uploadedBytes: 0,
         _clickedBtn: null,
         _redirect_url: null,
 
@@ -48,18 +74,10 @@ ckan.module('cloudstorage-multipart-upload', function($, _) {
 
             var self = this;
 
+            // Only used to pick the file, the parts are sent by `_onUploadParts`
             this._file.fileupload({
-                url: this.sandbox.client.url('/api/action/cloudstorage_upload_multipart'),
-                maxChunkSize: 5 * 1024 * 1024,
                 replaceFileInput: false,
-                formData: this._onGenerateAdditionalData,
-                submit: this._onUploadFileSubmit,
-                chunkdone: this._onChunkUploaded,
-                add: this._onFileUploadAdd,
-                progressall: this._onFileUploadProgress,
-                done: this._onFinishUpload,
-                fail: this._onUploadFail,
-                always: this._onAnyEndedUpload
+                add: this._onFileUploadAdd
             });
 
             this._save.on('click', this._onSaveClick);
@@ -67,10 +85,6 @@ ckan.module('cloudstorage-multipart-upload', function($, _) {
             this._onCheckExistingMultipart('choose');
         },
 
-        _onChunkUploaded: function () {
-            this._uploadedParts = this._partNumber++;
-        },
-
         _onCheckExistingMultipart: function (operation) {
             var self = this;
             var id = this._id.val();
@@ -78,22 +92,19 @@ ckan.module('cloudstorage-multipart-upload', function($, _) {
             this.sandbox.client.call(
                 'POST',
                 'cloudstorage_check_multipart',
-                {id: id},
+                // include the parts uploaded but not reported before
+                {id: id, reconcile: true},
                 function (data) {
                     if (!data.result) return;
                     var upload = data.result.upload;
 
                     var name = upload.name.slice(upload.name.lastIndexOf('/')+1);
                     self._uploadId = upload.id;
+                    self._direct = upload.direct;
+                    self._partSize = upload.part_size;
                     self._uploadSize = upload.size;
-                    self._uploadedParts = upload.parts;
                     self._uploadName = upload.original_name;
-                    self._partNumber = self._uploadedParts + 1;
-
-
-                    var current_chunk_size = self._file.fileupload('option', 'maxChunkSize');
-                    var uploaded_bytes = current_chunk_size * upload.parts;
-                    self._file.fileupload('option', 'uploadedBytes', uploaded_bytes);
+                    self._onRestoreCompletedParts(upload);
 
                     self.sandbox.notify(
                         'Incomplete upload',
@@ -112,6 +123,25 @@ ckan.module('cloudstorage-multipart-upload', function($, _) {
             );
         },
 
+        _onRestoreCompletedParts: function (upload) {
+            // Only the missing parts are uploaded again, parts whose size
+            // does not match their slot in the file are considered missing.
+            var size = Number(upload.size);
+            var partSize = upload.part_size || this._countChunkSize(size, this._minPartSize);
+            this._completedParts = {};
+            this._uploadedParts = 0;
+            this._uploadedBytes = 0;
+            for (var i = 0; i < upload.completed_parts.length; i++) {
+                var part = upload.completed_parts[i];
+                var expected = Math.min(partSize, size - (part.partNumber - 1) * partSize);
+                if (expected <= 0 || (part.size !== null && part.size !== expected)) continue;
+                this._completedParts[part.partNumber] = true;
+                this._uploadedParts++;
+                this._uploadedBytes += expected;
+            }
+            this._pendingParts = [];
+        },
+
         _onEnableResumeBtn: function (operation) {
             var self = this;
             this.$('.btn-remove-url').remove();
@@ -145,41 +175,9 @@ ckan.module('cloudstorage-multipart-upload', function($, _) {
             this._onCheckExistingMultipart('resume');
         },
 
-        _onUploadFileSubmit: function (event, data) {
-            if (!this._uploadId) {
-                this._onDisableSave(false);
-                this.sandbox.notify(
-                    'Upload error',
-                    this.i18n('undefined_upload_id'),
-                    'error'
-                );
-                return false;
-            }
-
-            this._setProgressType('info', this._progress);
-            this._progress.removeClass('hidden').show('slow');
-        },
-
-        _onGenerateAdditionalData: function (form) {
-            return [
-                {
-                    name: 'partNumber',
-                    value: this._partNumber
-                },
-                {
-                    name: 'uploadId',
-                    value: this._uploadId
-                },
-                {
-                    name: 'id',
-                    value: this._resourceId
-                }
-
-            ];
-        },
-
         _onAnyEndedUpload: function () {
-            this._partNumber = 1;
+            // presigned URLs may have expired by the time the upload resumes
+            this._partUrls = {};
         },
 
         _countChunkSize: function (size, chunk) {
@@ -188,11 +186,12 @@ ckan.module('cloudstorage-multipart-upload', function($, _) {
         },
 
         _onFileUploadAdd: function (event, data) {
+            var self = this;
             this._setProgress(0, this._bar);
             var file = data.files[0];
-            var target = $(event.target);
 
-            var chunkSize = this._countChunkSize(file.size, target.fileupload('option', 'maxChunkSize'));
+            // uploads started before the part size was recorded used 5MB parts
+            var chunkSize = this._partSize || this._countChunkSize(file.size, this._minPartSize);
 
             if (this._uploadName && this._uploadSize && this._uploadedParts !== null) {
                 if (this._uploadSize !== file.size || this._uploadName !== file.name){
@@ -208,7 +207,7 @@ ckan.module('cloudstorage-multipart-upload', function($, _) {
                 }
 
 
-                var loaded = chunkSize * this._uploadedParts;
+                var loaded = this._uploadedBytes;
 
                 // target.fileupload('option', 'uploadedBytes', loaded);
                 this._onFileUploadProgress(event, {
@@ -227,11 +226,10 @@ ckan.module('cloudstorage-multipart-upload', function($, _) {
             }
 
 
-            target.fileupload('option', 'maxChunkSize', chunkSize);
-
             this.el.off('multipartstarted.cloudstorage');
             this.el.on('multipartstarted.cloudstorage', function () {
-                data.submit();
+                self._onUploadParts(
+                    file, self._partSize || self._countChunkSize(file.size, self._minPartSize));
             });
         },
 
@@ -309,6 +307,10 @@ ckan.module('cloudstorage-multipart-upload', function($, _) {
                 this._onPrepareUpload(file, id).then(
                     function (data) {
                         self._uploadId = data.result.id;
+                        self._direct = data.result.direct;
+                        self._partSize = data.result.part_size;
+                        self._completedParts = null;
+                        self._pendingParts = null;
                         self.el.trigger('multipartstarted.cloudstorage');
                     },
                     function (err) {
@@ -321,6 +323,33 @@ ckan.module('cloudstorage-multipart-upload', function($, _) {
 
         },
 
+        _proposePartSize: function (size) {
+            // The server keeps the part size within the S3 limits
+            var rate = null;
+            try {
+                rate = Number(window.localStorage.getItem(this._rateStorageKey));
+            } catch (error) {
+                console.log(error);
+            }
+            var partSize = this._minPartSize;
+            if (rate > 0) {
+                var mb = 1024 * 1024;
+                partSize = Math.max(Math.ceil(rate * this._partSeconds / mb) * mb, partSize);
+            }
+            return this._countChunkSize(size, partSize);
+        },
+
+        _onSaveRate: function (state) {
+            if (!(state.rate > 0)) return;
+            try {
+                // throughput of a single part in bytes per second
+                window.localStorage.setItem(
+                    this._rateStorageKey, Math.round(state.rate * 1000 / state.concurrency));
+            } catch (error) {
+                console.log(error);
+            }
+        },
+
         _onPrepareUpload: function(file, id) {
 
             return $.ajax({
@@ -329,12 +358,238 @@ ckan.module('cloudstorage-multipart-upload', function($, _) {
                 data: JSON.stringify({
                     id: id,
                     name: encodeURIComponent(file.name),
-                    size: file.size
+                    size: file.size,
+                    partSize: this._proposePartSize(file.size)
                 })
             });
 
         },
 
+        _onUploadParts: function (file, chunkSize) {
+            var self = this;
+            if (!this._uploadId) {
+                this._onDisableSave(false);
+                this.sandbox.notify(
+                    'Upload error',
+                    this.i18n('undefined_upload_id'),
+                    'error'
+                );
+                return;
+            }
+
+            var partCount = Math.max(Math.ceil(file.size / chunkSize), 1);
+            this._completedParts = this._completedParts || {};
+            this._pendingParts = this._pendingParts || [];
+            this._partUrls = {};
+
+            var queue = [];
+            var uploadedBytes = 0;
+            for (var n = 1; n <= partCount; n++) {
+                if (this._completedParts[n]) {
+                    uploadedBytes += Math.min(chunkSize, file.size - (n - 1) * chunkSize);
+                } else {
+                    queue.push(n);
+                }
+            }
+
+            var state = {
+                concurrency: this._initialConcurrency,
+                inFlight: 0,
+                failed: false,
+                // throughput of the previous round, in bytes per ms
+                rate: 0,
+                round: {start: Date.now(), bytes: 0, parts: 0},
+                // bytes sent so far of the parts in flight
+                loaded: {}
+            };
+
+            var progress = function () {
+                var loaded = uploadedBytes;
+                for (var n in state.loaded) loaded += state.loaded[n];
+                self._onFileUploadProgress(null, {total: file.size, loaded: loaded});
+            };
+
+            this._setProgressType('info', this._progress);
+            this._progress.removeClass('hidden').show('slow');
+
+            new Promise(function (resolve, reject) {
+                // Parts may complete in any order, each one is recorded
+                // under its own number.
+                var start = function (n) {
+                    var blob = file.slice((n - 1) * chunkSize, Math.min(n * chunkSize, file.size));
+                    state.inFlight++;
+                    self._onUploadPart(n, blob, file.name, queue, function (loaded) {
+                        state.loaded[n] = loaded;
+                        progress();
+                    }, function () {
+                        // back off on errors
+                        state.concurrency = Math.max(Math.floor(state.concurrency / 2), self._minConcurrency);
+                    }).then(function (etag) {
+                        state.inFlight--;
+                        delete state.loaded[n];
+                        uploadedBytes += blob.size;
+                        self._completedParts[n] = true;
+                        self._uploadedParts = (self._uploadedParts || 0) + 1;
+                        if (self._direct) {
+                            self._pendingParts.push({partNumber: n, ETag: etag, size: blob.size});
+                        }
+                        self._onAdaptConcurrency(state, blob.size);
+                        progress();
+                        pump();
+                    }, function (error) {
+                        state.failed = true;
+                        reject(error);
+                    });
+                };
+                var pump = function () {
+                    if (state.failed) return;
+                    if (!queue.length && !state.inFlight) {
+                        resolve();
+                        return;
+                    }
+                    while (queue.length && state.inFlight < state.concurrency) {
+                        start(queue.shift());
+                    }
+                };
+                pump();
+            }).then(function () {
+                self._onSaveRate(state);
+                self._onAnyEndedUpload();
+                self._onFinishUpload();
+            }, function (error) {
+                console.log(error);
+                self._onSaveRate(state);
+                self._onAnyEndedUpload();
+                self._onUploadFail();
+            });
+        },
+
+        _onAdaptConcurrency: function (state, bytes) {
+            // Once every part of a round has completed, add a part in flight
+            // if the throughput improved, remove one if it dropped.
+            var round = state.round;
+            round.bytes += bytes;
+            round.parts++;
+            if (round.parts < state.concurrency) return;
+
+            var rate = round.bytes / Math.max(Date.now() - round.start, 1);
+            if (rate > state.rate * 1.05) {
+                state.concurrency = Math.min(state.concurrency + 1, this._maxConcurrency);
+            } else if (rate < state.rate * 0.9) {
+                state.concurrency = Math.max(state.concurrency - 1, this._minConcurrency);
+            }
+            state.rate = rate;
+            state.round = {start: Date.now(), bytes: 0, parts: 0};
+        },
+
+        _onUploadPart: async function (n, blob, name, queue, onProgress, onRetry) {
+            for (var attempt = 0; ; attempt++) {
+                try {
+                    if (this._direct) {
+                        var url = await this._onGetPartUrl(n, queue);
+                        return await this._onPutPart(url, blob, onProgress);
+                    }
+                    return await this._onPostPart(n, blob, name, onProgress);
+                } catch (error) {
+                    if (attempt >= this._partRetries) throw error;
+                    console.log(error);
+                    // the presigned URL may have expired
+                    delete this._partUrls[n];
+                    onProgress(0);
+                    onRetry();
+                    await new Promise(function (resolve) {
+                        setTimeout(resolve, 1000 * Math.pow(2, attempt));
+                    });
+                }
+            }
+        },
+
+        _onGetPartUrl: async function (n, queue) {
+            while (!this._partUrls[n]) {
+                if (!this._signing) {
+                    // sign the next parts of the queue along with this one
+                    var partNumbers = [n].concat(queue.slice(0, this._signBatchSize - 1));
+                    this._signing = this._onSignParts(partNumbers).finally(function () {
+                        this._signing = null;
+                    }.bind(this));
+                }
+                await this._signing;
+            }
+            return this._partUrls[n];
+        },
+
+        _onSignParts: async function (partNumbers) {
+            var parts = this._pendingParts.splice(0);
+            try {
+                var data = await $.ajax({
+                    method: 'POST',
+                    url: this.sandbox.client.url('/api/action/cloudstorage_sign_multipart_parts'),
+                    data: JSON.stringify({
+                        id: this._resourceId,
+                        uploadId: this._uploadId,
+                        partNumbers: partNumbers,
+                        parts: parts
+                    })
+                });
+            } catch (error) {
+                // report them with the next batch
+                Array.prototype.push.apply(this._pendingParts, parts);
+                throw error;
+            }
+            $.extend(this._partUrls, data.result.urls);
+        },
+
+        _onPutPart: function (url, blob, onProgress) {
+            return new Promise(function (resolve, reject) {
+                var xhr = new XMLHttpRequest();
+                xhr.open('PUT', url);
+                xhr.upload.onprogress = function (event) {
+                    onProgress(event.loaded);
+                };
+                xhr.onload = function () {
+                    if (xhr.status < 200 || xhr.status >= 300) {
+                        reject(new Error('Part upload failed with status ' + xhr.status));
+                        return;
+                    }
+                    var etag = xhr.getResponseHeader('ETag');
+                    if (etag) {
+                        resolve(etag);
+                    } else {
+                        // The bucket CORS rules must expose the ETag header
+                        reject(new Error('ETag header is not exposed by the bucket'));
+                    }
+                };
+                xhr.onerror = function () {
+                    reject(new Error('Part upload failed'));
+                };
+                xhr.send(blob);
+            });
+        },
+
+        _onPostPart: async function (n, blob, name, onProgress) {
+            var formData = new FormData();
+            formData.append('partNumber', n);
+            formData.append('uploadId', this._uploadId);
+            formData.append('id', this._resourceId);
+            formData.append('upload', blob, name);
+
+            var data = await $.ajax({
+                method: 'POST',
+                url: this.sandbox.client.url('/api/action/cloudstorage_upload_multipart'),
+                data: formData,
+                processData: false,
+                contentType: false,
+                xhr: function () {
+                    var xhr = $.ajaxSettings.xhr();
+                    xhr.upload.onprogress = function (event) {
+                        onProgress(event.loaded);
+                    };
+                    return xhr;
+                }
+            });
+            return data.result.ETag;
+        },
+
         _onAbortUpload: function(id) {
             var self = this;
             this.sandbox.client.call(
@@ -357,67 +612,29 @@ ckan.module('cloudstorage-multipart-upload', function($, _) {
         _onFinishUpload: function() {
             var self = this;
             var keepDraft = this._pressedSaveButton == 'again' || this._pressedSaveButton == 'go-dataset';
-            let ref_client = this.sandbox.client;
+            var uploadId = this._uploadId;
             this.sandbox.client.call(
                 'POST',
                 'cloudstorage_finish_multipart',
                 {
-                    'uploadId': this._uploadId,
+                    'uploadId': uploadId,
                     'id': this._resourceId,
                     'keepDraft': keepDraft,
-                    'save_action': this._pressedSaveButton
+                    'save_action': this._pressedSaveButton,
+                    'parts': this._pendingParts || []
                 },
                 function (data) {
-
-                    self._progress.hide('fast');
-                    self._onDisableSave(false);
-
-                    if (self._resourceId && self._packageId){
-                        self.sandbox.notify(
-                            'Success',
-                            self.i18n('upload_completed'),
-                            'success'
-                        );
-
-                        let package_type = 'dataset' //Default type 
-                        // Get the package type 
-                        ref_client.call(
-                            'POST',
-                            'package_show',
-                            {
-                                'id': self._packageId
-                            },
-                            function (data){
-                                try {
-                                    // try to parse type from the results
-                                    package_type = data.result.type;
-                                }
-                                catch (error) {
-                                    console.log(error);
-                                }
-                                // self._form.remove();
-                                if (self._pressedSaveButton == 'again') {
-                                    var path = `/${package_type}/new_resource/`;
-                                } else if (self._pressedSaveButton == 'go-dataset') {
-                                    var path = `/${package_type}/edit/`;
-                                } else {
-                                    var path = `/${package_type}/`;
-                                }
-                                var redirect_url = self.sandbox.url(path + self._packageId);
-
-                                self._form.attr('action', redirect_url);
-                                self._form.attr('method', 'GET');
-                                self.$('[name]').attr('name', null);
-                                setTimeout(function(){
-                                    self._form.submit();
-                                }, 3000);
-
-                            },
-                            function (error){
-                                console.log(error);
-                            }
-                        );
+                    self._pendingParts = null;
+                    self._completedParts = null;
+                    self._partSize = null;
+                    if (data.result.status == 'done') {
+                        // updated in the request, no worker is running
+                        self._onFinishedUpload();
+                        return;
                     }
+                    // The object is stored, wait for the dataset to be
+                    // updated before leaving the page.
+                    self._onWaitForFinish(uploadId, self._finishPollAttempts);
                 },
                 function (err) {
                     console.log(err);
@@ -427,6 +644,92 @@ ckan.module('cloudstorage-multipart-upload', function($, _) {
             this._setProgressType('success', this._progress);
         },
 
+        _onWaitForFinish: function (uploadId, attempts) {
+            var self = this;
+            this.sandbox.client.call(
+                'GET',
+                'cloudstorage_multipart_status',
+                '?id=' + encodeURIComponent(this._resourceId) +
+                    '&uploadId=' + encodeURIComponent(uploadId),
+                function (data) {
+                    var status = data.result.status;
+                    if (status == 'done') {
+                        self._onFinishedUpload();
+                    } else if (status == 'error') {
+                        console.log(data.result.error);
+                        self._onHandleError(self.i18n('unable_to_finish'));
+                    } else if (attempts <= 1) {
+                        // ex: no worker is running the background job
+                        self._progress.hide('fast');
+                        self._onDisableSave(false);
+                        self.sandbox.notify('', self.i18n('still_processing'), 'info');
+                    } else {
+                        setTimeout(function () {
+                            self._onWaitForFinish(uploadId, attempts - 1);
+                        }, self._finishPollInterval);
+                    }
+                },
+                function (err) {
+                    console.log(err);
+                    self._onHandleError(self.i18n('unable_to_finish'));
+                }
+            );
+        },
+
+        _onFinishedUpload: function () {
+            var self = this;
+            let ref_client = this.sandbox.client;
+            self._progress.hide('fast');
+            self._onDisableSave(false);
+
+            if (self._resourceId && self._packageId){
+                self.sandbox.notify(
+                    'Success',
+                    self.i18n('upload_completed'),
+                    'success'
+                );
+
+                let package_type = 'dataset' //Default type 
+                // Get the package type 
+                ref_client.call(
+                    'POST',
+                    'package_show',
+                    {
+                        'id': self._packageId
+                    },
+                    function (data){
+                        try {
+                            // try to parse type from the results
+                            package_type = data.result.type;
+                        }
+                        catch (error) {
+                            console.log(error);
+                        }
+                        // self._form.remove();
+                        if (self._pressedSaveButton == 'again') {
+                            var path = `/${package_type}/new_resource/`;
+                        } else if (self._pressedSaveButton == 'go-dataset') {
+                            var path = `/${package_type}/edit/`;
+                        } else {
+                            var path = `/${package_type}/`;
+                        }
+                        var redirect_url = self.sandbox.url(path + self._packageId);
+
+                        self._form.attr('action', redirect_url);
+                        self._form.attr('method', 'GET');
+                        self.$('[name]').attr('name', null);
+                        setTimeout(function(){
+                            self._form.submit();
+                        }, 3000);
+
+                    },
+                    function (error){
+                        console.log(error);
+                    }
+                );
+            }
+        },
+
         _onDisableSave: function (value) {
             this._save.attr('disabled', value);
         },
@@ -3,6 +3,7 @@
 import os
 
 from ckanext.cloudstorage.config import config
+from ckanext.cloudstorage.model import MultipartUpload
 from ckanext.cloudstorage.storage import STORAGE_PATH_FIELD_NAME
 
 
@@ -15,6 +16,7 @@ def use_secure_urls():
 
 
 STREAM_RESOURCE_TYPE = 'stream'
+UPLOAD_IN_PROGRESS_FIELD_NAME = 'upload_in_progress'
 
 
 def is_stream_resource(resource):
@@ -31,3 +33,42 @@ def get_package_cloud_storage_key(package: dict) -> str:
 
 def can_generate_presigned_url(resource):
     return resource.get(STORAGE_PATH_FIELD_NAME) is not None
+
+
+def _request_uploads_in_progress():
+    try:
+        from flask import g
+        return g.setdefault('cloudstorage_uploads_in_progress', {})
+    except (ImportError, RuntimeError):
+        # outside of a flask request context
+        return None
+
+
+def upload_in_progress(resource) -> bool:
+    """
+    Whether the file of the resource (dict or id) is still being uploaded,
+    in which case it should not be handled yet, ex: by the archiver.
+
+    For resource dicts the uploads in progress of the whole package are read
+    at once and memoised for the duration of the current request, so showing
+    a package takes a single query whatever its amount of resources.
+    """
+    if not isinstance(resource, dict):
+        return MultipartUpload.in_progress(resource)
+    if not resource.get('package_id'):
+        return MultipartUpload.in_progress(resource['id'])
+
+    package_id = resource['package_id']
+    memo = _request_uploads_in_progress()
+    if memo is None:
+        return MultipartUpload.in_progress(resource['id'])
+    if package_id not in memo:
+        memo[package_id] = MultipartUpload.resources_in_progress(package_id)
+    return resource['id'] in memo[package_id]
+
+
+def forget_uploads_in_progress():
+    """Drop the memoised uploads in progress, ex: when an upload starts or ends."""
+    memo = _request_uploads_in_progress()
+    if memo is not None:
+        memo.clear()
@@ -1,5 +1,8 @@
 from ckan.plugins import toolkit as tk
 from ...utils import canonicalize_package_name, convert_local_package_name_to_global
+from ...drivers import registry as driver_registry
+from ...clients import azure_services, s3_clients
+from ...url_cache import presigned_urls
 
 
 @tk.side_effect_free
@@ -10,3 +13,15 @@ def cloudstorage_package_show(context, data):
 
     data['id'] = package_name
     return tk.get_action('package_show')(context, data)
+
+
+@tk.side_effect_free
+def cloudstorage_stats(context, data):
+    """Connection pool counters of the current process. Sysadmins only."""
+    tk.check_access('cloudstorage_stats', context, data)
+    return {
+        'drivers': driver_registry.stats(),
+        's3_clients': s3_clients.stats(),
+        'azure_services': azure_services.stats(),
+        'presigned_urls': presigned_urls.stats(),
+    }
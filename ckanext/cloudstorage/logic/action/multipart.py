@@ -1,26 +1,81 @@
 #!/usr/bin/env python
 # -*- coding: utf-8 -*-
+import json
 import logging
-import datetime
+import time
 from urllib.parse import quote as url_quote
 
 import mimetypes
 from werkzeug.datastructures import FileStorage as FlaskFileStorage
 
-from ckan.plugins.toolkit import config
+from ckan.lib.jobs import get_queue
+from ckan.lib.redis import connect_to_redis
 from ckan.plugins import plugin_loaded
+from sqlalchemy.dialects.postgresql import insert
 from sqlalchemy.orm.exc import NoResultFound
+from libcloud.common.types import LibcloudError
+from libcloud.storage.drivers.s3 import NAMESPACE
+from libcloud.utils.xml import findall, findtext
+from requests.exceptions import RequestException
+from rq import Worker
 import ckan.model as model
 import ckan.lib.helpers as h
 import ckan.plugins.toolkit as toolkit
 
+from ckanext.cloudstorage.checksum import ChecksumReader, etag_md5, multipart_md5
 from ckanext.cloudstorage.storage import ResourceCloudStorage
 from ckanext.cloudstorage.model import MultipartUpload, MultipartPart
 from ckanext.cloudstorage.config import config
+from ckanext.cloudstorage.helpers import forget_uploads_in_progress
+from ckanext.cloudstorage.multipart_cleanup import clean_multipart_uploads
+from ckanext.cloudstorage.parallel_upload import MAX_PART_SIZE, MAX_PARTS, MIN_PART_SIZE, remaining_size
 
 
 log = logging.getLogger(__name__)
 
+# Parts presigned by a single `sign_multipart_parts` call, and their lifetime
+MAX_SIGNED_PARTS = 100
+SIGNED_PART_EXPIRES_IN = 3600
+
+# Size of the chunks proxied parts are sent to the provider in
+PART_CHUNK_SIZE = 1024 * 1024
+
+# Status of the metadata updates of finished uploads, kept for a day
+FINISH_STATUS_KEY = 'cloudstorage:multipart-finish:{}'
+FINISH_STATUS_TTL = 24 * 60 * 60
+
+# Errors of a provider request: refused by the provider, or lost on the way
+# (`ssl.SSLError` and socket errors are `OSError`)
+PROVIDER_ERRORS = (LibcloudError, RequestException, OSError)
+
+
+class _PartStream(object):
+    """
+    Body of a proxied part: the uploaded file sent in `PART_CHUNK_SIZE`
+    chunks and hashed on the way. Its length is known, so the provider gets
+    a Content-Length instead of a chunked body.
+    """
+    def __init__(self, fileobj, length):
+        self._checksum = ChecksumReader(fileobj)
+        self._length = length
+
+    def __len__(self):
+        return self._length
+
+    def __iter__(self):
+        return self
+
+    def __next__(self):
+        remaining = self._length - self._checksum.size
+        chunk = self._checksum.read(min(PART_CHUNK_SIZE, remaining)) if remaining > 0 else b''
+        if not chunk:
+            raise StopIteration
+        return chunk
+
+    @property
+    def md5(self):
+        return self._checksum.md5
+
 
 def _get_underlying_file(wrapper):
     if isinstance(wrapper, FlaskFileStorage):
@@ -28,11 +83,6 @@ def _get_underlying_file(wrapper):
     return wrapper.file
 
 
-def _get_max_multipart_lifetime():
-    value = float(config.get('ckanext.cloudstorage.max_multipart_lifetime', 7))
-    return datetime.timedelta(value)
-
-
 def _get_object_url(uploader, name):
     path = '/' + uploader.container_name + '/' + name
     return url_quote(path, safe="/~")
@@ -49,28 +99,107 @@ def _delete_multipart(upload, uploader):
 
     upload.delete()
     upload.commit()
+    forget_uploads_in_progress()
     return resp
 
 
-def _save_part_info(n, etag, upload):
+def _save_parts(upload_id, parts):
+    """Record the `(n, etag, size)` parts of an upload in one statement."""
+    if not parts:
+        return
+    statement = insert(MultipartPart.__table__).values([
+        {'upload_id': upload_id, 'n': n, 'etag': etag, 'size': size}
+        for n, etag, size in parts
+    ])
+    statement = statement.on_conflict_do_update(
+        index_elements=['upload_id', 'n'],
+        set_={'etag': statement.excluded.etag, 'size': statement.excluded.size},
+    )
+    model.Session.execute(statement)
+    model.Session.commit()
+
+
+def _list_provider_parts(uploader, upload):
+    """The parts of `upload` stored by the provider, as `(n, etag, size)`."""
+    parts = []
+    params = {'uploadId': upload.id}
+    while True:
+        resp = uploader.driver.connection.request(
+            _get_object_url(uploader, upload.name),
+            params=params
+        )
+        for part in findall(resp.object, 'Part', NAMESPACE):
+            parts.append((
+                int(findtext(part, 'PartNumber', NAMESPACE)),
+                findtext(part, 'ETag', NAMESPACE),
+                int(findtext(part, 'Size', NAMESPACE)),
+            ))
+        if findtext(resp.object, 'IsTruncated', NAMESPACE) != 'true':
+            return parts
+        params['part-number-marker'] = findtext(resp.object, 'NextPartNumberMarker', NAMESPACE)
+
+
+def _reconcile_parts(upload, provider_parts):
+    """Make the recorded parts of `upload` match the ones of the provider."""
+    stale = model.Session.query(MultipartPart).filter(MultipartPart.upload_id == upload.id)
+    if provider_parts:
+        stale = stale.filter(MultipartPart.n.notin_([n for n, _, _ in provider_parts]))
+    stale.delete(synchronize_session=False)
+    _save_parts(upload.id, provider_parts)
+    model.Session.commit()
+
+
+def _save_reported_parts(upload, parts):
+    """Record the parts uploaded by the browser straight to the provider."""
+    if not isinstance(parts, list):
+        raise toolkit.ValidationError({'parts': ['Must be a list']})
+    rows = []
+    for part in parts:
+        try:
+            n, etag = int(part['partNumber']), str(part['ETag'])
+            size = int(part['size']) if part.get('size') is not None else None
+        except (KeyError, TypeError, ValueError):
+            raise toolkit.ValidationError(
+                {'parts': ['Each part needs a partNumber and an ETag']})
+        rows.append((n, etag, size))
+    _save_parts(upload.id, rows)
+
+
+def _choose_part_size(size, requested=None):
+    """
+    The part size of a browser upload of `size` bytes.
+
+    The browser proposes a part size from the throughput it observed. It is
+    kept within the S3 limits and `multipart_max_part_size`, then grown
+    until the file fits in `MAX_PARTS` parts.
+    """
     try:
-        part = model.Session.query(MultipartPart).filter(
-            MultipartPart.n == n,
-            MultipartPart.upload == upload).one()
-    except NoResultFound:
-        part = MultipartPart(n, etag, upload)
-    else:
-        part.etag = etag
-    part.save()
-    return part
+        size = int(size)
+        part_size = int(requested or MIN_PART_SIZE)
+    except (TypeError, ValueError):
+        raise toolkit.ValidationError({'partSize': ['Must be an integer']})
+
+    upper = min(max(config.multipart_max_part_size, MIN_PART_SIZE), MAX_PART_SIZE)
+    part_size = min(max(part_size, MIN_PART_SIZE), upper)
+    while size / part_size > MAX_PARTS and part_size < MAX_PART_SIZE:
+        part_size *= 2
+    return min(part_size, MAX_PART_SIZE)
+
+
+def _can_upload_directly(uploader):
+    return config.multipart_direct_upload and uploader.can_use_advanced_aws
 
 
 def check_multipart(context, data_dict):
     """Check whether unfinished multipart upload already exists.
 
     :param context:
-    :param data_dict: dict with required `id`
-    :returns: None or dict with `upload` - existing multipart upload info
+    :param data_dict: dict with required `id` and optional `reconcile` - if
+        true, the recorded parts are first replaced by the ones listed by the
+        provider, which includes parts uploaded but never reported
+    :returns: None or dict with `upload` - existing multipart upload info,
+        where `parts` is the number of completed parts and `completed_parts`
+        their `partNumber`, `ETag` and `size`
     :rtype: NoneType or dict
 
     """
@@ -82,9 +211,23 @@ def check_multipart(context, data_dict):
             resource_id=id).one()
     except NoResultFound:
         return
+
+    uploader = ResourceCloudStorage({})
+    if toolkit.asbool(data_dict.get('reconcile', False)):
+        try:
+            _reconcile_parts(upload, _list_provider_parts(uploader, upload))
+        except PROVIDER_ERRORS:
+            log.exception("unable to list the parts of multipart upload %s", upload.id)
+
+    parts = model.Session.query(MultipartPart).filter(
+        MultipartPart.upload == upload).order_by(MultipartPart.n).all()
     upload_dict = upload.as_dict()
-    upload_dict['parts'] = model.Session.query(MultipartPart).filter(
-        MultipartPart.upload == upload).count()
+    upload_dict['parts'] = len(parts)
+    upload_dict['completed_parts'] = [
+        {'partNumber': part.n, 'ETag': part.etag, 'size': part.size}
+        for part in parts
+    ]
+    upload_dict['direct'] = _can_upload_directly(uploader)
     return {'upload': upload_dict}
 
 def _guess_mimetype(*names):
@@ -102,6 +245,8 @@ def initiate_multipart(context, data_dict):
         id: resource's id
         name: filename
         size: filesize
+      and optional key:
+        partSize: part size proposed by the client
 
     :returns: MultipartUpload info
     :rtype: dict
@@ -110,16 +255,15 @@ def initiate_multipart(context, data_dict):
 
     h.check_access('cloudstorage_initiate_multipart', data_dict)
     id, name, size = toolkit.get_or_bust(data_dict, ['id', 'name', 'size'])
+    part_size = _choose_part_size(size, data_dict.get('partSize'))
     user_id = None
     if context['auth_user_obj']:
         user_id = context['auth_user_obj'].id
 
-    res_dict = toolkit.get_action('resource_show')(
-        context.copy(), {'id': data_dict.get('id')})
-
-    # Delay handling in archiver
-    res_dict['upload_in_progress'] = True
-    toolkit.get_action('resource_patch')(context.copy(), res_dict)
+    # The upload row marks the resource as being uploaded, see
+    # `helpers.upload_in_progress`.
+    if model.Resource.get(id) is None:
+        raise toolkit.ObjectNotFound('Resource was not found.')
 
     uploader = ResourceCloudStorage({'multipart_name': name})
     res_name = uploader.get_path(id)
@@ -144,10 +288,71 @@ def initiate_multipart(context, data_dict):
         res_name,
         size,
         name,
-        user_id
+        user_id,
+        part_size,
     )
     upload_object.save()
-    return upload_object.as_dict()
+    forget_uploads_in_progress()
+    upload_dict = upload_object.as_dict()
+    # Tell the client to get presigned part URLs instead of sending the
+    # parts through `upload_multipart`
+    upload_dict['direct'] = _can_upload_directly(uploader)
+    return upload_dict
+
+
+def sign_multipart_parts(context, data_dict):
+    """Presign the URLs of a batch of parts of a Multipart Upload.
+
+    The browser uploads each part with a PUT request to its URL, straight to
+    the bucket, and reports the ETag of the response back, either with the
+    next batch or when finishing the upload.
+
+    :param context:
+    :param data_dict: dict with required keys:
+        uploadId: id of the Multipart Upload
+        partNumbers: list of at most `MAX_SIGNED_PARTS` part numbers
+      and optional key:
+        parts: list of `{partNumber, ETag}` of the uploaded parts
+    :returns: dict with `urls` - part number to presigned URL, and
+        `expires_in` - lifetime of the URLs in seconds
+    :rtype: dict
+
+    """
+
+    h.check_access('cloudstorage_sign_multipart_parts', data_dict)
+    upload_id, part_numbers = toolkit.get_or_bust(
+        data_dict,
+        ['uploadId', 'partNumbers']
+    )
+
+    uploader = ResourceCloudStorage({})
+    if not _can_upload_directly(uploader):
+        raise toolkit.ValidationError('Direct multipart uploads are disabled')
+
+    upload = model.Session.query(MultipartUpload).get(upload_id)
+    if upload is None:
+        raise toolkit.ObjectNotFound('Multipart upload not found')
+
+    try:
+        part_numbers = [int(n) for n in part_numbers]
+    except (TypeError, ValueError):
+        raise toolkit.ValidationError({'partNumbers': ['Must be a list of integers']})
+    if not 0 < len(part_numbers) <= MAX_SIGNED_PARTS:
+        raise toolkit.ValidationError(
+            {'partNumbers': [f'Between 1 and {MAX_SIGNED_PARTS} parts can be signed at once']})
+    if not all(1 <= n <= 10000 for n in part_numbers):
+        raise toolkit.ValidationError({'partNumbers': ['Part numbers range from 1 to 10000']})
+
+    if data_dict.get('parts'):
+        _save_reported_parts(upload, data_dict['parts'])
+
+    return {
+        'urls': {
+            n: uploader.presign_upload_part(upload.name, upload_id, n, SIGNED_PART_EXPIRES_IN)
+            for n in part_numbers
+        },
+        'expires_in': SIGNED_PART_EXPIRES_IN,
+    }
 
 
 def upload_multipart(context, data_dict):
@@ -159,8 +364,14 @@ def upload_multipart(context, data_dict):
 
     uploader = ResourceCloudStorage({})
     upload = model.Session.query(MultipartUpload).get(upload_id)
-    data = _get_underlying_file(part_content).read()
-
+    part_file = _get_underlying_file(part_content)
+    length = getattr(part_content, 'content_length', None) or remaining_size(part_file)
+    if length is None:
+        raise toolkit.ValidationError('Unable to determine the size of part %s' % part_number)
+    body = _PartStream(part_file, length)
+
+    # The part is streamed from the spooled request body, only one chunk is
+    # held in memory at a time.
     resp = uploader.driver.connection.request(
         _get_object_url(
             uploader,
@@ -171,16 +382,21 @@ def upload_multipart(context, data_dict):
             'partNumber': part_number
         },
         method='PUT',
-        data=data,
+        data=body,
         headers={
-            'Content-Length': len(data)
+            'Content-Length': length
         }
     )
 
     if resp.status != 200:
         raise toolkit.ValidationError('Upload failed: part %s' % part_number)
 
-    _save_part_info(part_number, resp.headers['etag'], upload)
+    # The ETag of a part is its MD5 unless the bucket uses SSE-KMS
+    provider_md5 = etag_md5(resp.headers['etag'])
+    if provider_md5 is not None and provider_md5 != body.md5:
+        raise toolkit.ValidationError('Upload failed: part %s is corrupted' % part_number)
+
+    _save_parts(upload.id, [(int(part_number), resp.headers['etag'], length)])
 
     return {
         'partNumber': part_number,
@@ -197,6 +413,8 @@ def finish_multipart(context, data_dict):
     :param context:
     :param data_dict: dict with required key `uploadId` - id of Multipart Upload that should be finished
     :param keepDraft: true if dataset should be kept as a draft after the file is uploaded
+    :param parts: optional list of `{partNumber, ETag}` of the parts uploaded
+        straight to the provider since the last report
     :returns: None
     :rtype: NoneType
 
@@ -206,6 +424,8 @@ def finish_multipart(context, data_dict):
     upload_id = toolkit.get_or_bust(data_dict, 'uploadId')
     save_action = data_dict.get('save_action', False)
     upload = model.Session.query(MultipartUpload).get(upload_id)
+    if data_dict.get('parts'):
+        _save_reported_parts(upload, data_dict['parts'])
     chunks = [
         (part.n, part.etag)
         for part in model.Session.query(MultipartPart).filter_by(
@@ -223,11 +443,69 @@ def finish_multipart(context, data_dict):
         chunks=chunks
     )
 
+    size = upload.size
     upload.delete()
     upload.commit()
+    forget_uploads_in_progress()
+
+    finish_kwargs = {
+        'resource_id': data_dict.get('id'),
+        'size': size,
+        'multipart_etag': multipart_md5(etag for _, etag in chunks),
+        'save_action': save_action,
+        'keep_draft': toolkit.asbool(data_dict.get('keepDraft')),
+    }
+    if not _can_finish_in_background():
+        _finish_upload(context, **finish_kwargs)
+        return {'commited': True, 'status': 'done'}
+
+    # The object is stored, the metadata updates can take several seconds on
+    # large datasets and run in the background. The client polls
+    # `multipart_status` for their completion.
+    _set_finish_status(upload_id, 'pending')
+    toolkit.enqueue_job(
+        process_finished_upload,
+        kwargs=dict(finish_kwargs, upload_id=upload_id, user=context.get('user')),
+        title='cloudstorage finish multipart upload {}'.format(upload_id),
+    )
+
+    return {'commited': True, 'status': 'pending'}
+
+
+def _can_finish_in_background():
+    """Whether a CKAN worker listens to the queue of the background jobs."""
+    if not config.multipart_finish_in_background:
+        return False
+    try:
+        return bool(Worker.all(queue=get_queue()))
+    except Exception:
+        log.exception("unable to look for a worker, finishing the upload in the request")
+        return False
+
+
+def process_finished_upload(upload_id, resource_id, user, size, multipart_etag, save_action, keep_draft):
+    """Background job updating the metadata of a resource once its
+    multipart upload has been committed.
+    """
+    context = {'model': model, 'session': model.Session, 'user': user}
+    _set_finish_status(upload_id, 'running')
+    try:
+        _finish_upload(context, resource_id, size, multipart_etag, save_action, keep_draft)
+    except Exception as e:
+        log.exception("unable to update resource %s after multipart upload %s", resource_id, upload_id)
+        _set_finish_status(upload_id, 'error', str(e))
+        raise
+    _set_finish_status(upload_id, 'done')
 
+
+def _finish_upload(context, resource_id, size, multipart_etag, save_action, keep_draft):
+    res_dict = _update_finished_resource(context, resource_id, size, multipart_etag, save_action, keep_draft)
+    _submit_to_datapusher(context, res_dict)
+
+
+def _update_finished_resource(context, resource_id, size, multipart_etag, save_action, keep_draft):
     res_dict = toolkit.get_action('resource_show')(
-        context.copy(), {'id': data_dict.get('id')})
+        context.copy(), {'id': resource_id})
 
     # Change draft state of package to active
     if save_action and save_action == "go-metadata":
@@ -235,7 +513,7 @@ def finish_multipart(context, data_dict):
             pkg_dict = toolkit.get_action('package_show')(
                 context.copy(), {'id': res_dict['package_id']})
 
-            if pkg_dict['state'] == 'draft' and not toolkit.asbool(data_dict.get('keepDraft')):
+            if pkg_dict['state'] == 'draft' and not keep_draft:
                 toolkit.get_action('package_patch')(
                     dict(context.copy(), allow_state_change=True),
                     dict(id=pkg_dict['id'], state='active')
@@ -244,14 +522,24 @@ def finish_multipart(context, data_dict):
         except Exception as e:
             log.error(e)
 
-    # Trigger handling in archiver
-    res_dict.pop('upload_in_progress', None)
+    # The parts were checked against their MD5 when uploaded, the object
+    # checksum is the one S3 reports as ETag of multipart uploads. It is not
+    # an MD5 of the content, so the `md5` of an earlier upload is dropped
+    # rather than replaced.
+    res_dict['size'] = size
+    res_dict['multipart_etag'] = multipart_etag
+    res_dict.pop('md5', None)
+    # Trigger handling in archiver, the upload row is gone so the resource
+    # is no longer in progress.
     toolkit.get_action('resource_update')(context.copy(), res_dict)
+    return res_dict
 
+
+def _submit_to_datapusher(context, res_dict):
     # Submit to datapusher, uses custom config variable which is not triggered automatically in ckan
     if plugin_loaded('datapusher'):
         resource_format = res_dict.get('format')
-        supported_formats = toolkit.config.get('ckanext.cloudstorage.datapusher.formats', '').split()
+        supported_formats = config.datapusher_formats
 
         submit = (
             resource_format
@@ -266,7 +554,44 @@ def finish_multipart(context, data_dict):
                 }
             )
 
-    return {'commited': True}
+
+def _set_finish_status(upload_id, status, error=None):
+    try:
+        connect_to_redis().set(
+            FINISH_STATUS_KEY.format(upload_id),
+            json.dumps({'status': status, 'error': error, 'updated': time.time()}),
+            ex=FINISH_STATUS_TTL,
+        )
+    except Exception:
+        log.exception("unable to store the status of multipart upload %s", upload_id)
+
+
+@toolkit.side_effect_free
+def multipart_status(context, data_dict):
+    """Status of the metadata updates run after a multipart upload is
+    finished.
+
+    :param context:
+    :param data_dict: dict with required keys `id` - resource's id, checked
+        by the auth function, and `uploadId` - id of the finished Multipart
+        Upload
+    :returns: dict with `status` - one of `pending`, `running`, `done` or
+        `error`, and `error` - the error message if the updates failed. An
+        update still pending after `multipart.finish_timeout` seconds, ex:
+        no worker is running, is reported as an error.
+    :rtype: dict
+
+    """
+
+    h.check_access('cloudstorage_multipart_status', data_dict)
+    upload_id = toolkit.get_or_bust(data_dict, 'uploadId')
+    value = connect_to_redis().get(FINISH_STATUS_KEY.format(upload_id))
+    if value is None:
+        raise toolkit.ObjectNotFound('No finished multipart upload {}'.format(upload_id))
+    status = json.loads(value)
+    if status['status'] == 'pending' and time.time() - status.get('updated', 0) > config.multipart_finish_timeout:
+        status = {'status': 'error', 'error': 'No worker has started updating the resource'}
+    return {'status': status['status'], 'error': status['error']}
 
 
 def abort_multipart(context, data_dict):
@@ -291,10 +616,12 @@ def clean_multipart(context, data_dict):
     """Clean old multipart uploads.
 
     :param context:
-    :param data_dict:
+    :param data_dict: dict with optional key `dry_run` - only count the
+        uploads to remove
     :returns: dict with:
         removed - amount of removed uploads.
         total - total amount of expired uploads.
+        orphans - amount of expired uploads unknown to CKAN.
         errors - list of errors raised during deletion. Appears when
         `total` and `removed` are different.
     :rtype: dict
@@ -302,26 +629,4 @@ def clean_multipart(context, data_dict):
     """
 
     h.check_access('cloudstorage_clean_multipart', data_dict)
-    uploader = ResourceCloudStorage({})
-    delta = _get_max_multipart_lifetime()
-    oldest_allowed = datetime.datetime.utcnow() - delta
-
-    uploads_to_remove = model.Session.query(MultipartUpload).filter(
-        MultipartUpload.initiated < oldest_allowed
-    )
-
-    result = {
-        'removed': 0,
-        'total': uploads_to_remove.count(),
-        'errors': []
-    }
-
-    for upload in uploads_to_remove:
-        try:
-            _delete_multipart(upload, uploader)
-        except toolkit.ValidationError as e:
-            result['errors'].append(e.error_summary)
-        else:
-            result['removed'] += 1
-
-    return result
+    return clean_multipart_uploads(dry_run=toolkit.asbool(data_dict.get('dry_run')))
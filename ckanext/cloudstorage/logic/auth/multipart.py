@@ -11,10 +11,18 @@ def upload_multipart(context, data_dict):
     return {'success': check_access('resource_create', context, data_dict)}
 
 
+def sign_multipart_parts(context, data_dict):
+    return {'success': check_access('resource_create', context, data_dict)}
+
+
 def finish_multipart(context, data_dict):
     return {'success': check_access('resource_create', context, data_dict)}
 
 
+def multipart_status(context, data_dict):
+    return {'success': check_access('resource_create', context, data_dict)}
+
+
 def abort_multipart(context, data_dict):
     return {'success': check_access('resource_create', context, data_dict)}
 
@@ -8,8 +8,13 @@ from sqlalchemy import (
     UnicodeText,
     DateTime,
     ForeignKey,
+    BigInteger,
     Integer,
-    Numeric
+    Numeric,
+    exists,
+    PrimaryKeyConstraint,
+    inspect,
+    text,
 )
 from datetime import datetime
 import ckan.model.meta as meta
@@ -23,24 +28,107 @@ def drop_tables():
     metadata.drop_all(model.meta.engine)
 
 
+# Key of the postgres advisory lock held while the tables are upgraded
+SCHEMA_LOCK_KEY = 0x636c6f7564
+
+
 def create_tables():
     metadata.create_all(model.meta.engine)
+    upgrade_tables()
+
+
+def upgrade_tables():
+    """
+    Bring tables created by earlier versions (ex: with `initdb`) to the
+    current schema, keeping their rows.
+
+    Every step checks the current schema first, so the upgrade can run on
+    every startup. Processes starting at the same time wait for each other.
+    """
+    with model.meta.engine.begin() as connection:
+        connection.execute(text('SELECT pg_advisory_xact_lock(:key)'), {'key': SCHEMA_LOCK_KEY})
+        inspector = inspect(connection)
+        _add_missing_columns(connection, inspector)
+        _widen_integer_columns(connection, inspector)
+        _upgrade_part_primary_key(connection, inspector)
+        _add_missing_indexes(connection, inspector)
+
+
+def _add_missing_columns(connection, inspector):
+    # `create_all` only creates missing tables, columns added to existing
+    # tables are nullable and can be added in place.
+    for table in metadata.sorted_tables:
+        existing = {column['name'] for column in inspector.get_columns(table.name)}
+        for column in table.columns:
+            if column.name not in existing:
+                column_type = column.type.compile(dialect=connection.dialect)
+                connection.execute(text(
+                    f'ALTER TABLE {table.name} ADD COLUMN {column.name} {column_type}'
+                ))
+
+
+def _widen_integer_columns(connection, inspector):
+    # Sizes used to be stored in `integer` columns, which overflow above
+    # 2 GiB.
+    for table in metadata.sorted_tables:
+        existing = {column['name']: column['type'] for column in inspector.get_columns(table.name)}
+        for column in table.columns:
+            existing_type = existing.get(column.name)
+            if (
+                isinstance(column.type, BigInteger)
+                and isinstance(existing_type, Integer)
+                and not isinstance(existing_type, BigInteger)
+            ):
+                connection.execute(text(
+                    f'ALTER TABLE {table.name} ALTER COLUMN {column.name} TYPE BIGINT'
+                ))
+
+
+def _upgrade_part_primary_key(connection, inspector):
+    # Parts used to be keyed by `(n, etag, upload_id)`, which neither made
+    # part numbers unique within an upload nor served lookups by upload.
+    table = MultipartPart.__tablename__
+    primary_key = inspector.get_pk_constraint(table)
+    if primary_key['constrained_columns'] == ['upload_id', 'n']:
+        return
+
+    connection.execute(text(
+        f'DELETE FROM {table} a USING {table} b '
+        f'WHERE a.upload_id = b.upload_id AND a.n = b.n AND a.ctid < b.ctid'
+    ))
+    connection.execute(text(f'ALTER TABLE {table} DROP CONSTRAINT {primary_key["name"]}'))
+    connection.execute(text(f'ALTER TABLE {table} ADD PRIMARY KEY (upload_id, n)'))
+
+
+def _add_missing_indexes(connection, inspector):
+    for table in metadata.sorted_tables:
+        existing = {index['name'] for index in inspector.get_indexes(table.name)}
+        for index in table.indexes:
+            if index.name not in existing:
+                index.create(connection)
 
 
 class MultipartPart(Base, DomainObject):
     __tablename__ = 'cloudstorage_multipart_part'
 
-    def __init__(self, n, etag, upload):
+    def __init__(self, n, etag, upload, size=None):
         self.n = n
         self.etag = etag
         self.upload = upload
+        self.size = size
+
+    __table_args__ = (
+        # also serves the lookups of the parts of an upload
+        PrimaryKeyConstraint('upload_id', 'n'),
+    )
 
-    n = Column(Integer, primary_key=True)
-    etag = Column(UnicodeText, primary_key=True)
+    n = Column(Integer)
+    etag = Column(UnicodeText)
     upload_id = Column(
-        UnicodeText, ForeignKey('cloudstorage_multipart_upload.id'),
-        primary_key=True
+        UnicodeText, ForeignKey('cloudstorage_multipart_upload.id')
     )
+    # `None` for parts recorded before their size was
+    size = Column(BigInteger)
     upload = relationship(
         'MultipartUpload',
         backref=backref('parts', cascade='delete, delete-orphan'),
@@ -50,13 +138,14 @@ class MultipartPart(Base, DomainObject):
 class MultipartUpload(Base, DomainObject):
     __tablename__ = 'cloudstorage_multipart_upload'
 
-    def __init__(self, id, resource_id, name, size, original_name, user_id):
+    def __init__(self, id, resource_id, name, size, original_name, user_id, part_size=None):
         self.id = id
         self.resource_id = resource_id
         self.name = name
         self.size = size
         self.original_name = original_name
         self.user_id = user_id
+        self.part_size = part_size
 
     @classmethod
     def resource_uploads(cls, resource_id):
@@ -65,10 +154,28 @@ class MultipartUpload(Base, DomainObject):
         )
         return query
 
+    @classmethod
+    def in_progress(cls, resource_id):
+        """`True` while a multipart upload of the resource is unfinished."""
+        return meta.Session.query(
+            exists().where(cls.resource_id == resource_id)
+        ).scalar()
+
+    @classmethod
+    def resources_in_progress(cls, package_id):
+        """Ids of the resources of the package with an unfinished multipart upload."""
+        query = meta.Session.query(cls.resource_id).join(
+            model.Resource, model.Resource.id == cls.resource_id
+        ).filter(model.Resource.package_id == package_id).distinct()
+        return {resource_id for resource_id, in query}
+
     id = Column(UnicodeText, primary_key=True)
-    resource_id = Column(UnicodeText)
-    name = Column(UnicodeText)
-    initiated = Column(DateTime, default=datetime.utcnow)
+    resource_id = Column(UnicodeText, index=True)
+    name = Column(UnicodeText, index=True)
+    initiated = Column(DateTime, default=datetime.utcnow, index=True)
     size = Column(Numeric)
     original_name = Column(UnicodeText)
     user_id = Column(UnicodeText)
+    # size of every part but the last one, `None` for uploads started
+    # before it was recorded (5MB parts)
+    part_size = Column(BigInteger)
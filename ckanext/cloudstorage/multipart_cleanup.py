@@ -0,0 +1,258 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+import logging
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime
+from typing import Dict, Iterator, List, Optional, Tuple
+
+import ckan.model as model
+from ckan.plugins import toolkit
+from libcloud.storage.base import Container
+from libcloud.storage.drivers.s3 import NAMESPACE, BaseS3StorageDriver
+from libcloud.utils.xml import findall, findtext
+
+from .config import config
+from .distributed_lock import distributed_lock
+from .drivers import registry as driver_registry
+from .helpers import forget_uploads_in_progress
+from .model import MultipartPart, MultipartUpload
+from .storage import ResourceCloudStorage
+
+
+logger = logging.getLogger(__name__)
+
+# Uploads listed per request, the most S3 returns
+LIST_PAGE_SIZE = 1000
+# Upload ids per query of the multipart tables
+BATCH_SIZE = 500
+
+
+class _RateLimiter(object):
+    """Spaces calls shared by several threads to at most `rate` per second."""
+    def __init__(self, rate: float):
+        self._interval = 1.0 / rate if rate > 0 else 0
+        self._lock = threading.Lock()
+        self._next = time.monotonic()
+
+    def wait(self):
+        if not self._interval:
+            return
+        with self._lock:
+            now = time.monotonic()
+            delay = self._next - now
+            self._next = max(self._next, now) + self._interval
+        if delay > 0:
+            time.sleep(delay)
+
+
+def can_list_provider_uploads(storage) -> bool:
+    """`True` if the provider of `storage` lists its multipart uploads (S3)."""
+    return isinstance(storage.driver, BaseS3StorageDriver)
+
+
+def list_provider_uploads(storage) -> Iterator[Tuple[str, str, datetime]]:
+    """
+    The multipart uploads in progress in the container of `storage`, as
+    `(object name, upload id, initiated)`.
+    """
+    path = '/' + storage.container_name
+    params = {'uploads': '', 'max-uploads': LIST_PAGE_SIZE}
+    while True:
+        resp = storage.driver.connection.request(path, params=params)
+        for upload in findall(resp.object, 'Upload', NAMESPACE):
+            yield (
+                findtext(upload, 'Key', NAMESPACE),
+                findtext(upload, 'UploadId', NAMESPACE),
+                # ex: 2010-11-10T20:48:33.000Z
+                datetime.strptime(findtext(upload, 'Initiated', NAMESPACE)[:19], '%Y-%m-%dT%H:%M:%S'),
+            )
+        if findtext(resp.object, 'IsTruncated', NAMESPACE) != 'true':
+            return
+        params['key-marker'] = findtext(resp.object, 'NextKeyMarker', NAMESPACE)
+        params['upload-id-marker'] = findtext(resp.object, 'NextUploadIdMarker', NAMESPACE)
+
+
+def clean_multipart_uploads(storage=None, dry_run: bool = False) -> dict:
+    """
+    Abort the multipart uploads older than `max_multipart_lifetime` and
+    remove their records.
+
+    On S3, the uploads in progress are listed from the provider and
+    compared with `cloudstorage_multipart_upload`, which finds:
+
+    - expired uploads, aborted and removed from the table;
+    - orphans, uploads of the provider without a record (ex: the record was
+      lost by an earlier failure), aborted;
+    - stale records, of uploads the provider no longer has, removed.
+
+    Other providers cannot list their uploads, only the expired records are
+    aborted and removed.
+
+    Aborts run in parallel, limited by `multipart_cleanup_concurrency` and
+    `multipart_cleanup_rate`.
+
+    :returns: dict with:
+        removed - amount of removed uploads.
+        total - total amount of expired uploads.
+        orphans - amount of expired uploads found only on the provider.
+        errors - list of errors raised during deletion.
+    """
+    storage = storage or ResourceCloudStorage({})
+    oldest_allowed = datetime.utcnow() - config.max_multipart_lifetime
+
+    recorded = dict(
+        model.Session.query(MultipartUpload.id, MultipartUpload.name)
+        .filter(MultipartUpload.initiated < oldest_allowed)
+    )
+    provider = known_ids = None
+    if can_list_provider_uploads(storage):
+        # Only the uploads older than the lifetime are considered, younger
+        # ones may not be recorded yet.
+        provider = {
+            upload_id: name
+            for name, upload_id, initiated in list_provider_uploads(storage)
+            if initiated < oldest_allowed
+        }
+        known_ids = _recorded_ids(list(provider))
+    to_abort, orphans = _plan_aborts(recorded, provider, known_ids)
+
+    result = {
+        'removed': 0,
+        'total': len(recorded) + len(orphans),
+        'orphans': len(orphans),
+        'errors': [],
+    }
+    logger.info(
+        "cleaning %i expired multipart uploads: %i recorded, %i orphans, %i already gone",
+        result['total'], len(recorded), len(orphans), len(_removable_records(recorded, provider, set())),
+    )
+    if dry_run:
+        return result
+
+    aborted, result['errors'] = _abort_uploads(storage, to_abort)
+    removable = _removable_records(recorded, provider, aborted)
+    _delete_records(removable)
+    result['removed'] = len(removable) + len(aborted & set(orphans))
+    return result
+
+
+def _plan_aborts(
+    recorded: Dict[str, str],
+    provider: Optional[Dict[str, str]],
+    known_ids: Optional[set],
+) -> Tuple[Dict[str, str], Dict[str, str]]:
+    """
+    The expired uploads to abort and the orphans among them, as
+    `{upload id: object name}`, from the expired `recorded` uploads, the
+    expired `provider` uploads (`None` if they cannot be listed) and the ids
+    of the provider uploads with a record.
+    """
+    if provider is None:
+        return dict(recorded), {}
+    orphans = {upload_id: name for upload_id, name in provider.items() if upload_id not in known_ids}
+    to_abort = dict(orphans)
+    to_abort.update((upload_id, name) for upload_id, name in recorded.items() if upload_id in provider)
+    return to_abort, orphans
+
+
+def _removable_records(recorded: Dict[str, str], provider: Optional[Dict[str, str]], aborted: set) -> List[str]:
+    # the records of uploads the provider no longer has are stale
+    return [
+        upload_id for upload_id in recorded
+        if upload_id in aborted or (provider is not None and upload_id not in provider)
+    ]
+
+
+def _recorded_ids(upload_ids: List[str]) -> set:
+    recorded = set()
+    for start in range(0, len(upload_ids), BATCH_SIZE):
+        batch = upload_ids[start:start + BATCH_SIZE]
+        recorded.update(
+            upload_id for upload_id, in
+            model.Session.query(MultipartUpload.id).filter(MultipartUpload.id.in_(batch))
+        )
+    return recorded
+
+
+def _abort_uploads(storage, uploads: Dict[str, str]) -> Tuple[set, List[str]]:
+    aborted = set()
+    errors = []
+    if not uploads:
+        return aborted, errors
+
+    limiter = _RateLimiter(config.multipart_cleanup_rate)
+    concurrency = max(config.multipart_cleanup_concurrency, 1)
+    with ThreadPoolExecutor(max_workers=concurrency, thread_name_prefix='cloudstorage-cleanup') as executor:
+        futures = {
+            executor.submit(
+                _abort_upload,
+                limiter,
+                storage.driver_name,
+                dict(storage.driver_options),
+                storage.credentials_generation,
+                storage.container_name,
+                name,
+                upload_id,
+            ): upload_id
+            for upload_id, name in uploads.items()
+        }
+        for future, upload_id in futures.items():
+            error = future.exception()
+            if error is None:
+                aborted.add(upload_id)
+            else:
+                logger.warning("unable to abort multipart upload %s: %s", upload_id, error)
+                errors.append(f'{upload_id}: {error}')
+    return aborted, errors
+
+
+def _abort_upload(limiter, driver_name, driver_options, generation, container_name, name, upload_id):
+    # libcloud connections are not thread-safe, every worker thread uses its
+    # own pooled driver.
+    driver = driver_registry.get(driver_name, driver_options, generation)
+    container = Container(name=container_name, extra=None, driver=driver)
+    limiter.wait()
+    resp = driver.connection.request(
+        driver._get_object_path(container, name),
+        params={'uploadId': upload_id},
+        method='DELETE',
+    )
+    # 404: the upload was aborted or completed in the meantime
+    if resp.status not in (204, 404):
+        raise IOError(f'unexpected status {resp.status}')
+
+
+def _delete_records(upload_ids: List[str]):
+    for start in range(0, len(upload_ids), BATCH_SIZE):
+        batch = upload_ids[start:start + BATCH_SIZE]
+        model.Session.query(MultipartPart).filter(
+            MultipartPart.upload_id.in_(batch)
+        ).delete(synchronize_session=False)
+        model.Session.query(MultipartUpload).filter(
+            MultipartUpload.id.in_(batch)
+        ).delete(synchronize_session=False)
+        model.Session.commit()
+    forget_uploads_in_progress()
+
+
+def schedule_clean_multipart_job() -> Optional[str]:
+    """
+    Enqueue `clean_multipart_job`, unless one is queued already. Meant to be
+    run periodically, ex: from cron with `ckan cloudstorage clean-multipart --enqueue`.
+    """
+    with distributed_lock('clean-multipart-job'):
+        jobs = toolkit.get_action("job_list")({"ignore_auth": True, "model": model}, {})
+        if any(job['title'] == clean_multipart_job.__name__ for job in jobs):
+            logger.info("a multipart cleanup job is already queued")
+            return None
+        return toolkit.enqueue_job(clean_multipart_job, title=clean_multipart_job.__name__).id
+
+
+def clean_multipart_job():
+    result = clean_multipart_uploads()
+    logger.info(
+        "removed %i of %i expired multipart uploads, %i errors",
+        result['removed'], result['total'], len(result['errors']),
+    )
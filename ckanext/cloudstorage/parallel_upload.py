@@ -0,0 +1,174 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+import logging
+import os
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from typing import List, Optional, Tuple
+
+from libcloud.storage.base import Container
+
+from .checksum import content_md5
+from .config import config
+from .drivers import registry as driver_registry
+
+
+logger = logging.getLogger(__name__)
+
+# S3 limits, see https://docs.aws.amazon.com/AmazonS3/latest/userguide/qfacts.html
+MIN_PART_SIZE = 5 * 1024 * 1024
+MAX_PART_SIZE = 5 * 1024 * 1024 * 1024
+MAX_PARTS = 10000
+
+
+def remaining_size(fileobj) -> Optional[int]:
+    """Number of bytes left to read in a seekable file, `None` otherwise."""
+    try:
+        # SpooledTemporaryFile only has `seekable` since python 3.11
+        if hasattr(fileobj, 'seekable') and not fileobj.seekable():
+            return None
+        position = fileobj.tell()
+        end = fileobj.seek(0, os.SEEK_END)
+        fileobj.seek(position)
+        return end - position
+    except (AttributeError, OSError, ValueError):
+        return None
+
+
+def part_size_for(size: int) -> int:
+    """The configured part size, grown until `size` fits in `MAX_PARTS`."""
+    part_size = max(config.upload_part_size, MIN_PART_SIZE)
+    while size / part_size > MAX_PARTS:
+        part_size *= 2
+    return part_size
+
+
+def can_upload_in_parts(storage, fileobj) -> bool:
+    """
+    `True` if the driver supports multipart uploads and the file is
+    seekable and larger than a single part.
+    """
+    if 'S3' not in storage.driver_name:
+        return False
+    size = remaining_size(fileobj)
+    return size is not None and size > config.upload_part_size
+
+
+def upload_in_parts(
+    storage,
+    fileobj,
+    object_name: str,
+    headers: Optional[dict] = None,
+    size: Optional[int] = None,
+) -> str:
+    """
+    Upload a file as an S3 multipart upload, sending up to
+    `upload_concurrency` parts at once.
+
+    Parts are read sequentially from `fileobj`, so at most
+    `upload_concurrency + 1` parts are held in memory. Failed parts are
+    retried individually, and the upload is aborted if a part still fails.
+
+    :param storage: The `CloudStorage` instance to upload with.
+    :param fileobj: A binary file, seekable unless `size` is given.
+    :param object_name: The destination object name.
+    :param headers: Extra headers for the upload, ex: Content-Type.
+    :param size: Number of bytes to upload, defaults to the rest of the file.
+
+    :returns: The ETag of the committed object.
+    """
+    if size is None:
+        size = remaining_size(fileobj)
+    part_size = part_size_for(size)
+    container = storage.container
+    upload_id = storage.driver._initiate_multipart(
+        container=container,
+        object_name=object_name,
+        headers=headers,
+    )
+    logger.debug("uploading %s in parts of %i bytes, upload id %s", object_name, part_size, upload_id)
+
+    try:
+        chunks = _upload_parts(storage, fileobj, object_name, upload_id, part_size)
+        return storage.driver._commit_multipart(
+            container=container,
+            object_name=object_name,
+            upload_id=upload_id,
+            chunks=chunks,
+        )
+    except BaseException:
+        logger.exception("aborting multipart upload %s of %s", upload_id, object_name)
+        try:
+            storage.driver._abort_multipart(container, object_name, upload_id)
+        except Exception:
+            logger.exception("unable to abort multipart upload %s", upload_id)
+        raise
+
+
+def _upload_parts(storage, fileobj, object_name: str, upload_id: str, part_size: int) -> List[Tuple[int, str]]:
+    concurrency = max(config.upload_concurrency, 1)
+    slots = threading.BoundedSemaphore(concurrency)
+    futures = []
+
+    def release_slot(_future):
+        slots.release()
+
+    with ThreadPoolExecutor(max_workers=concurrency, thread_name_prefix='cloudstorage-upload') as executor:
+        part_number = 1
+        while True:
+            slots.acquire()
+            if any(f.done() and f.exception() is not None for f in futures):
+                slots.release()
+                break
+
+            data = fileobj.read(part_size)
+            if not data:
+                slots.release()
+                break
+
+            future = executor.submit(
+                _upload_part,
+                storage.driver_name,
+                dict(storage.driver_options),
+                storage.credentials_generation,
+                storage.container_name,
+                object_name,
+                upload_id,
+                part_number,
+                data,
+            )
+            future.add_done_callback(release_slot)
+            futures.append(future)
+            part_number += 1
+
+    return [future.result() for future in futures]
+
+
+def _upload_part(driver_name, driver_options, generation, container_name, object_name, upload_id, part_number, data):
+    # libcloud connections are not thread-safe, every worker thread uses its
+    # own pooled driver.
+    driver = driver_registry.get(driver_name, driver_options, generation)
+    container = Container(name=container_name, extra=None, driver=driver)
+    path = driver._get_object_path(container, object_name)
+
+    attempt = 0
+    while True:
+        try:
+            response = driver.connection.request(
+                path,
+                params={'uploadId': upload_id, 'partNumber': part_number},
+                method='PUT',
+                data=data,
+                headers={'Content-Length': len(data), 'Content-MD5': content_md5(data)},
+            )
+            if response.status != 200:
+                raise IOError(f'unexpected status {response.status}')
+            return part_number, response.headers['etag']
+        except Exception:
+            if attempt >= config.upload_part_retries:
+                raise
+            attempt += 1
+            logger.warning("retrying part %i of upload %s", part_number, upload_id, exc_info=True)
+            time.sleep(2 ** attempt * 0.5)
+
@@ -1,12 +1,14 @@
 #!/usr/bin/env python
 # -*- coding: utf-8 -*-
 from ckan import plugins
+from libcloud.storage.types import ContainerDoesNotExistError
 from ckanext.cloudstorage import storage
 from ckanext.cloudstorage import helpers
 import ckanext.cloudstorage.logic.action.presigned_url as presigned_url_action
 import ckanext.cloudstorage.logic.action.multipart as m_action
 import ckanext.cloudstorage.logic.action.get as get_actions
 import ckanext.cloudstorage.logic.auth.multipart as m_auth
+import ckanext.cloudstorage.logic.auth.get as get_auth
 
 if plugins.toolkit.check_ckan_version(min_version='2.9.0'):
     from ckanext.cloudstorage.plugin.flask_plugin import MixinPlugin
@@ -16,6 +18,8 @@ else:
 from ..resource_object_key import ResourceObjectKey
 from ..storage import STORAGE_PATH_FIELD_NAME
 from .. import model
+from ..config import config as cloudstorage_config
+from ..url_cache import presigned_urls
 from ..validators import (
     valid_resource_name,
     default_cloud_storage_key_package_segment,
@@ -50,6 +54,7 @@ class CloudStoragePlugin(MixinPlugin, plugins.SingletonPlugin, plugins.toolkit.D
             is_stream_resource=helpers.is_stream_resource,
             get_package_cloud_storage_key=helpers.get_package_cloud_storage_key,
             can_generate_presigned_url=helpers.can_generate_presigned_url,
+            cloudstorage_upload_in_progress=helpers.upload_in_progress,
         )
 
     def configure(self, config):
@@ -67,8 +72,19 @@ class CloudStoragePlugin(MixinPlugin, plugins.SingletonPlugin, plugins.toolkit.D
                     )
                 )
 
+        cloudstorage_config.reload(config)
         model.create_tables()
 
+        if cloudstorage_config.local_container:
+            try:
+                storage.validate_container()
+            except ContainerDoesNotExistError:
+                raise RuntimeError(
+                    'Container {0} does not exist.'.format(
+                        cloudstorage_config.container_name
+                    )
+                )
+
     def get_resource_uploader(self, data_dict):
         # We provide a custom Resource uploader.
         return storage.ResourceCloudStorage(data_dict)
@@ -84,12 +100,15 @@ class CloudStoragePlugin(MixinPlugin, plugins.SingletonPlugin, plugins.toolkit.D
         return {
             'cloudstorage_initiate_multipart': m_action.initiate_multipart,
             'cloudstorage_upload_multipart': m_action.upload_multipart,
+            'cloudstorage_sign_multipart_parts': m_action.sign_multipart_parts,
             'cloudstorage_finish_multipart': m_action.finish_multipart,
+            'cloudstorage_multipart_status': m_action.multipart_status,
             'cloudstorage_abort_multipart': m_action.abort_multipart,
             'cloudstorage_check_multipart': m_action.check_multipart,
             'cloudstorage_clean_multipart': m_action.clean_multipart,
             'resource_create_presigned_url': presigned_url_action.create_presigned_url,
             'cloudstorage_package_show': get_actions.cloudstorage_package_show,
+            'cloudstorage_stats': get_actions.cloudstorage_stats,
         }
 
     # IAuthFunctions
@@ -98,10 +117,13 @@ class CloudStoragePlugin(MixinPlugin, plugins.SingletonPlugin, plugins.toolkit.D
         return {
             'cloudstorage_initiate_multipart': m_auth.initiate_multipart,
             'cloudstorage_upload_multipart': m_auth.upload_multipart,
+            'cloudstorage_sign_multipart_parts': m_auth.sign_multipart_parts,
             'cloudstorage_finish_multipart': m_auth.finish_multipart,
+            'cloudstorage_multipart_status': m_auth.multipart_status,
             'cloudstorage_abort_multipart': m_auth.abort_multipart,
             'cloudstorage_check_multipart': m_auth.check_multipart,
             'cloudstorage_clean_multipart': m_auth.clean_multipart,
+            'cloudstorage_stats': get_auth.cloudstorage_stats,
         }
 
     # IResourceController
@@ -114,21 +136,43 @@ class CloudStoragePlugin(MixinPlugin, plugins.SingletonPlugin, plugins.toolkit.D
         return ResourceObjectKey.from_resource(package, resource).raw
 
     def before_create(self, context, resource):
+        resource.pop(helpers.UPLOAD_IN_PROGRESS_FIELD_NAME, None)
         if resource.get('url_type') == 'upload' and resource.get(STORAGE_PATH_FIELD_NAME) is None:
             resource[STORAGE_PATH_FIELD_NAME] = self._get_storage_path(context, resource)
 
     def before_update(self, context, current, resource):
+        # the flag is read from the multipart uploads, never stored
+        resource.pop(helpers.UPLOAD_IN_PROGRESS_FIELD_NAME, None)
         if STORAGE_PATH_FIELD_NAME not in resource and STORAGE_PATH_FIELD_NAME in current:
             resource[STORAGE_PATH_FIELD_NAME] = current[STORAGE_PATH_FIELD_NAME]
         elif resource.get('upload') and resource.get('url_type') == 'upload' or resource.get('multipart_name'):
             # new upload initiated, use the current resource as the updated resource object might be missing some fields
             resource[STORAGE_PATH_FIELD_NAME] = self._get_storage_path(context, current)
 
+        current_path = current.get(STORAGE_PATH_FIELD_NAME)
+        if current_path and resource.get(STORAGE_PATH_FIELD_NAME) != current_path:
+            presigned_urls.invalidate(current_path)
+        storage.forget_storage_path(current['id'])
+
+    def after_update(self, context, resource):
+        storage.forget_storage_path(resource['id'])
+
+    def before_show(self, resource):
+        # Delay handling in archiver
+        if helpers.upload_in_progress(resource):
+            resource[helpers.UPLOAD_IN_PROGRESS_FIELD_NAME] = True
+        else:
+            resource.pop(helpers.UPLOAD_IN_PROGRESS_FIELD_NAME, None)
+        return resource
+
     def before_delete(self, context, id_dict, resources):
         # let's get all info about our resource. It somewhere in resources
         # but if there is some possibility that it isn't(magic?) we skip
         resource = next((r for r in resources if r['id'] == id_dict['id']), None)
+        storage.forget_storage_path(id_dict['id'])
         if resource is not None and resource['url_type'] == 'upload':
+            if resource.get(STORAGE_PATH_FIELD_NAME):
+                presigned_urls.invalidate(resource[STORAGE_PATH_FIELD_NAME])
             resource = dict(resource, clear_upload=True)
             uploader = self.get_resource_uploader(resource)
             uploader.upload(resource['id'])
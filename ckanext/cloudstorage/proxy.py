@@ -0,0 +1,77 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+from typing import Iterator, Tuple
+
+
+PROXY_REQUEST_HEADERS = (
+    'Range',
+    'If-Range',
+    'If-Match',
+    'If-None-Match',
+    'If-Modified-Since',
+    'If-Unmodified-Since',
+)
+PROXY_RESPONSE_HEADERS = (
+    'Accept-Ranges',
+    'Cache-Control',
+    'Content-Disposition',
+    'Content-Encoding',
+    'Content-Length',
+    'Content-Range',
+    'Content-Type',
+    'ETag',
+    'Last-Modified',
+)
+
+
+class ProviderStream(object):
+    """
+    Iterator over the body of a streamed `requests` response, exactly as
+    the provider sent it: an object stored with a `Content-Encoding` is not
+    decoded, so the body still matches the forwarded `Content-Encoding` and
+    `Content-Length`. Closing it releases the provider connection, even if
+    the body was not consumed.
+    """
+    def __init__(self, response, chunk_size: int):
+        self._response = response
+        self._chunks = response.raw.stream(chunk_size, decode_content=False)
+
+    def __iter__(self):
+        return self
+
+    def __next__(self) -> bytes:
+        return next(self._chunks)
+
+    def close(self):
+        self._response.close()
+
+
+def request_object(driver, container, name: str, request_headers, chunk_size: int) -> Tuple[int, dict, Iterator[bytes]]:
+    """
+    GET an object with the range and conditional headers of the client
+    request.
+
+    :returns: the provider's status code, the response headers to forward
+        and an iterator over the body in `chunk_size` chunks.
+    """
+    headers = {
+        name: request_headers[name]
+        for name in PROXY_REQUEST_HEADERS
+        if request_headers.get(name)
+    }
+    driver.connection.request(
+        driver._get_object_path(container, name),
+        method='GET',
+        headers=headers,
+        stream=True,
+        raw=True,
+    )
+    # libcloud's raw response only copies a few attributes of the `requests`
+    # response, which the connection keeps until its next request
+    response = driver.connection.connection.getresponse()
+    response_headers = {
+        name: response.headers[name]
+        for name in PROXY_RESPONSE_HEADERS
+        if name in response.headers
+    }
+    return response.status_code, response_headers, ProviderStream(response, chunk_size)
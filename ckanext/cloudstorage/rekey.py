@@ -0,0 +1,284 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+"""
+Move the objects of uploaded resources to the latest key format with
+server-side copies, ex: from `<org>/<package>/<name>` (version 0) to
+`1/<org>/<package>/<name>` (version 1).
+"""
+import logging
+import os
+import time
+from concurrent.futures import ThreadPoolExecutor
+from dataclasses import dataclass, field
+from typing import Callable, List, Optional, Tuple
+
+import ckan.model as model
+from libcloud.common.types import LibcloudError
+from libcloud.storage.base import Container
+from libcloud.storage.types import ObjectDoesNotExistError
+from libcloud.utils.xml import findtext
+from libcloud.storage.drivers.s3 import NAMESPACE
+
+from .drivers import registry as driver_registry
+from .parallel_upload import MAX_PART_SIZE, MAX_PARTS
+from .resource_object_key import ResourceObjectKey, ResourceObjectKeyType, upgrade_key
+from .storage import STORAGE_PATH_FIELD_NAME, CloudStorage
+from .url_cache import presigned_urls
+
+
+logger = logging.getLogger(__name__)
+
+# Objects up to this size are copied with a single CopyObject request, the
+# most S3 allows
+COPY_OBJECT_LIMIT = MAX_PART_SIZE
+# Initial size of the parts of larger objects, copied with UploadPartCopy
+COPY_PART_SIZE = 512 * 1024 * 1024
+
+
+@dataclass
+class RekeyStats:
+    resources: int = 0
+    moved: int = 0
+    skipped: int = 0
+    bytes: int = 0
+    errors: List[str] = field(default_factory=list)
+    started: float = field(default_factory=time.monotonic)
+
+    @property
+    def elapsed(self) -> float:
+        return time.monotonic() - self.started
+
+    @property
+    def throughput(self) -> float:
+        """Bytes copied per second."""
+        return self.bytes / max(self.elapsed, 1e-6)
+
+    def __str__(self):
+        return (
+            f'{self.moved} moved, {self.skipped} skipped, {len(self.errors)} errors '
+            f'of {self.resources} resources; {self.bytes / 1024 ** 2:.1f} MiB in {self.elapsed:.0f}s '
+            f'({self.throughput / 1024 ** 2:.1f} MiB/s, {self.moved / max(self.elapsed, 1e-6):.1f} objects/s)'
+        )
+
+
+class Checkpoint(object):
+    """The id of the last resource handled, kept in a file between runs."""
+    def __init__(self, path: Optional[str]):
+        self.path = path
+
+    def load(self) -> Optional[str]:
+        if not self.path or not os.path.exists(self.path):
+            return None
+        with open(self.path) as f:
+            return f.read().strip() or None
+
+    def save(self, resource_id: str):
+        if not self.path:
+            return
+        tmp_path = self.path + '.tmp'
+        with open(tmp_path, 'w') as f:
+            f.write(resource_id)
+        os.replace(tmp_path, self.path)
+
+
+def rekey_resources(
+    checkpoint: Checkpoint,
+    batch_size: int = 100,
+    concurrency: int = 8,
+    delete_source: bool = True,
+    dry_run: bool = False,
+    on_batch: Optional[Callable[[RekeyStats], None]] = None,
+) -> RekeyStats:
+    """
+    Copy the objects of uploaded resources with keys in an older format to
+    their key in the latest format, then update `cloud_storage_key`.
+
+    Resources are handled by id, in batches. The objects of a batch are
+    copied in parallel, then the keys of the batch are updated in one
+    commit, the checkpoint is saved and the source objects are deleted.
+    A run resumes after the last resource of the checkpoint.
+    """
+    stats = RekeyStats()
+    last_id = checkpoint.load()
+    if last_id:
+        logger.info("resuming after resource %s", last_id)
+
+    with ThreadPoolExecutor(max_workers=concurrency, thread_name_prefix='cloudstorage-rekey') as objects, \
+            ThreadPoolExecutor(max_workers=concurrency, thread_name_prefix='cloudstorage-rekey-part') as parts:
+        while True:
+            batch = _next_batch(last_id, batch_size)
+            if not batch:
+                break
+            last_id = batch[-1].id
+            stats.resources += len(batch)
+
+            moves = []
+            for resource in batch:
+                move = _planned_move(resource)
+                if move is None:
+                    stats.skipped += 1
+                else:
+                    moves.append(move)
+
+            if dry_run:
+                stats.moved += len(moves)
+            elif moves:
+                # credentials are resolved again for every batch, long runs
+                # would outlive them otherwise
+                storage = CloudStorage()
+                futures = [
+                    (move, objects.submit(_copy_object, storage, parts, move[1], move[2]))
+                    for move in moves
+                ]
+                copied = []
+                for (resource, source, target), future in futures:
+                    try:
+                        stats.bytes += future.result()
+                    except Exception as e:
+                        logger.exception("unable to copy %s to %s", source, target)
+                        stats.errors.append(f'{resource.id}: {e}')
+                    else:
+                        copied.append((resource, source, target))
+
+                _update_keys(copied)
+                checkpoint.save(last_id)
+                stats.moved += len(copied)
+                if delete_source:
+                    _delete_objects(storage, objects, [source for _, source, _ in copied])
+            else:
+                checkpoint.save(last_id)
+
+            if on_batch is not None:
+                on_batch(stats)
+
+    return stats
+
+
+def _next_batch(last_id: Optional[str], batch_size: int) -> List[model.Resource]:
+    query = model.Session.query(model.Resource).filter(
+        model.Resource.state == 'active',
+        model.Resource.url_type == 'upload',
+    )
+    if last_id:
+        query = query.filter(model.Resource.id > last_id)
+    return query.order_by(model.Resource.id).limit(batch_size).all()
+
+
+def _planned_move(resource) -> Optional[Tuple[model.Resource, str, str]]:
+    source = (resource.extras or {}).get(STORAGE_PATH_FIELD_NAME)
+    if not source:
+        return None
+    try:
+        key = ResourceObjectKey.from_raw_key(source)
+    except ValueError:
+        logger.warning("resource %s has an unsupported key %s", resource.id, source)
+        return None
+    # the objects of streams are written by the producer, only single
+    # uploaded objects are moved
+    if key.type != ResourceObjectKeyType.UPLOAD:
+        return None
+    target = upgrade_key(key)
+    if target.raw == key.raw:
+        return None
+    return resource, key.raw, target.raw
+
+
+def _thread_container(storage):
+    # libcloud connections are not thread-safe, every worker thread uses its
+    # own pooled driver.
+    driver = driver_registry.get(storage.driver_name, dict(storage.driver_options), storage.credentials_generation)
+    return Container(name=storage.container_name, extra=None, driver=driver)
+
+
+def _copy_object(storage, parts: ThreadPoolExecutor, source: str, target: str) -> int:
+    """Copy `source` to `target` in the bucket, returns the bytes copied."""
+    container = _thread_container(storage)
+    driver = container.driver
+    try:
+        obj = driver.get_object(container.name, source)
+    except ObjectDoesNotExistError:
+        # copied by an interrupted run, before its keys were updated
+        driver.get_object(container.name, target)
+        return 0
+
+    copy_source = driver._get_object_path(container, source)
+    if obj.size <= COPY_OBJECT_LIMIT:
+        resp = driver.connection.request(
+            driver._get_object_path(container, target),
+            method='PUT',
+            headers={'x-amz-copy-source': copy_source},
+        )
+        _check_copy_result(resp, 'CopyObjectResult')
+    else:
+        _copy_in_parts(storage, parts, container, copy_source, target, obj)
+    return obj.size
+
+
+def _copy_in_parts(storage, parts: ThreadPoolExecutor, container, copy_source: str, target: str, obj):
+    part_size = COPY_PART_SIZE
+    while obj.size / part_size > MAX_PARTS:
+        part_size *= 2
+    part_size = min(part_size, MAX_PART_SIZE)
+
+    driver = container.driver
+    headers = {'Content-Type': obj.extra['content_type']} if obj.extra.get('content_type') else None
+    upload_id = driver._initiate_multipart(container=container, object_name=target, headers=headers)
+    try:
+        futures = [
+            parts.submit(
+                _copy_part, storage, copy_source, target, upload_id,
+                n, start, min(start + part_size, obj.size) - 1,
+            )
+            for n, start in enumerate(range(0, obj.size, part_size), start=1)
+        ]
+        chunks = [future.result() for future in futures]
+        driver._commit_multipart(container=container, object_name=target, upload_id=upload_id, chunks=chunks)
+    except BaseException:
+        try:
+            driver._abort_multipart(container, target, upload_id)
+        except Exception:
+            logger.exception("unable to abort multipart copy %s", upload_id)
+        raise
+
+
+def _copy_part(storage, copy_source: str, target: str, upload_id: str, n: int, first: int, last: int):
+    container = _thread_container(storage)
+    driver = container.driver
+    resp = driver.connection.request(
+        driver._get_object_path(container, target),
+        params={'uploadId': upload_id, 'partNumber': n},
+        method='PUT',
+        headers={
+            'x-amz-copy-source': copy_source,
+            'x-amz-copy-source-range': f'bytes={first}-{last}',
+        },
+    )
+    _check_copy_result(resp, 'CopyPartResult')
+    return n, findtext(resp.object, 'ETag', NAMESPACE)
+
+
+def _check_copy_result(resp, tag: str):
+    # S3 may report a failed copy in the body of a 200 response
+    if resp.status != 200 or not resp.object.tag.endswith(tag):
+        raise LibcloudError(f'copy failed with status {resp.status}: {resp.body}')
+
+
+def _update_keys(copied: List[Tuple[model.Resource, str, str]]):
+    if not copied:
+        return
+    for resource, _, target in copied:
+        resource.extras = dict(resource.extras or {}, **{STORAGE_PATH_FIELD_NAME: target})
+    model.repo.commit()
+    for _, source, _ in copied:
+        presigned_urls.invalidate(source)
+
+
+def _delete_objects(storage, executor: ThreadPoolExecutor, names: List[str]):
+    def delete(name):
+        container = _thread_container(storage)
+        resp = container.driver.connection.request(
+            container.driver._get_object_path(container, name), method='DELETE')
+        if resp.status not in (204, 404):
+            logger.warning("unable to delete %s, status %s", name, resp.status)
+
+    list(executor.map(delete, names))
@@ -129,7 +129,8 @@ class _ResourceObjectKeyV1(ResourceObjectKey):
     @classmethod
     def try_parse(cls, key):
         version, _, path = key.partition('/')
-        if int(version) == cls.version:
+        # version 0 keys start with the organization name
+        if version.isdigit() and int(version) == cls.version:
             return _parse_from_path_v0_v1(cls, path, key)
         return None
 
@@ -138,6 +139,18 @@ class _ResourceObjectKeyV1(ResourceObjectKey):
         return _create_from_resource_v0_v1(cls, str(cls.version), package, resource)
 
 
+def upgrade_key(key: ResourceObjectKey) -> ResourceObjectKey:
+    """
+    The key in the latest format for the same object path, `key` itself if it
+    is already in that format.
+    """
+    latest = ResourceObjectKey._factories()[0]
+    if key.version == latest.version:
+        return key
+    path = key.raw if key.version == 0 else key.raw.partition('/')[2]
+    return latest.try_parse(f'{latest.version}/{path}')
+
+
 def _parse_from_path_v0_v1(cls: Type[ResourceObjectKey], path: str, key: str) -> ResourceObjectKey:
     try:
         organization_name, package_segment, *resource_path = path.split("/")
@@ -0,0 +1,178 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+"""
+Dependency-free AWS signature version 4 query string signing for S3
+`GetObject` and `UploadPart` URLs.
+
+The URLs are byte-identical to the ones returned by boto3's
+`generate_presigned_url('get_object', ...)` and
+`generate_presigned_url('upload_part', ...)` for a client using the `s3v4`
+signature version (the default for every region but `us-east-1`), including
+the addressing style botocore picks for the bucket.
+"""
+import hashlib
+import hmac
+import re
+from datetime import datetime
+from typing import List, Optional, Tuple
+from urllib.parse import quote
+
+
+ALGORITHM = 'AWS4-HMAC-SHA256'
+UNSIGNED_PAYLOAD = 'UNSIGNED-PAYLOAD'
+DEFAULT_REGION = 'us-east-1'
+
+_SAFE_CHARS = '-._~'
+_LABEL_RE = re.compile(r'[a-z0-9][a-z0-9\-]*[a-z0-9]')
+
+
+def _percent_encode(value) -> str:
+    return quote(str(value).encode('utf-8'), safe=_SAFE_CHARS)
+
+
+def _encode_query(params) -> str:
+    return '&'.join(
+        f'{_percent_encode(key)}={_percent_encode(value)}'
+        for key, value in params
+    )
+
+
+def _is_virtual_host_bucket(bucket: str) -> bool:
+    # Same rules as botocore's `check_dns_name`: buckets with dots would break
+    # TLS certificate validation with virtual hosted addressing.
+    if '.' in bucket or not 3 <= len(bucket) <= 63:
+        return False
+    match = _LABEL_RE.match(bucket)
+    return match is not None and match.end() == len(bucket)
+
+
+def _hmac(key: bytes, msg: str) -> bytes:
+    return hmac.new(key, msg.encode('utf-8'), hashlib.sha256).digest()
+
+
+def _signing_key(secret_key: str, date_stamp: str, region: str) -> bytes:
+    k_date = _hmac(('AWS4' + secret_key).encode('utf-8'), date_stamp)
+    k_region = _hmac(k_date, region)
+    k_service = _hmac(k_region, 's3')
+    return _hmac(k_service, 'aws4_request')
+
+
+def presign_get_object(
+    bucket: str,
+    key: str,
+    access_key: str,
+    secret_key: str,
+    token: Optional[str] = None,
+    region: Optional[str] = None,
+    expires_in: int = 3600,
+    content_type: Optional[str] = None,
+    now: Optional[datetime] = None,
+) -> str:
+    """
+    Return a presigned URL to download `key` from `bucket`.
+
+    :param token: Optional session token for temporary (STS) credentials.
+    :param content_type: Optional value for the `response-content-type`
+        override.
+    :param now: Signing time in UTC, defaults to the current time.
+    """
+    operation_params = []
+    if content_type:
+        operation_params.append(('response-content-type', content_type))
+
+    return _presign(
+        'GET', bucket, key, operation_params,
+        access_key, secret_key, token, region, expires_in, now,
+    )
+
+
+def presign_upload_part(
+    bucket: str,
+    key: str,
+    upload_id: str,
+    part_number: int,
+    access_key: str,
+    secret_key: str,
+    token: Optional[str] = None,
+    region: Optional[str] = None,
+    expires_in: int = 3600,
+    now: Optional[datetime] = None,
+) -> str:
+    """
+    Return a presigned URL to upload part `part_number` of the multipart
+    upload `upload_id` of `key` with a PUT request.
+
+    See `presign_get_object` for the other parameters.
+    """
+    # same order as botocore, the signature does not depend on it
+    operation_params = [('uploadId', upload_id), ('partNumber', part_number)]
+    return _presign(
+        'PUT', bucket, key, operation_params,
+        access_key, secret_key, token, region, expires_in, now,
+    )
+
+
+def _presign(
+    method: str,
+    bucket: str,
+    key: str,
+    operation_params: List[Tuple[str, object]],
+    access_key: str,
+    secret_key: str,
+    token: Optional[str],
+    region: Optional[str],
+    expires_in: int,
+    now: Optional[datetime],
+) -> str:
+    region = region or DEFAULT_REGION
+    timestamp = (now or datetime.utcnow()).strftime('%Y%m%dT%H%M%SZ')
+    date_stamp = timestamp[:8]
+    quoted_key = quote(key.encode('utf-8'), safe='/~')
+
+    if _is_virtual_host_bucket(bucket):
+        host = f'{bucket}.s3.amazonaws.com'
+        path = f'/{quoted_key}'
+    else:
+        host = 's3.amazonaws.com' if region == DEFAULT_REGION else f's3.{region}.amazonaws.com'
+        path = f'/{quote(bucket, safe="~")}/{quoted_key}'
+
+    credential_scope = f'{date_stamp}/{region}/s3/aws4_request'
+    auth_params = [
+        ('X-Amz-Algorithm', ALGORITHM),
+        ('X-Amz-Credential', f'{access_key}/{credential_scope}'),
+        ('X-Amz-Date', timestamp),
+        ('X-Amz-Expires', int(expires_in)),
+        ('X-Amz-SignedHeaders', 'host'),
+    ]
+    if token is not None:
+        auth_params.append(('X-Amz-Security-Token', token))
+
+    canonical_query = '&'.join(
+        f'{k}={v}' for k, v in sorted(
+            (_percent_encode(k), _percent_encode(v))
+            for k, v in operation_params + auth_params
+        )
+    )
+    canonical_request = '\n'.join([
+        method,
+        path,
+        canonical_query,
+        f'host:{host}\n',
+        'host',
+        UNSIGNED_PAYLOAD,
+    ])
+    string_to_sign = '\n'.join([
+        ALGORITHM,
+        timestamp,
+        credential_scope,
+        hashlib.sha256(canonical_request.encode('utf-8')).hexdigest(),
+    ])
+    signature = hmac.new(
+        _signing_key(secret_key, date_stamp, region),
+        string_to_sign.encode('utf-8'),
+        hashlib.sha256,
+    ).hexdigest()
+
+    # the operation params must come before the auth params
+    query = _encode_query(operation_params + auth_params)
+    return f'https://{host}{path}?{query}&X-Amz-Signature={signature}'
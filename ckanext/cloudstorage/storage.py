@@ -3,19 +3,26 @@
 import cgi
 import mimetypes
 from urllib.parse import urljoin
-from datetime import datetime, timedelta
-from time import time
-from tempfile import SpooledTemporaryFile
+from datetime import datetime, timedelta, timezone
+from typing import Iterator, Optional, Tuple
 
 from ckan.plugins import toolkit
 from ckan.lib.uploader import ResourceUpload as DefaultResourceUpload
 from ckan import model
 from ckan.lib import munge
 
-from libcloud.storage.types import Provider, ObjectDoesNotExistError
-from libcloud.storage.providers import get_driver
+from libcloud.storage.base import Container
+from libcloud.storage.types import ObjectDoesNotExistError
 
+from .checksum import ChecksumReader
 from .config import config
+from .clients import azure_services, s3_clients
+from .credentials import aws_credentials, resolve_aws_credentials, EXPIRES_FORMAT
+from .drivers import registry as driver_registry
+from .url_cache import presigned_urls
+from .sigv4 import presign_get_object, presign_upload_part
+from .proxy import request_object
+from .parallel_upload import can_upload_in_parts, remaining_size, upload_in_parts
 
 from werkzeug.datastructures import FileStorage as FlaskFileStorage
 
@@ -24,6 +31,8 @@ c = toolkit.c
 
 ALLOWED_UPLOAD_TYPES = (cgi.FieldStorage, FlaskFileStorage)
 
+UPLOAD_CHUNK_SIZE = 1024 * 1024
+
 
 def _get_underlying_file(wrapper):
     if isinstance(wrapper, FlaskFileStorage):
@@ -31,49 +40,44 @@ def _get_underlying_file(wrapper):
     return wrapper.file
 
 
+def _iter_chunks(fileobj, chunk_size: int) -> Iterator[bytes]:
+    while True:
+        chunk = fileobj.read(chunk_size)
+        if not chunk:
+            return
+        yield chunk
+
+
 class CloudStorage(object):
     def __init__(self):
         self.driver_name = config.driver_name
         self._driver_options = config.driver_options
         self.container_name = config.container_name
+        self.credentials_generation = 0
 
         if 'S3' in self.driver_name and 'key' not in self.driver_options:
             self._authenticate_with_aws()
-
-        self.driver = get_driver(
-            getattr(
-                Provider,
-                self.driver_name
-            )
-        )(**self.driver_options)
+        else:
+            self.driver = driver_registry.get(self.driver_name, self.driver_options)
         self._container = None
 
     def _authenticate_with_aws(self):
         """
-        TTL max 900 seconds for IAM role session
-        https://docs.aws.amazon.com/IAM/latest/UserGuide/id_roles_use.html#id_roles_use_view-role-max-session
+        Use the process-wide AWS credentials, refreshing them if they expired.
+        The pooled driver has its credentials swapped in place.
         """
-        import boto3
-        session = boto3.Session(
-            aws_access_key_id=config.aws_access_key_id,
-            aws_secret_access_key=config.aws_secret_access_key,
-        )
-        credentials = session.get_credentials()
-        current_credentials = credentials.get_frozen_credentials()
+        credentials = aws_credentials.get()
         self.driver_options = {
             **self.driver_options,
-            'key': current_credentials.access_key,
-            'secret': current_credentials.secret_key,
-            'token': current_credentials.token,
-            'expires': datetime.fromtimestamp(time() + 900).strftime('%Y-%m-%dT%H:%M:%SZ')
+            **credentials.as_driver_options(),
         }
 
-        self.driver = get_driver(
-            getattr(
-                Provider,
-                self.driver_name
-            )
-        )(**self.driver_options)
+        self.credentials_generation = credentials.generation
+        self.driver = driver_registry.get(
+            self.driver_name,
+            self.driver_options,
+            self.credentials_generation,
+        )
         self._container = None
 
     @property
@@ -82,14 +86,23 @@ class CloudStorage(object):
         Return the currently configured libcloud container.
         """
         if self.driver_options.get('expires'):
-            expires = datetime.strptime(self.driver_options['expires'], "%Y-%m-%dT%H:%M:%SZ")
+            expires = datetime.strptime(self.driver_options['expires'], EXPIRES_FORMAT)
             if expires < datetime.utcnow():
                 self._authenticate_with_aws()
 
         if self._container is None:
-            self._container = self.driver.get_container(
-                container_name=self.container_name
-            )
+            if config.local_container:
+                # The container has been validated when the plugin was
+                # configured, skip the round trip to the provider.
+                self._container = Container(
+                    name=self.container_name,
+                    extra=None,
+                    driver=self.driver,
+                )
+            else:
+                self._container = self.driver.get_container(
+                    container_name=self.container_name
+                )
 
         return self._container
 
@@ -132,9 +145,86 @@ class CloudStorage(object):
 
         return False
 
+    def presign_upload_part(self, object_name: str, upload_id: str, part_number: int, expires_in: int) -> str:
+        """
+        Return a presigned URL to upload a part of an S3 multipart upload
+        with a PUT request, without going through CKAN.
+        """
+        if config.presigner == 'native':
+            credentials = resolve_aws_credentials()
+            return presign_upload_part(
+                bucket=self.container_name,
+                key=object_name,
+                upload_id=upload_id,
+                part_number=part_number,
+                access_key=credentials.access_key,
+                secret_key=credentials.secret_key,
+                token=credentials.token,
+                region=config.aws_bucket_region,
+                expires_in=expires_in,
+            )
+
+        return s3_clients.get().generate_presigned_url(
+            ClientMethod='upload_part',
+            Params={
+                'Bucket': self.container_name,
+                'Key': object_name,
+                'UploadId': upload_id,
+                'PartNumber': part_number,
+            },
+            ExpiresIn=expires_in,
+        )
+
+
+def validate_container():
+    """
+    Make sure the configured container exists on the provider.
+
+    :raises ContainerDoesNotExistError: if it does not.
+    """
+    storage = CloudStorage()
+    storage.driver.get_container(container_name=storage.container_name)
+
 
 STORAGE_PATH_FIELD_NAME = "cloud_storage_key"
 
+def _request_storage_paths():
+    try:
+        from flask import g
+        return g.setdefault('cloudstorage_storage_paths', {})
+    except (ImportError, RuntimeError):
+        # outside of a flask request context
+        return None
+
+
+def resolve_storage_path(resource_id: str):
+    """
+    Return the `cloud_storage_key` of a resource, read straight from its
+    extras instead of going through `resource_show`. Lookups are memoised
+    for the duration of the current request.
+
+    :raises ObjectNotFound: if the resource does not exist.
+    """
+    paths = _request_storage_paths()
+    if paths is not None and resource_id in paths:
+        return paths[resource_id]
+
+    resource = model.Resource.get(resource_id)
+    if resource is None:
+        raise toolkit.ObjectNotFound('Resource was not found.')
+
+    path = (resource.extras or {}).get(STORAGE_PATH_FIELD_NAME)
+    if paths is not None:
+        paths[resource_id] = path
+    return path
+
+
+def forget_storage_path(resource_id: str):
+    """Drop the memoised storage key of a resource, ex: when it is updated."""
+    paths = _request_storage_paths()
+    if paths is not None:
+        paths.pop(resource_id, None)
+
 
 class ResourceCloudStorage(CloudStorage):
     def __init__(self, resource):
@@ -190,10 +280,12 @@ class ResourceCloudStorage(CloudStorage):
         return self._fallback_uploader_instance
 
     def _get_cloud_storage_path(self, resource_id):
-        return toolkit.get_action('resource_show')(
-            {'model': model, 'ignore_auth': True},
-            {'id': resource_id},
-        ).get(STORAGE_PATH_FIELD_NAME)
+        # The resource dict given by CKAN (ex: from resource_show, or the
+        # data dict of resource_create/update after `before_create` and
+        # `before_update`) usually carries the key already.
+        if STORAGE_PATH_FIELD_NAME in self.resource and self.resource.get('id') in (None, resource_id):
+            return self.resource[STORAGE_PATH_FIELD_NAME]
+        return resolve_storage_path(resource_id)
 
     def get_path(self, resource_id):
         path = self._get_cloud_storage_path(resource_id)
@@ -210,10 +302,13 @@ class ResourceCloudStorage(CloudStorage):
         if storage_path is None:
             return self._fallback_uploader.upload(id, max_size)
         elif self.filename:
+            # The upload is checksummed as it streams to the provider
+            checksum = ChecksumReader(self.file_upload)
             if self.can_use_advanced_azure:
-                return self._upload_using_azure(storage_path)
+                self._upload_using_azure(storage_path, checksum)
             else:
-                return self._upload_using_libcloud(storage_path)
+                self._upload_using_libcloud(storage_path, checksum)
+            self._store_checksum(id, checksum)
         elif self._clear and self.old_filename and not self.leave_files:
             # This is only set when a previously-uploaded file is replaced
             # by a link. We want to delete the previously-uploaded file.
@@ -247,21 +342,67 @@ class ResourceCloudStorage(CloudStorage):
         # If advanced azure features are enabled, generate a temporary
         # shared access link instead of simply redirecting to the file.
         elif self.can_use_advanced_azure and self.use_secure_urls:
-            return self._get_url_from_filename_using_azure(path)
+            return presigned_urls.get_or_sign(
+                path, None, 3600,
+                lambda: self._get_url_from_filename_using_azure(path),
+            )
         elif self.can_use_advanced_aws and self.use_secure_urls:
             expiry = expires_in or 3600
-            return self._get_url_from_filename_using_aws(content_type, path, expiry)
+            credentials = resolve_aws_credentials()
+            return presigned_urls.get_or_sign(
+                path, content_type, expiry,
+                lambda: self._get_url_from_filename_using_aws(content_type, path, expiry),
+                credentials_id=credentials.access_key,
+                credentials_expire_at=(
+                    None if credentials.expires == datetime.max
+                    else credentials.expires.replace(tzinfo=timezone.utc).timestamp()
+                ),
+            )
         else:
             return self._get_url_from_filename_using_libcloud(path)
 
-    def _upload_using_azure(self, storage_path: str):
-        from azure.storage import blob as azure_blob
+    def stream_object(self, rid: str, request_headers) -> Optional[Tuple[int, dict, Iterator[bytes]]]:
+        """
+        Fetch the stored object of a resource from the provider so it can be
+        proxied to the client.
+
+        The range and conditional headers of the client request are passed
+        through, so partial and conditional requests are answered by the
+        provider without pulling the whole object through the worker.
+
+        :param rid: The resource ID.
+        :param request_headers: The headers of the client request.
+
+        :returns: `None` if the resource is not stored in the cloud, otherwise
+            the provider's status code, the response headers to forward and
+            an iterator over the body in `proxy_chunk_size` chunks.
+        """
+        path = self._get_cloud_storage_path(rid)
+        if path is None:
+            return None
+
+        return request_object(self.driver, self.container, path, request_headers, config.proxy_chunk_size)
+
+    def _store_checksum(self, resource_id: str, checksum: ChecksumReader):
+        """
+        Record the size and digests of the uploaded file on the resource.
+
+        Only the session is updated: `resource_create` and `resource_update`
+        upload the file right before committing their own changes, so the
+        fields are saved, and the package reindexed, with them.
+        """
+        resource = model.Resource.get(resource_id)
+        if resource is None:
+            return
+        fields = checksum.as_resource_fields()
+        resource.size = fields.pop('size')
+        resource.hash = fields.pop('hash')
+        resource.extras = dict(resource.extras or {}, **fields)
+
+    def _upload_using_azure(self, storage_path: str, fileobj):
         from azure.storage.blob.models import ContentSettings
 
-        blob_service = azure_blob.BlockBlobService(
-            self.driver_options['key'],
-            self.driver_options['secret']
-        )
+        blob_service = azure_services.get()
         content_settings = None
         if self.guess_mimetype:
             content_type, _ = mimetypes.guess_type(self.filename)
@@ -273,46 +414,42 @@ class ResourceCloudStorage(CloudStorage):
         return blob_service.create_blob_from_stream(
             container_name=self.container_name,
             blob_name=storage_path,
-            stream=self.file_upload,
-            content_settings=content_settings
+            stream=fileobj,
+            content_settings=content_settings,
+            # the checksummed stream is not seekable, so its blocks are read
+            # sequentially and sent in parallel
+            max_connections=config.azure_max_connections,
         )
 
-    def _upload_using_libcloud(self, storage_path: str):
-        # If it's temporary file, we'd better convert it
-        # into FileIO. Otherwise libcloud will iterate
-        # over lines, not over chunks and it will really
-        # slow down the process for files that consist of
-        # millions of short line
-        if isinstance(self.file_upload, SpooledTemporaryFile):
-            self.file_upload.rollover()
-            try:
-                # extract underlying file
-                file_upload_iter = self.file_upload._file.detach()
-            except AttributeError:
-                # It's python2
-                file_upload_iter = self.file_upload._file
-        else:
-            file_upload_iter = iter(self.file_upload)
-
-        extra = None
+    def _upload_using_libcloud(self, storage_path: str, fileobj):
+        content_type = None
         if self.guess_mimetype:
             content_type, _ = mimetypes.guess_type(self.filename)
-            extra = {'content_type': content_type} if content_type else None
 
+        # Large seekable files are sent as concurrent multipart uploads
+        if can_upload_in_parts(self, self.file_upload):
+            upload_in_parts(
+                self,
+                fileobj,
+                storage_path,
+                headers={'Content-Type': content_type} if content_type else None,
+                size=remaining_size(self.file_upload),
+            )
+            return
+
+        # Feed the provider fixed size chunks read straight from the upload,
+        # whether it is still spooled in memory or not. Iterating over the
+        # file itself would yield lines, which is really slow for files that
+        # consist of millions of short lines.
+        extra = {'content_type': content_type} if content_type else None
         self.container.upload_object_via_stream(
-            iterator=file_upload_iter,
+            iterator=_iter_chunks(fileobj, UPLOAD_CHUNK_SIZE),
             object_name=storage_path,
             extra=extra,
         )
 
     def _delete_using_aws(self, storage_path: str, id: str, max_size: int):
-        import boto3
-        client = boto3.client(
-            's3',
-            aws_access_key_id=config.aws_access_key_id,
-            aws_secret_access_key=config.aws_secret_access_key,
-            region_name=config.aws_bucket_region,
-        )
+        client = s3_clients.get()
         client.delete_object(Bucket=self.container_name, Key=storage_path)
 
     def _delete_using_libcloud(self, storage_path: str, id: str, max_size: int):
@@ -331,10 +468,7 @@ class ResourceCloudStorage(CloudStorage):
     def _get_url_from_filename_using_azure(self, path: str):
         from azure.storage import blob as azure_blob
 
-        blob_service = azure_blob.BlockBlobService(
-            self.driver_options['key'],
-            self.driver_options['secret']
-        )
+        blob_service = azure_services.get()
 
         return blob_service.make_blob_url(
             container_name=self.container_name,
@@ -348,13 +482,20 @@ class ResourceCloudStorage(CloudStorage):
         )
 
     def _get_url_from_filename_using_aws(self, content_type: str, path: str, expires_in: int):
-        import boto3
-        client = boto3.client(
-            's3',
-            aws_access_key_id=config.aws_access_key_id,
-            aws_secret_access_key=config.aws_secret_access_key,
-            region_name=config.aws_bucket_region,
-        )
+        if config.presigner == 'native':
+            credentials = resolve_aws_credentials()
+            return presign_get_object(
+                bucket=self.container_name,
+                key=path,
+                access_key=credentials.access_key,
+                secret_key=credentials.secret_key,
+                token=credentials.token,
+                region=config.aws_bucket_region,
+                expires_in=expires_in,
+                content_type=content_type,
+            )
+
+        client = s3_clients.get()
         params = {'Bucket': self.container_name, 'Key': path}
         if content_type:
             params['ResponseContentType'] = content_type
@@ -0,0 +1,114 @@
+import itertools
+import threading
+import time
+import uuid
+from typing import Dict, List, Optional
+
+
+class LocalMessage:
+    """An in-memory stand-in for a boto3 SQS `Message`."""
+    def __init__(self, queue: 'LocalQueue', message_id: str, body: str):
+        self.queue = queue
+        self.message_id = message_id
+        self.body = body
+        self.receipt_handle: Optional[str] = None
+        self.receive_count = 0
+
+    def delete(self):
+        self.queue.delete_messages(Entries=[{'Id': '0', 'ReceiptHandle': self.receipt_handle}])
+
+    def change_visibility(self, VisibilityTimeout: int):
+        self.queue.change_message_visibility_batch(Entries=[
+            {'Id': '0', 'ReceiptHandle': self.receipt_handle, 'VisibilityTimeout': VisibilityTimeout},
+        ])
+
+    def __repr__(self):
+        return f'LocalMessage(message_id={self.message_id!r})'
+
+
+class LocalQueue:
+    """
+    An in-memory stand-in for a boto3 SQS `Queue`, with the same visibility
+    timeout semantics, so the sync worker can run without AWS (ex: in tests
+    or with `ckanext.cloudstorage.sync.use_fake_events`).
+
+    Only the methods used by the sync worker are implemented.
+    """
+    def __init__(self, bodies: List[str] = (), visibility_timeout: int = 30):
+        self.url = 'local://queue'
+        self.visibility_timeout = visibility_timeout
+        self._lock = threading.Condition()
+        self._messages: Dict[str, LocalMessage] = {}
+        # message id -> time the message becomes visible again
+        self._invisible_until: Dict[str, float] = {}
+        self._receipts: Dict[str, str] = {}
+        self._ids = itertools.count(1)
+        self.deleted: List[str] = []
+        self.api_calls = 0
+        for body in bodies:
+            self.send_message(MessageBody=body)
+
+    def send_message(self, MessageBody: str) -> dict:
+        with self._lock:
+            self.api_calls += 1
+            message_id = str(next(self._ids))
+            self._messages[message_id] = LocalMessage(self, message_id, MessageBody)
+            self._lock.notify_all()
+            return {'MessageId': message_id}
+
+    def receive_messages(self, MaxNumberOfMessages: int = 1, WaitTimeSeconds: int = 0,
+                         VisibilityTimeout: Optional[int] = None) -> List[LocalMessage]:
+        deadline = time.monotonic() + WaitTimeSeconds
+        with self._lock:
+            self.api_calls += 1
+            while True:
+                now = time.monotonic()
+                visible = [
+                    message for message_id, message in self._messages.items()
+                    if self._invisible_until.get(message_id, 0) <= now
+                ][:MaxNumberOfMessages]
+                if visible or now >= deadline:
+                    break
+                self._lock.wait(min(deadline - now, 0.1))
+
+            timeout = self.visibility_timeout if VisibilityTimeout is None else VisibilityTimeout
+            for message in visible:
+                message.receipt_handle = uuid.uuid4().hex
+                message.receive_count += 1
+                self._receipts[message.receipt_handle] = message.message_id
+                self._invisible_until[message.message_id] = now + timeout
+            return visible
+
+    def change_message_visibility_batch(self, Entries: List[dict]) -> dict:
+        with self._lock:
+            self.api_calls += 1
+            now = time.monotonic()
+            successful, failed = [], []
+            for entry in Entries:
+                message_id = self._receipts.get(entry['ReceiptHandle'])
+                if message_id in self._messages:
+                    self._invisible_until[message_id] = now + entry['VisibilityTimeout']
+                    successful.append({'Id': entry['Id']})
+                else:
+                    failed.append({'Id': entry['Id'], 'Code': 'ReceiptHandleIsInvalid', 'SenderFault': True})
+            self._lock.notify_all()
+            return {'Successful': successful, 'Failed': failed}
+
+    def delete_messages(self, Entries: List[dict]) -> dict:
+        with self._lock:
+            self.api_calls += 1
+            successful, failed = [], []
+            for entry in Entries:
+                message_id = self._receipts.pop(entry['ReceiptHandle'], None)
+                if message_id is None:
+                    failed.append({'Id': entry['Id'], 'Code': 'ReceiptHandleIsInvalid', 'SenderFault': True})
+                    continue
+                if self._messages.pop(message_id, None) is not None:
+                    self._invisible_until.pop(message_id, None)
+                    self.deleted.append(message_id)
+                successful.append({'Id': entry['Id']})
+            return {'Successful': successful, 'Failed': failed}
+
+    def __len__(self):
+        with self._lock:
+            return len(self._messages)
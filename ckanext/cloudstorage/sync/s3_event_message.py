@@ -1,6 +1,6 @@
 from datetime import datetime
 import logging
-from typing import Iterator, Tuple, Any, Optional
+from typing import Iterable, Iterator, Tuple, Any, Optional
 from urllib.parse import unquote_plus as url_unquote_plus
 import json
 
@@ -14,6 +14,74 @@ logger = logging.getLogger(__name__)
 SQSMessage = Any # type for the messages from SQS queue
 
 
+class MessageAcknowledger:
+    """
+    Deletes messages from the queue once every event they hold is handled,
+    in batches of up to 10 (the most `DeleteMessageBatch` accepts).
+
+    A message with an event that failed, or with a record that could not
+    be parsed, is kept, so it is delivered again (and eventually moved to
+    the dead letter queue). Events handled before are ignored on
+    redelivery, as their sequencer is already recorded.
+    """
+    BATCH_SIZE = 10
+
+    def __init__(self, queue):
+        self._queue = queue
+        # message id -> [message, events left, failed]
+        self._pending = {}
+        self._buffer = []
+        # ids of the messages with records that could not be parsed
+        self._unparsable = set()
+
+    def unparsable(self, message: SQSMessage):
+        self._unparsable.add(message.message_id)
+
+    def track(self, message: SQSMessage, events: int):
+        failed = message.message_id in self._unparsable
+        self._unparsable.discard(message.message_id)
+        if events:
+            self._pending[message.message_id] = [message, events, failed]
+        elif failed:
+            logger.warning("keeping message %s, none of its records could be parsed", message)
+        else:
+            # ex: test events or folder objects, there is nothing to handle
+            self._acknowledge(message)
+
+    def handled(self, message: SQSMessage):
+        self._done(message, failed=False)
+
+    def failed(self, message: SQSMessage):
+        self._done(message, failed=True)
+
+    def _done(self, message: SQSMessage, failed: bool):
+        entry = self._pending.get(message.message_id)
+        if entry is None:
+            return
+        entry[1] -= 1
+        entry[2] = entry[2] or failed
+        if entry[1] > 0:
+            return
+        del self._pending[message.message_id]
+        if not entry[2]:
+            self._acknowledge(message)
+
+    def _acknowledge(self, message: SQSMessage):
+        self._buffer.append(message)
+        if len(self._buffer) >= self.BATCH_SIZE:
+            self.flush()
+
+    def flush(self):
+        while self._buffer:
+            batch, self._buffer = self._buffer[:self.BATCH_SIZE], self._buffer[self.BATCH_SIZE:]
+            response = self._queue.delete_messages(Entries=[
+                {'Id': str(i), 'ReceiptHandle': message.receipt_handle}
+                for i, message in enumerate(batch)
+            ])
+            for failure in response.get('Failed', []):
+                logger.warning("unable to delete message %s: %s", batch[int(failure['Id'])], failure)
+
+
 class S3EventMessage:
     SUPPORTED_VERSION_MAJOR = 2
     SUPPORTED_VERSION_MINOR = 1
@@ -21,9 +89,10 @@ class S3EventMessage:
     OBJECT_REMOVED_EVENT_NAME = "ObjectRemoved:"
     EVENT_NAMES = (OBJECT_CREATED_EVENT_NAME, OBJECT_REMOVED_EVENT_NAME)
 
-    def __init__(self, message: SQSMessage, record: dict):
+    def __init__(self, message: SQSMessage, record: dict, acknowledger: MessageAcknowledger):
         self._record = record
         self._message = message
+        self._acknowledger = acknowledger
         self._object_key = url_unquote_plus(record["s3"]["object"]["key"])
         self._object_key_parts = tuple(self._object_key.split("/"))
         self.resource_key = ResourceObjectKey.from_raw_key(self.object_key)
@@ -37,17 +106,24 @@ class S3EventMessage:
             self.time = datetime.fromisoformat(event_time)
 
     @classmethod
-    def from_sqs_message(cls, bucket_name: str, message: SQSMessage):
-        body = json.loads(message.body)
-        if body.get("Event") == "s3:TestEvent":
-            logger.debug("received an S3 test event message")
+    def from_sqs_message(cls, bucket_name: str, message: SQSMessage, acknowledger: MessageAcknowledger):
+        try:
+            body = json.loads(message.body)
+            if body.get("Event") == "s3:TestEvent":
+                logger.debug("received an S3 test event message")
+                return None
+            records = body["Records"]
+        except (ValueError, KeyError, TypeError, AttributeError):
+            logger.exception("unexpected message schema")
+            acknowledger.unparsable(message)
             return None
 
-        for record in body["Records"]:
+        for record in records:
             try:
                 version_major, version_minor = map(int, record["eventVersion"].split("."))
                 if version_major > cls.SUPPORTED_VERSION_MAJOR or version_minor < cls.SUPPORTED_VERSION_MINOR:
                     logger.warning("received message with unsupported event version: %s", record["eventVersion"])
+                    acknowledger.unparsable(message)
                     continue
 
                 event_source, event_name = record["eventSource"], record["eventName"]
@@ -61,20 +137,21 @@ class S3EventMessage:
                     event_object_key = record["s3"]["object"]["key"]
                     logger.debug("sync event message for key %s", event_object_key)
                     is_folder_object = event_object_key.endswith('/')
-                    yield None if is_folder_object else S3EventMessage(message, record)
+                    yield None if is_folder_object else S3EventMessage(message, record, acknowledger)
             except (ValueError, KeyError, TypeError):
                 logger.exception("unexpected schema")
+                acknowledger.unparsable(message)
 
     def mark_received(self):
-        self._message.delete()
+        self._acknowledger.handled(self._message)
 
     def mark_invalid(self, message=None):
         logger.warning("cannot process event for object %s. event will be deleted, cause: %s", self.object_key, message)
-        self._message.delete()
+        self._acknowledger.handled(self._message)
 
     def mark_error(self, error=None):
-        # do nothing, after some retries the message will be delivered to the dead letter queue
-        pass
+        # keep the message, after some retries it will be delivered to the dead letter queue
+        self._acknowledger.failed(self._message)
 
     @property
     def type(self):
@@ -126,37 +203,22 @@ class S3EventMessage:
         return self._record["s3"]["object"]["sequencer"]
 
 
-def _poll_queue(queue_region: str, queue_url: str, driver_options) -> Iterator[SQSMessage]:
-    queue = boto3.resource(
+def sqs_queue(queue_region: str, queue_url: str, driver_options: dict):
+    return boto3.resource(
         "sqs",
         region_name=queue_region,
         aws_access_key_id=driver_options.get('key'),
         aws_secret_access_key=driver_options.get('secret'),
     ).Queue(queue_url)
 
-    while True:
-        messages = queue.receive_messages(MaxNumberOfMessages=10)
-        if not messages:
-            break
-        yield from messages
-
-def receive_s3_events(bucket_name: str, queue_region: str, queue_url: str, driver_options: dict) -> Iterator[S3EventMessage]:
-    for message in _poll_queue(queue_region, queue_url, driver_options):
+def events_from_messages(bucket_name: str, messages: Iterable[SQSMessage], acknowledger: MessageAcknowledger) -> Iterator[S3EventMessage]:
+    """The events of `messages`, which are deleted once all their events are marked."""
+    for message in messages:
         logger.info("received message from sqs: %s", message)
-        for event in S3EventMessage.from_sqs_message(bucket_name, message):
-            if event is None:
-                message.delete()
-            else:
-                yield event
-
-# Fakes
-
-def fake_receive_s3_events():
-    class FakeSQSMessage:
-        def __init__(self, *, delete=lambda: None, body={'Records': []}):
-            self.body = body
-            self.delete = delete
-
-    from .fake_s3_event_messages import FAKE_MESSAGES
-
-    yield from S3EventMessage.from_sqs_message('fake_bucket', FakeSQSMessage(body=FAKE_MESSAGES))
+        events = [
+            event for event in S3EventMessage.from_sqs_message(bucket_name, message, acknowledger)
+            if event is not None
+        ]
+        acknowledger.track(message, len(events))
+        yield from events
+    acknowledger.flush()
@@ -1,16 +1,16 @@
 import logging
 import re
-from typing import Optional
+from typing import Iterable, Optional
 
 import ckan.model as model
 from ckan.plugins import toolkit
 
-from ..config import config
 from ..distributed_lock import distributed_lock
 from ..resource_object_key import ResourceObjectKeyType
 from ..utils import convert_global_package_name_to_local
 from ..helpers import STREAM_RESOURCE_TYPE
-from .s3_event_message import S3EventMessage, receive_s3_events, fake_receive_s3_events
+from .s3_event_message import S3EventMessage
+from .worker import SyncWorker
 
 
 logger = logging.getLogger(__name__)
@@ -26,9 +26,14 @@ def schedule_s3_sync_job():
             toolkit.enqueue_job(sync_s3, title=sync_s3.__name__)
 
 def sync_s3():
+    # unlike the sync-worker command, the job ends once the queue is drained
+    received = SyncWorker.from_config(handle_s3_events).drain()
+    logger.info("sync job handled %i messages", received)
+
+def handle_s3_events(events: Iterable[S3EventMessage]):
     context = {"model": model, "session": model.Session, "ignore_auth": True, "defer_commit": True, "user": None}
 
-    for event in _events():
+    for event in events:
         try:
             _do_sync(context, event)
         except ValueError as e:
@@ -40,13 +45,6 @@ def sync_s3():
         else:
             event.mark_received()
 
-def _events():
-    return (
-        receive_s3_events(config.container_name, config.queue_region, config.queue_url, config.driver_options)
-        if not config.use_fake_events else
-        fake_receive_s3_events()
-    )
-
 def _do_sync(context, event: S3EventMessage):
     organization = _get_organization(dict(context), event.resource_key.organization_name)
     admin = _get_organization_admin(organization)
@@ -0,0 +1,142 @@
+from contextlib import contextmanager
+import logging
+import threading
+from typing import Callable, Iterable, List
+
+import ckan.model as model
+
+from ..config import config
+from .fake_s3_event_messages import FAKE_MESSAGES
+from .local_queue import LocalQueue
+from .s3_event_message import MessageAcknowledger, S3EventMessage, SQSMessage, events_from_messages, sqs_queue
+
+
+logger = logging.getLogger(__name__)
+
+
+class SyncWorker:
+    """
+    Long-running consumer of the S3 event queue.
+
+    Messages are long polled in batches of up to 10. While a batch is being
+    handled its visibility timeout is extended in the background, so slow
+    batches are not delivered to another consumer in the meantime.
+
+    `stop` lets the current batch finish before `run` returns, a stop
+    requested during a poll takes effect once the poll returns (at most
+    `wait_time` seconds).
+    """
+
+    def __init__(
+        self,
+        queue,
+        bucket_name: str,
+        handle_events: Callable[[Iterable[S3EventMessage]], None],
+        wait_time: int = 20,
+        visibility_timeout: int = 120,
+    ):
+        self._queue = queue
+        self._bucket_name = bucket_name
+        self._handle_events = handle_events
+        self._wait_time = wait_time
+        self._visibility_timeout = visibility_timeout
+        self._stopping = threading.Event()
+
+    @classmethod
+    def from_config(cls, handle_events):
+        queue = (
+            LocalQueue([FAKE_MESSAGES])
+            if config.use_fake_events else
+            sqs_queue(config.queue_region, config.queue_url, config.driver_options)
+        )
+        bucket_name = 'fake_bucket' if config.use_fake_events else config.container_name
+        return cls(queue, bucket_name, handle_events, config.sync_wait_time, config.sync_visibility_timeout)
+
+    def stop(self, *_args):
+        if not self._stopping.is_set():
+            logger.info("stopping the sync worker once the current batch is handled")
+        self._stopping.set()
+
+    @property
+    def stopping(self) -> bool:
+        return self._stopping.is_set()
+
+    def run(self):
+        logger.info("sync worker started")
+        while not self._stopping.is_set():
+            self.run_once()
+        logger.info("sync worker stopped")
+
+    def drain(self) -> int:
+        """
+        Handle batches until a poll comes back empty, returns the number of
+        messages received. Used by the `sync_s3` job, which must end.
+        """
+        received = 0
+        while not self._stopping.is_set():
+            batch = self.run_once()
+            if not batch:
+                break
+            received += batch
+        return received
+
+    def run_once(self) -> int:
+        """Poll and handle one batch of messages, returns its size."""
+        messages = self._queue.receive_messages(
+            MaxNumberOfMessages=10,
+            WaitTimeSeconds=self._wait_time,
+            VisibilityTimeout=self._visibility_timeout,
+        )
+        if not messages:
+            return 0
+
+        acknowledger = MessageAcknowledger(self._queue)
+        try:
+            with self._extending_visibility(messages):
+                self._handle_events(events_from_messages(self._bucket_name, messages, acknowledger))
+        except Exception:
+            # the messages not acknowledged are delivered again once their
+            # visibility timeout expires
+            logger.exception("unable to handle a batch of %i messages", len(messages))
+        finally:
+            acknowledger.flush()
+            # don't hold a session, and its objects, between batches
+            model.Session.remove()
+        return len(messages)
+
+    @contextmanager
+    def _extending_visibility(self, messages: List[SQSMessage]):
+        done = threading.Event()
+        thread = threading.Thread(
+            target=self._extend_visibility,
+            args=(messages, done),
+            name='cloudstorage-sync-visibility',
+            daemon=True,
+        )
+        thread.start()
+        try:
+            yield
+        finally:
+            done.set()
+            thread.join()
+
+    def _extend_visibility(self, messages: List[SQSMessage], done: threading.Event):
+        # extend halfway through the timeout, so a slow request can't let it
+        # expire
+        while not done.wait(self._visibility_timeout / 2):
+            logger.debug("extending the visibility timeout of %i messages", len(messages))
+            try:
+                response = self._queue.change_message_visibility_batch(Entries=[
+                    {
+                        'Id': str(i),
+                        'ReceiptHandle': message.receipt_handle,
+                        'VisibilityTimeout': self._visibility_timeout,
+                    }
+                    for i, message in enumerate(messages)
+                ])
+            except Exception:
+                logger.exception("unable to extend the visibility timeout of %i messages", len(messages))
+                continue
+            for failure in response.get('Failed', []):
+                # ex: the message was deleted in the meantime
+                logger.debug("visibility timeout not extended: %s", failure)
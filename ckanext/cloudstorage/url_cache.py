@@ -0,0 +1,196 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+import hashlib
+import logging
+import threading
+from collections import OrderedDict
+from time import time
+from typing import Callable, Optional, Tuple
+
+from .config import config
+
+
+logger = logging.getLogger(__name__)
+
+REDIS_KEY_PREFIX = 'cloudstorage:presigned-url'
+
+CacheKey = Tuple[str, Optional[str], int, Optional[str]]
+
+
+class PresignedUrlCache:
+    """
+    Two level cache of signed download URLs: an in-process LRU and,
+    optionally, redis shared by every worker.
+
+    Entries are keyed by `(storage key, content type, expiry bucket,
+    credentials)` where the expiry bucket is the requested lifetime of the
+    URL and credentials identifies the key that signed it, so rotated
+    credentials never reuse URLs signed with the previous ones. A cached URL
+    is only handed out while at least `min_validity` (a fraction of the
+    requested lifetime) remains, so callers always get a URL that stays
+    valid for a predictable amount of time.
+
+    A URL signed with temporary credentials stops working when they expire,
+    whatever its own expiry, so entries never outlive the credentials.
+    """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._entries = OrderedDict()
+        self.hits = 0
+        self.misses = 0
+
+    @property
+    def enabled(self) -> bool:
+        return config.presigned_url_cache_size > 0
+
+    def get_or_sign(
+        self,
+        path: str,
+        content_type: Optional[str],
+        expires_in: int,
+        sign: Callable[[], str],
+        credentials_id: Optional[str] = None,
+        credentials_expire_at: Optional[float] = None,
+    ) -> str:
+        """
+        Return a cached URL for the object or sign a new one with `sign`.
+
+        :param credentials_id: Identifies the credentials used by `sign`, ex:
+            the access key.
+        :param credentials_expire_at: Epoch time at which the credentials
+            used by `sign` expire, if they are temporary.
+        """
+        if not self.enabled:
+            return sign()
+
+        key = (path, content_type or None, int(expires_in), credentials_id or None)
+        now = time()
+        min_expires_at = now + expires_in * config.presigned_url_min_validity
+
+        url = self._get_local(key, min_expires_at)
+        if url is None and config.presigned_url_cache_redis:
+            url = self._get_redis(key, min_expires_at)
+        if url is not None:
+            self._count('hits')
+            return url
+
+        self._count('misses')
+        url = sign()
+        expires_at = now + expires_in
+        if credentials_expire_at is not None:
+            expires_at = min(expires_at, credentials_expire_at)
+        self._set_local(key, url, expires_at)
+        if config.presigned_url_cache_redis:
+            self._set_redis(key, url, expires_at, expires_at - min_expires_at)
+        return url
+
+    def invalidate(self, path: str):
+        """Evict every URL signed for the given storage key."""
+        with self._lock:
+            for key in [key for key in self._entries if key[0] == path]:
+                del self._entries[key]
+
+        if config.presigned_url_cache_redis:
+            try:
+                redis = _connect_to_redis()
+                # the index is dropped with its members, URLs cached from
+                # now on start a new one
+                pipeline = redis.pipeline()
+                pipeline.smembers(_redis_index_key(path))
+                pipeline.delete(_redis_index_key(path))
+                keys, _ = pipeline.execute()
+                if keys:
+                    redis.delete(*keys)
+            except Exception:
+                logger.exception("unable to invalidate presigned urls in redis for %s", path)
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+
+    def stats(self) -> dict:
+        with self._lock:
+            return {
+                'hits': self.hits,
+                'misses': self.misses,
+                'entries': len(self._entries),
+            }
+
+    def _get_local(self, key: CacheKey, min_expires_at: float) -> Optional[str]:
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is None:
+                return None
+            url, expires_at = entry
+            if expires_at < min_expires_at:
+                del self._entries[key]
+                return None
+            self._entries.move_to_end(key)
+            return url
+
+    def _set_local(self, key: CacheKey, url: str, expires_at: float):
+        with self._lock:
+            self._entries[key] = (url, expires_at)
+            self._entries.move_to_end(key)
+            while len(self._entries) > config.presigned_url_cache_size:
+                self._entries.popitem(last=False)
+
+    def _get_redis(self, key: CacheKey, min_expires_at: float) -> Optional[str]:
+        try:
+            value = _connect_to_redis().get(_redis_key(key))
+        except Exception:
+            logger.exception("unable to read presigned url from redis")
+            return None
+        if value is None:
+            return None
+
+        expires_at, _, url = value.decode('utf-8').partition(' ')
+        if float(expires_at) < min_expires_at:
+            return None
+        self._set_local(key, url, float(expires_at))
+        return url
+
+    def _set_redis(self, key: CacheKey, url: str, expires_at: float, ttl: float):
+        if ttl < 1:
+            return
+        try:
+            redis = _connect_to_redis()
+            index_key = _redis_index_key(key[0])
+            pipeline = redis.pipeline(transaction=False)
+            pipeline.set(_redis_key(key), f'{expires_at} {url}', ex=int(ttl))
+            pipeline.sadd(index_key, _redis_key(key))
+            pipeline.ttl(index_key)
+            _, _, index_ttl = pipeline.execute()
+            # the index lives as long as its longest lived URL
+            if index_ttl < int(ttl):
+                redis.expire(index_key, int(ttl))
+        except Exception:
+            logger.exception("unable to store presigned url in redis")
+
+    def _count(self, counter: str):
+        with self._lock:
+            setattr(self, counter, getattr(self, counter) + 1)
+
+
+def _connect_to_redis():
+    from ckan.lib.redis import connect_to_redis
+    return connect_to_redis()
+
+
+def _redis_path_prefix(path: str) -> str:
+    return f'{REDIS_KEY_PREFIX}:{hashlib.sha1(path.encode("utf-8")).hexdigest()}'
+
+
+def _redis_index_key(path: str) -> str:
+    """Set of the redis keys of the URLs cached for `path`."""
+    return f'{_redis_path_prefix(path)}:keys'
+
+
+def _redis_key(key: CacheKey) -> str:
+    path, content_type, expires_in, credentials_id = key
+    return f'{_redis_path_prefix(path)}:{expires_in}:{credentials_id or ""}:{content_type or ""}'
+
+
+presigned_urls = PresignedUrlCache()
+config.on_reload(presigned_urls.clear)
@@ -13,6 +13,8 @@ import tempfile
 from ckan.logic import NotFound
 from ckanapi import LocalCKAN
 
+from ckanext.cloudstorage.clients import azure_services
+from ckanext.cloudstorage.config import config
 from ckanext.cloudstorage.model import (create_tables, drop_tables)
 from ckanext.cloudstorage.storage import (CloudStorage, ResourceCloudStorage)
 
@@ -32,16 +34,18 @@ def initdb():
     create_tables()
 
 
+def upgradedb():
+    # creates the missing tables and upgrades the existing ones
+    create_tables()
+
+
 def fix_cors(domains):
     cs = CloudStorage()
 
     if cs.can_use_advanced_azure:
-        from azure.storage import blob as azure_blob
         from azure.storage import CorsRule
 
-        blob_service = azure_blob.BlockBlobService(
-                cs.driver_options['key'],
-                cs.driver_options['secret'])
+        blob_service = azure_services.get()
 
         blob_service.set_blob_service_properties(
             cors=[CorsRule(allowed_origins=domains,
@@ -108,6 +112,8 @@ def migrate(path, single_id):
             try:
                 uploader = ResourceCloudStorage(resource)
                 uploader.upload(resource['id'])
+                # the uploader records the checksum without committing
+                model.repo.commit()
             except Exception as e:
                 failed.append(resource_id)
                 print('\tError of type {0} during upload: {1}'.format(
@@ -152,6 +158,11 @@ def resource_download(id, resource_id, filename=None):
 
     upload = uploader.get_resource_uploader(resource)
 
+    if config.proxy_downloads and isinstance(upload, ResourceCloudStorage):
+        streamed = upload.stream_object(resource['id'], tk.request.headers)
+        if streamed is not None:
+            return _proxy_response(*streamed)
+
     # if the client requests with a Content-Type header (e.g. Text preview)
     # we have to add the header to the signature
     try:
@@ -200,3 +211,23 @@ def canonicalize_package_name(name: str) -> str:
         package_name = name.lower()
 
     return package_name
+
+
+def _proxy_response(status, headers, body):
+    if status in (304, 412, 416):
+        # conditional and range failures carry no body for the client
+        body.close()
+        headers.pop('Content-Length', None)
+        return flask.Response(status=status, headers=headers)
+    if status >= 400:
+        body.close()
+        if status == 404:
+            return base.abort(404, tk._('Resource data not found'))
+        return base.abort(502, tk._('No download is available'))
+
+    return flask.Response(
+        flask.stream_with_context(body),
+        status=status,
+        headers=headers,
+        direct_passthrough=True,
+    )
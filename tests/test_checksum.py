@@ -0,0 +1,59 @@
+# -*- coding: utf-8 -*-
+import hashlib
+import io
+import os
+from unittest import mock
+
+import pytest
+
+from ckanext.cloudstorage.checksum import ChecksumReader, etag_md5, multipart_md5
+
+
+def test_checksum_reader_digests():
+    data = os.urandom(100000)
+    reader = ChecksumReader(io.BytesIO(data))
+    while reader.read(4096):
+        pass
+    assert reader.size == reader.tell() == len(data)
+    assert reader.md5 == hashlib.md5(data).hexdigest()
+    assert reader.sha256 == hashlib.sha256(data).hexdigest()
+
+
+def test_checksum_reader_is_not_seekable():
+    reader = ChecksumReader(io.BytesIO(b'data'))
+    assert not reader.seekable()
+    with pytest.raises(io.UnsupportedOperation):
+        reader.seek(0)
+
+
+def test_multipart_md5():
+    parts = [b'a' * 10, b'b' * 10]
+    etags = [f'"{hashlib.md5(part).hexdigest()}"' for part in parts]
+    expected = hashlib.md5(b''.join(hashlib.md5(part).digest() for part in parts)).hexdigest()
+    assert multipart_md5(etags) == f'{expected}-2'
+    assert multipart_md5(etags + ['"not-an-md5"']) is None
+    assert etag_md5('"ABCDEF0123456789ABCDEF0123456789"') == 'abcdef0123456789abcdef0123456789'
+
+
+@pytest.mark.parametrize('size', [1024, 70 * 1024 + 5])
+def test_azure_parallel_upload(size):
+    """The blocks `create_blob_from_stream` uploads in parallel are read in order."""
+    blob = pytest.importorskip('azure.storage.blob')
+    service = blob.BlockBlobService(account_name='account', account_key='a2V5')
+    service.MAX_BLOCK_SIZE = 4 * 1024
+    blocks = {}
+
+    def put_block(container_name, blob_name, block, block_id, **kwargs):
+        blocks[block_id] = block
+
+    def put_block_list(container_name, blob_name, block_list, **kwargs):
+        blocks['list'] = [block.id for block in block_list]
+
+    data = os.urandom(size)
+    reader = ChecksumReader(io.BytesIO(data))
+    with mock.patch.object(service, '_put_block', side_effect=put_block), \
+            mock.patch.object(service, '_put_block_list', side_effect=put_block_list):
+        service.create_blob_from_stream('container', 'blob', reader, max_connections=4)
+
+    assert b''.join(blocks[block_id] for block_id in blocks['list']) == data
+    assert reader.md5 == hashlib.md5(data).hexdigest()
@@ -0,0 +1,281 @@
+# -*- coding: utf-8 -*-
+import hashlib
+import io
+import os
+import ssl
+import threading
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from types import SimpleNamespace
+from urllib.parse import parse_qs, urlparse
+
+import pytest
+
+pytest.importorskip('ckan')
+
+import requests  # noqa: E402
+from libcloud.common.types import LibcloudError  # noqa: E402
+from libcloud.storage.drivers.s3 import S3StorageDriver  # noqa: E402
+from sqlalchemy import create_engine  # noqa: E402
+from sqlalchemy.orm import sessionmaker  # noqa: E402
+from werkzeug.datastructures import FileStorage  # noqa: E402
+
+import ckan.plugins.toolkit as toolkit  # noqa: E402
+from ckanext.cloudstorage.logic.action import multipart  # noqa: E402
+from ckanext.cloudstorage.model import MultipartPart, MultipartUpload, metadata  # noqa: E402
+
+
+class _PartHandler(BaseHTTPRequestHandler):
+    """
+    Answers UploadPart requests with the MD5 of the body as ETag, and
+    ListParts requests with `listed_parts`, two parts per page.
+    """
+    requests = []
+    wrong_etag = False
+    listed_parts = []
+
+    def do_GET(self):
+        marker = int(parse_qs(urlparse(self.path).query).get('part-number-marker', ['0'])[0])
+        page = [part for part in self.listed_parts if part[0] > marker][:2]
+        truncated = page and page[-1] != self.listed_parts[-1]
+        body = (
+            '<ListPartsResult xmlns="http://s3.amazonaws.com/doc/2006-03-01/">'
+            + ''.join(
+                f'<Part><PartNumber>{n}</PartNumber><ETag>{etag}</ETag><Size>{size}</Size></Part>'
+                for n, etag, size in page
+            )
+            + f'<IsTruncated>{"true" if truncated else "false"}</IsTruncated>'
+            + (f'<NextPartNumberMarker>{page[-1][0]}</NextPartNumberMarker>' if truncated else '')
+            + '</ListPartsResult>'
+        ).encode()
+        self.send_response(200)
+        self.send_header('Content-Type', 'application/xml')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def do_PUT(self):
+        body = self.rfile.read(int(self.headers['Content-Length']))
+        self.requests.append(({name.lower(): value for name, value in self.headers.items()}, body))
+        etag = hashlib.md5(b'corrupted' if self.wrong_etag else body).hexdigest()
+        self.send_response(200)
+        self.send_header('ETag', f'"{etag}"')
+        self.send_header('Content-Length', '0')
+        self.end_headers()
+
+    def log_message(self, *args):
+        pass
+
+
+@pytest.fixture
+def driver():
+    server = ThreadingHTTPServer(('127.0.0.1', 0), _PartHandler)
+    thread = threading.Thread(target=server.serve_forever, daemon=True)
+    thread.start()
+    _PartHandler.requests = []
+    _PartHandler.wrong_etag = False
+    _PartHandler.listed_parts = []
+    yield S3StorageDriver('key', 'secret', secure=False, host='127.0.0.1', port=server.server_address[1])
+    server.shutdown()
+
+
+@pytest.fixture
+def upload_part(monkeypatch, driver):
+    saved = []
+    upload = SimpleNamespace(id='upload-id', name='1/org/pkg/file.csv')
+    monkeypatch.setattr(multipart.h, 'check_access', lambda *args: True)
+    monkeypatch.setattr(multipart, 'ResourceCloudStorage', lambda data_dict: SimpleNamespace(
+        driver=driver, container_name='bucket'))
+    monkeypatch.setattr(multipart, 'model', SimpleNamespace(Session=SimpleNamespace(
+        query=lambda cls: SimpleNamespace(get=lambda upload_id: upload))))
+    monkeypatch.setattr(multipart, '_save_parts', lambda upload_id, parts: saved.extend(parts))
+
+    def upload_part(data):
+        result = multipart.upload_multipart({}, {
+            'uploadId': upload.id,
+            'partNumber': 3,
+            'upload': FileStorage(io.BytesIO(data), 'blob', content_length=len(data)),
+        })
+        return result, saved
+    return upload_part
+
+
+DATA = os.urandom(2 * multipart.PART_CHUNK_SIZE + 123)
+
+
+def test_part_stream_length_is_sent_as_content_length():
+    body = multipart._PartStream(io.BytesIO(DATA + b'next part'), len(DATA))
+    request = requests.Request('PUT', 'http://localhost/', data=body).prepare()
+    assert request.headers['Content-Length'] == str(len(DATA))
+    assert 'Transfer-Encoding' not in request.headers
+
+
+def test_part_stream_is_not_hashed_by_libcloud(upload_part):
+    result, saved = upload_part(DATA)
+
+    headers, body = _PartHandler.requests[-1]
+    # libcloud only streams iterators, other bodies are read to be hashed
+    assert headers['x-amz-content-sha256'] == 'UNSIGNED-PAYLOAD'
+    assert headers['content-length'] == str(len(DATA))
+    assert 'transfer-encoding' not in headers
+    assert body == DATA
+    etag = f'"{hashlib.md5(DATA).hexdigest()}"'
+    assert result == {'partNumber': 3, 'ETag': etag}
+    assert saved == [(3, etag, len(DATA))]
+
+
+def test_part_with_a_mismatched_etag_is_rejected(upload_part):
+    _PartHandler.wrong_etag = True
+    with pytest.raises(toolkit.ValidationError):
+        upload_part(DATA)
+
+
+@pytest.fixture
+def session(monkeypatch):
+    engine = create_engine('sqlite://')
+    metadata.create_all(engine)
+    session = sessionmaker(bind=engine)()
+    monkeypatch.setattr(multipart.model, 'Session', session)
+    upload = MultipartUpload('upload-id', 'resource-id', '1/org/pkg/file.csv', 30, 'file.csv', 'user-id')
+    session.add(upload)
+    session.commit()
+    yield session
+    session.close()
+
+
+def _recorded_parts(session):
+    return session.query(MultipartPart.n, MultipartPart.etag, MultipartPart.size).order_by(MultipartPart.n).all()
+
+
+def test_provider_parts_are_listed_across_pages(driver):
+    _PartHandler.listed_parts = [(1, '"a"', 10), (2, '"b"', 10), (4, '"d"', 5)]
+    uploader = SimpleNamespace(driver=driver, container_name='bucket')
+    upload = SimpleNamespace(id='upload-id', name='1/org/pkg/file.csv')
+    assert multipart._list_provider_parts(uploader, upload) == _PartHandler.listed_parts
+
+
+def test_reconcile_replaces_the_recorded_parts(session):
+    multipart._save_parts('upload-id', [(1, '"old"', 10), (2, '"b"', 10), (5, '"e"', 10)])
+    multipart._reconcile_parts(
+        SimpleNamespace(id='upload-id'), [(1, '"a"', 10), (2, '"b"', 10), (3, '"c"', 10)])
+    assert _recorded_parts(session) == [(1, '"a"', 10), (2, '"b"', 10), (3, '"c"', 10)]
+
+
+def test_reconcile_without_provider_parts_forgets_them(session):
+    multipart._save_parts('upload-id', [(1, '"a"', 10)])
+    multipart._reconcile_parts(SimpleNamespace(id='upload-id'), [])
+    assert _recorded_parts(session) == []
+
+
+@pytest.fixture
+def check_multipart(monkeypatch, session):
+    monkeypatch.setattr(multipart.h, 'check_access', lambda *args: True)
+    monkeypatch.setattr(multipart, '_can_upload_directly', lambda uploader: False)
+    multipart._save_parts('upload-id', [(1, '"a"', 10), (2, '"b"', 10)])
+
+    def check_multipart(driver):
+        monkeypatch.setattr(multipart, 'ResourceCloudStorage', lambda data_dict: SimpleNamespace(
+            driver=driver, container_name='bucket'))
+        result = multipart.check_multipart({}, {'id': 'resource-id', 'reconcile': True})
+        return result['upload']['completed_parts']
+    return check_multipart
+
+
+def test_check_multipart_reconciles_the_parts(check_multipart, driver):
+    _PartHandler.listed_parts = [(1, '"a"', 10), (2, '"b"', 10), (3, '"c"', 10)]
+    assert [part['partNumber'] for part in check_multipart(driver)] == [1, 2, 3]
+
+
+def test_check_multipart_falls_back_when_the_provider_is_unreachable(check_multipart):
+    # nothing listens on the port of a closed server
+    server = ThreadingHTTPServer(('127.0.0.1', 0), _PartHandler)
+    port = server.server_address[1]
+    server.server_close()
+    driver = S3StorageDriver('key', 'secret', secure=False, host='127.0.0.1', port=port)
+    assert [part['partNumber'] for part in check_multipart(driver)] == [1, 2]
+
+
+@pytest.mark.parametrize('error', [
+    LibcloudError('access denied'),
+    requests.exceptions.ReadTimeout('timed out'),
+    ssl.SSLError('handshake failed'),
+    ConnectionResetError('reset by peer'),
+])
+def test_check_multipart_falls_back_on_provider_errors(check_multipart, monkeypatch, driver, error):
+    def fail(uploader, upload):
+        raise error
+    monkeypatch.setattr(multipart, '_list_provider_parts', fail)
+    assert [part['partNumber'] for part in check_multipart(driver)] == [1, 2]
+
+
+class _Redis:
+    def __init__(self):
+        self.values = {}
+
+    def set(self, key, value, ex=None):
+        self.values[key] = value
+
+    def get(self, key):
+        return self.values.get(key)
+
+
+@pytest.fixture
+def finish_multipart(monkeypatch, session):
+    redis, finished, jobs = _Redis(), [], []
+    monkeypatch.setattr(multipart.h, 'check_access', lambda *args: True)
+    monkeypatch.setattr(multipart, 'connect_to_redis', lambda: redis)
+    monkeypatch.setattr(multipart, 'get_queue', lambda: 'default')
+    monkeypatch.setattr(multipart, 'ResourceCloudStorage', lambda data_dict: SimpleNamespace(
+        container=None, driver=SimpleNamespace(_commit_multipart=lambda **kwargs: '"etag"')))
+    monkeypatch.setattr(multipart, '_finish_upload', lambda context, **kwargs: finished.append(kwargs))
+    monkeypatch.setattr(multipart.toolkit, 'enqueue_job', lambda job, kwargs, title: jobs.append(kwargs))
+    multipart._save_parts('upload-id', [(1, '"a"', 10)])
+
+    def finish_multipart(workers, in_background=True):
+        monkeypatch.setattr(multipart, 'config', SimpleNamespace(
+            multipart_finish_in_background=in_background, multipart_finish_timeout=60))
+        monkeypatch.setattr(multipart, 'Worker', SimpleNamespace(all=lambda queue: workers))
+        result = multipart.finish_multipart({'user': 'user'}, {'uploadId': 'upload-id', 'id': 'resource-id'})
+        return result, finished, jobs
+    return finish_multipart
+
+
+def _status():
+    return multipart.multipart_status({}, {'id': 'resource-id', 'uploadId': 'upload-id'})
+
+
+def test_finish_without_worker_updates_the_resource_in_the_request(finish_multipart, session):
+    result, finished, jobs = finish_multipart(workers=[])
+    assert result == {'commited': True, 'status': 'done'}
+    assert [kwargs['resource_id'] for kwargs in finished] == ['resource-id']
+    assert jobs == []
+    assert session.query(MultipartUpload).count() == 0
+
+
+def test_finish_in_background_can_be_turned_off(finish_multipart):
+    result, finished, jobs = finish_multipart(workers=['worker'], in_background=False)
+    assert result['status'] == 'done'
+    assert len(finished) == 1 and jobs == []
+
+
+def test_finish_with_a_worker_enqueues_the_updates(finish_multipart):
+    result, finished, jobs = finish_multipart(workers=['worker'])
+    assert result == {'commited': True, 'status': 'pending'}
+    assert finished == []
+    assert [(kwargs['upload_id'], kwargs['user']) for kwargs in jobs] == [('upload-id', 'user')]
+    assert _status() == {'status': 'pending', 'error': None}
+
+
+def test_finish_when_workers_cannot_be_listed(finish_multipart, monkeypatch):
+    def unreachable(queue):
+        raise ConnectionError('redis is down')
+    monkeypatch.setattr(multipart, 'get_queue', lambda: unreachable(None))
+    result, finished, jobs = finish_multipart(workers=['worker'])
+    assert result['status'] == 'done'
+    assert len(finished) == 1 and jobs == []
+
+
+def test_pending_updates_fail_once_no_worker_started_them(finish_multipart, monkeypatch):
+    finish_multipart(workers=['worker'])
+    now = multipart.time.time()
+    monkeypatch.setattr(multipart.time, 'time', lambda: now + 61)
+    assert _status()['status'] == 'error'
@@ -0,0 +1,158 @@
+# -*- coding: utf-8 -*-
+import threading
+from datetime import datetime, timedelta
+from types import SimpleNamespace
+
+import pytest
+
+pytest.importorskip('ckan')
+
+from libcloud.storage.drivers.azure_blobs import AzureBlobsStorageDriver  # noqa: E402
+from libcloud.storage.drivers.s3 import S3StorageDriver  # noqa: E402
+from sqlalchemy import create_engine  # noqa: E402
+from sqlalchemy.orm import sessionmaker  # noqa: E402
+
+from ckanext.cloudstorage import multipart_cleanup  # noqa: E402
+from ckanext.cloudstorage.model import MultipartUpload, metadata  # noqa: E402
+from ckanext.cloudstorage.multipart_cleanup import _RateLimiter, clean_multipart_uploads  # noqa: E402
+
+
+class _Clock:
+    """A monotonic clock only moved by `sleep`."""
+    def __init__(self):
+        self.now = 100.0
+        self.sleeps = []
+
+    def monotonic(self):
+        return self.now
+
+    def sleep(self, seconds):
+        self.sleeps.append(round(seconds, 6))
+        self.now += seconds
+
+
+@pytest.fixture
+def clock(monkeypatch):
+    clock = _Clock()
+    monkeypatch.setattr(multipart_cleanup, 'time', clock)
+    return clock
+
+
+def test_rate_limiter_spaces_calls(clock):
+    limiter = _RateLimiter(10)
+    for _ in range(4):
+        limiter.wait()
+    assert clock.sleeps == [0.1, 0.1, 0.1]
+
+
+def test_rate_limiter_does_not_wait_after_idle_time(clock):
+    limiter = _RateLimiter(10)
+    limiter.wait()
+    clock.now += 5
+    limiter.wait()
+    assert clock.sleeps == []
+
+
+def test_rate_limiter_without_rate_never_waits(clock):
+    limiter = _RateLimiter(0)
+    for _ in range(10):
+        limiter.wait()
+    assert clock.sleeps == []
+
+
+def test_rate_limiter_is_shared_by_threads():
+    limiter = _RateLimiter(50)
+    calls = []
+
+    def call():
+        limiter.wait()
+        calls.append(multipart_cleanup.time.monotonic())
+
+    threads = [threading.Thread(target=call) for _ in range(10)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    calls.sort()
+    # 10 calls at 50 per second take at least 9 intervals
+    assert calls[-1] - calls[0] >= 9 * 0.02 - 0.005
+
+
+NOW = datetime.utcnow()
+EXPIRED = NOW - timedelta(days=8)
+RECENT = NOW - timedelta(days=1)
+
+
+@pytest.fixture
+def clean(monkeypatch):
+    engine = create_engine('sqlite://')
+    metadata.create_all(engine)
+    session = sessionmaker(bind=engine)()
+    monkeypatch.setattr(multipart_cleanup.model, 'Session', session)
+    monkeypatch.setattr(multipart_cleanup, 'config', SimpleNamespace(max_multipart_lifetime=timedelta(days=7)))
+    aborted = {}
+
+    def abort_uploads(storage, uploads):
+        aborted.update(uploads)
+        failing = {upload_id for upload_id in uploads if upload_id.startswith('failing')}
+        return set(uploads) - failing, [f'{upload_id}: error' for upload_id in sorted(failing)]
+    monkeypatch.setattr(multipart_cleanup, '_abort_uploads', abort_uploads)
+
+    def clean(driver, records, provider_uploads=None, dry_run=False):
+        for upload_id, initiated in records:
+            upload = MultipartUpload(upload_id, 'resource', f'1/org/pkg/{upload_id}', 1, 'file', 'user')
+            upload.initiated = initiated
+            session.add(upload)
+        session.commit()
+
+        def list_provider_uploads(storage):
+            assert provider_uploads is not None, 'only S3 lists its multipart uploads'
+            return [(f'1/org/pkg/{upload_id}', upload_id, initiated) for upload_id, initiated in provider_uploads]
+        monkeypatch.setattr(multipart_cleanup, 'list_provider_uploads', list_provider_uploads)
+
+        result = clean_multipart_uploads(SimpleNamespace(driver=driver), dry_run=dry_run)
+        remaining = sorted(upload_id for upload_id, in session.query(MultipartUpload.id))
+        return result, aborted, remaining
+    yield clean
+    session.close()
+
+
+def test_recorded_and_provider_uploads_are_compared(clean):
+    result, aborted, remaining = clean(
+        S3StorageDriver('key', 'secret'),
+        records=[('expired', EXPIRED), ('gone', EXPIRED), ('recent', RECENT), ('failing', EXPIRED)],
+        provider_uploads=[
+            ('expired', EXPIRED),
+            ('recent', RECENT),
+            ('failing', EXPIRED),
+            ('orphan', EXPIRED),
+            # may be recorded soon
+            ('young-orphan', RECENT),
+        ],
+    )
+    assert sorted(aborted) == ['expired', 'failing', 'orphan']
+    # the record of an upload the provider no longer has is stale
+    assert remaining == ['failing', 'recent']
+    assert result == {'removed': 3, 'total': 4, 'orphans': 1, 'errors': ['failing: error']}
+
+
+def test_dry_run_only_counts(clean):
+    result, aborted, remaining = clean(
+        S3StorageDriver('key', 'secret'),
+        records=[('expired', EXPIRED)],
+        provider_uploads=[('expired', EXPIRED), ('orphan', EXPIRED)],
+        dry_run=True,
+    )
+    assert aborted == {}
+    assert remaining == ['expired']
+    assert result == {'removed': 0, 'total': 2, 'orphans': 1, 'errors': []}
+
+
+def test_other_providers_only_expire_the_records(clean):
+    result, aborted, remaining = clean(
+        AzureBlobsStorageDriver('account', 'a2V5'),
+        records=[('expired', EXPIRED), ('recent', RECENT), ('failing', EXPIRED)],
+    )
+    assert sorted(aborted) == ['expired', 'failing']
+    assert remaining == ['failing', 'recent']
+    assert result == {'removed': 1, 'total': 2, 'orphans': 0, 'errors': ['failing: error']}
@@ -0,0 +1,110 @@
+# -*- coding: utf-8 -*-
+import hashlib
+import io
+import os
+import threading
+from types import SimpleNamespace
+
+import pytest
+
+pytest.importorskip('ckan')
+
+from libcloud.storage.base import Container  # noqa: E402
+
+from ckanext.cloudstorage import parallel_upload  # noqa: E402
+from ckanext.cloudstorage.checksum import content_md5  # noqa: E402
+from ckanext.cloudstorage.parallel_upload import MIN_PART_SIZE, upload_in_parts  # noqa: E402
+
+
+class _Driver:
+    """Records the multipart calls, failing `failures[n]` times on part n."""
+    def __init__(self, failures=None):
+        self.failures = dict(failures or {})
+        self.attempts = {}
+        self.parts = {}
+        self.committed = None
+        self.aborted = []
+        self._lock = threading.Lock()
+        self.connection = SimpleNamespace(request=self._request)
+
+    def _get_object_path(self, container, name):
+        return f'/{container.name}/{name}'
+
+    def _initiate_multipart(self, container, object_name, headers=None):
+        return 'upload-id'
+
+    def _commit_multipart(self, container, object_name, upload_id, chunks):
+        self.committed = chunks
+        return '"etag"'
+
+    def _abort_multipart(self, container, object_name, upload_id):
+        self.aborted.append(upload_id)
+
+    def _request(self, path, params, method, data, headers):
+        n = params['partNumber']
+        with self._lock:
+            self.attempts[n] = self.attempts.get(n, 0) + 1
+            if self.failures.get(n, 0) > 0:
+                self.failures[n] -= 1
+                return SimpleNamespace(status=500, headers={})
+            assert headers['Content-MD5'] == content_md5(data)
+            self.parts[n] = data
+        return SimpleNamespace(status=200, headers={'etag': f'"{hashlib.md5(data).hexdigest()}"'})
+
+
+@pytest.fixture
+def upload(monkeypatch):
+    monkeypatch.setattr(parallel_upload, 'config', SimpleNamespace(
+        upload_part_size=MIN_PART_SIZE,
+        upload_concurrency=3,
+        upload_part_retries=2,
+    ))
+    monkeypatch.setattr(parallel_upload.time, 'sleep', lambda seconds: None)
+
+    def upload(driver, data):
+        monkeypatch.setattr(parallel_upload.driver_registry, 'get', lambda *args: driver)
+        storage = SimpleNamespace(
+            driver=driver,
+            driver_name='S3',
+            driver_options={},
+            credentials_generation=0,
+            container_name='bucket',
+            container=Container(name='bucket', extra=None, driver=driver),
+        )
+        return upload_in_parts(storage, io.BytesIO(data), 'object', size=len(data))
+    return upload
+
+
+DATA = os.urandom(3 * MIN_PART_SIZE + 1000)
+
+
+def test_parts_uploaded_once_and_committed_in_order(upload):
+    driver = _Driver()
+    upload(driver, DATA)
+
+    assert driver.attempts == {1: 1, 2: 1, 3: 1, 4: 1}
+    assert b''.join(driver.parts[n] for n in sorted(driver.parts)) == DATA
+    assert driver.committed == [
+        (n, f'"{hashlib.md5(driver.parts[n]).hexdigest()}"') for n in (1, 2, 3, 4)
+    ]
+    assert driver.aborted == []
+
+
+def test_failed_part_is_retried(upload):
+    driver = _Driver(failures={2: 2})
+    upload(driver, DATA)
+
+    assert driver.attempts[2] == 3
+    assert [n for n, _ in driver.committed] == [1, 2, 3, 4]
+    assert driver.aborted == []
+
+
+def test_upload_aborted_when_a_part_keeps_failing(upload):
+    driver = _Driver(failures={2: 3})
+    with pytest.raises(IOError):
+        upload(driver, DATA)
+
+    # the first try and `upload_part_retries` retries
+    assert driver.attempts[2] == 3
+    assert driver.committed is None
+    assert driver.aborted == ['upload-id']
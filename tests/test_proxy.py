@@ -0,0 +1,98 @@
+# -*- coding: utf-8 -*-
+import gzip
+import threading
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+import pytest
+
+from ckanext.cloudstorage.proxy import request_object
+
+libcloud_s3 = pytest.importorskip('libcloud.storage.drivers.s3')
+from libcloud.storage.base import Container  # noqa: E402
+
+BODY = b'0123456789' * 1000
+GZIPPED = gzip.compress(BODY)
+ETAG = '"d41d8cd98f00b204e9800998ecf8427e"'
+
+
+class _ObjectHandler(BaseHTTPRequestHandler):
+    """Answers GETs of `/bucket/plain` and `/bucket/gzipped` like S3."""
+    requests = []
+
+    def do_GET(self):
+        self.requests.append(dict(self.headers))
+        body, extra = (GZIPPED, {'Content-Encoding': 'gzip'}) if self.path.split('?')[0].endswith('/gzipped') else (BODY, {})
+        if self.headers.get('If-None-Match') == ETAG:
+            self._respond(304, b'', {})
+        elif self.headers.get('Range'):
+            first, last = (int(n) for n in self.headers['Range'][len('bytes='):].split('-'))
+            extra['Content-Range'] = f'bytes {first}-{last}/{len(body)}'
+            self._respond(206, body[first:last + 1], extra)
+        else:
+            self._respond(200, body, extra)
+
+    def _respond(self, status, body, headers):
+        self.send_response(status)
+        self.send_header('ETag', ETAG)
+        self.send_header('Content-Type', 'text/csv')
+        self.send_header('x-amz-request-id', 'not-forwarded')
+        for name, value in headers.items():
+            self.send_header(name, value)
+        if status != 304:
+            self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, *args):
+        pass
+
+
+@pytest.fixture(scope='module')
+def container():
+    server = ThreadingHTTPServer(('127.0.0.1', 0), _ObjectHandler)
+    thread = threading.Thread(target=server.serve_forever, daemon=True)
+    thread.start()
+    driver = libcloud_s3.S3StorageDriver(
+        'key', 'secret', secure=False, host='127.0.0.1', port=server.server_address[1])
+    yield Container(name='bucket', extra=None, driver=driver)
+    server.shutdown()
+
+
+def _get(container, name, request_headers=None):
+    status, headers, stream = request_object(container.driver, container, name, request_headers or {}, 1024)
+    try:
+        return status, headers, b''.join(stream)
+    finally:
+        stream.close()
+
+
+def test_full_object(container):
+    status, headers, body = _get(container, 'plain')
+    assert status == 200
+    assert body == BODY
+    assert headers == {'Content-Length': str(len(BODY)), 'Content-Type': 'text/csv', 'ETag': ETAG}
+
+
+def test_range_request(container):
+    status, headers, body = _get(container, 'plain', {'Range': 'bytes=10-29', 'Cookie': 'not-forwarded'})
+    assert status == 206
+    assert body == BODY[10:30]
+    assert headers['Content-Range'] == f'bytes 10-29/{len(BODY)}'
+    assert headers['Content-Length'] == '20'
+    assert _ObjectHandler.requests[-1]['Range'] == 'bytes=10-29'
+    assert 'Cookie' not in _ObjectHandler.requests[-1]
+
+
+def test_not_modified(container):
+    status, headers, body = _get(container, 'plain', {'If-None-Match': ETAG})
+    assert status == 304
+    assert body == b''
+    assert headers['ETag'] == ETAG
+
+
+def test_encoded_body_is_not_decoded(container):
+    status, headers, body = _get(container, 'gzipped')
+    assert status == 200
+    assert headers['Content-Encoding'] == 'gzip'
+    assert headers['Content-Length'] == str(len(GZIPPED))
+    assert body == GZIPPED
@@ -0,0 +1,114 @@
+# -*- coding: utf-8 -*-
+from types import SimpleNamespace
+
+import pytest
+
+pytest.importorskip('ckan')
+
+from ckanext.cloudstorage import rekey, resource_object_key  # noqa: E402
+from ckanext.cloudstorage.rekey import Checkpoint, rekey_resources  # noqa: E402
+
+
+def _resource(id, key):
+    return SimpleNamespace(id=id, extras={'cloud_storage_key': key} if key else {})
+
+
+@pytest.fixture
+def run(monkeypatch, tmp_path):
+    events = []
+    resources = []
+    monkeypatch.setattr(resource_object_key, 'convert_local_package_name_to_global', lambda org, name: name)
+    monkeypatch.setattr(rekey, 'CloudStorage', lambda: 'storage')
+    monkeypatch.setattr(rekey, 'model', SimpleNamespace(repo=SimpleNamespace(commit=lambda: events.append('commit'))))
+    monkeypatch.setattr(rekey.presigned_urls, 'invalidate', lambda path: events.append(('invalidate', path)))
+
+    def next_batch(last_id, batch_size):
+        return [resource for resource in resources if last_id is None or resource.id > last_id][:batch_size]
+    monkeypatch.setattr(rekey, '_next_batch', next_batch)
+
+    def copy_object(storage, parts, source, target):
+        events.append(('copy', source, target))
+        if 'broken' in source:
+            raise IOError('copy failed')
+        return 10
+    monkeypatch.setattr(rekey, '_copy_object', copy_object)
+
+    def delete_objects(storage, executor, names):
+        events.append(('delete', sorted(names)))
+    monkeypatch.setattr(rekey, '_delete_objects', delete_objects)
+
+    checkpoint = Checkpoint(str(tmp_path / 'checkpoint'))
+    save = checkpoint.save
+
+    def save_checkpoint(resource_id):
+        events.append(('checkpoint', resource_id))
+        save(resource_id)
+    monkeypatch.setattr(checkpoint, 'save', save_checkpoint)
+
+    def run(batch, **kwargs):
+        resources[:] = batch
+        events.clear()
+        return rekey_resources(checkpoint, batch_size=2, concurrency=2, **kwargs), events
+    run.checkpoint = checkpoint
+    return run
+
+
+def test_copy_commit_then_delete(run):
+    resources = [
+        _resource('a', 'org/pkg/a.csv'),
+        _resource('b', '1/org/pkg/b.csv'),
+        _resource('c', 'org/pkg/c.csv'),
+    ]
+    stats, events = run(resources)
+
+    assert events == [
+        ('copy', 'org/pkg/a.csv', '1/org/pkg/a.csv'),
+        'commit',
+        ('invalidate', 'org/pkg/a.csv'),
+        ('checkpoint', 'b'),
+        ('delete', ['org/pkg/a.csv']),
+        ('copy', 'org/pkg/c.csv', '1/org/pkg/c.csv'),
+        'commit',
+        ('invalidate', 'org/pkg/c.csv'),
+        ('checkpoint', 'c'),
+        ('delete', ['org/pkg/c.csv']),
+    ]
+    assert resources[0].extras['cloud_storage_key'] == '1/org/pkg/a.csv'
+    assert resources[1].extras['cloud_storage_key'] == '1/org/pkg/b.csv'
+    assert (stats.resources, stats.moved, stats.skipped, stats.bytes) == (3, 2, 1, 20)
+
+
+def test_failed_copy_keeps_the_key_and_the_source(run):
+    resources = [_resource('a', 'org/pkg/a.csv'), _resource('b', 'org/pkg/broken.csv')]
+    stats, events = run(resources)
+
+    assert 'commit' in events
+    assert ('delete', ['org/pkg/a.csv']) in events
+    assert resources[1].extras['cloud_storage_key'] == 'org/pkg/broken.csv'
+    assert stats.moved == 1
+    assert [error.split(':')[0] for error in stats.errors] == ['b']
+
+
+def test_streams_and_unsupported_keys_are_skipped(run):
+    resources = [
+        _resource('a', 'org/pkg/stream/part-0001'),
+        _resource('b', 'not-a-key'),
+        _resource('c', None),
+    ]
+    stats, events = run(resources)
+
+    assert [event for event in events if event[0] != 'checkpoint'] == []
+    assert (stats.resources, stats.moved, stats.skipped) == (3, 0, 3)
+
+
+def test_dry_run_only_counts(run):
+    stats, events = run([_resource('a', 'org/pkg/a.csv')], dry_run=True)
+    assert events == []
+    assert stats.moved == 1
+
+
+def test_resumes_after_the_checkpoint(run):
+    run.checkpoint.save('a')
+    stats, events = run([_resource('a', 'org/pkg/a.csv'), _resource('b', 'org/pkg/b.csv')])
+    assert [event for event in events if event[0] == 'copy'] == [('copy', 'org/pkg/b.csv', '1/org/pkg/b.csv')]
+    assert stats.resources == 1
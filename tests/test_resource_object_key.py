@@ -0,0 +1,72 @@
+# -*- coding: utf-8 -*-
+from datetime import datetime
+
+import pytest
+
+pytest.importorskip('ckan')
+
+from ckanext.cloudstorage import resource_object_key  # noqa: E402
+from ckanext.cloudstorage.resource_object_key import (  # noqa: E402
+    ResourceObjectKey,
+    ResourceObjectKeyType,
+    _ResourceObjectKeyV0,
+    _ResourceObjectKeyV1,
+    upgrade_key,
+)
+
+
+STREAM_FILE = 'PUT-S3-Qj0zi-3-2023-06-26-18-42-52-3d8d51f5-0fc4-3a21-8d2e-ff614b8e9a30'
+
+
+@pytest.fixture(autouse=True)
+def local_package_names(monkeypatch):
+    monkeypatch.setattr(resource_object_key, 'convert_local_package_name_to_global', lambda org, name: name)
+
+
+@pytest.mark.parametrize('key', [
+    'org/pkg/file.csv',
+    # organization names starting with a digit are not versions
+    '2020-org/pkg/file.csv',
+])
+def test_v1_does_not_parse_v0_keys(key):
+    assert _ResourceObjectKeyV1.try_parse(key) is None
+    assert ResourceObjectKey.from_raw_key(key).version == 0
+
+
+def test_v1_parses_its_keys():
+    key = _ResourceObjectKeyV1.try_parse('1/org/MyPackage/file.csv')
+    assert key.version == 1
+    assert key.raw == '1/org/MyPackage/file.csv'
+    assert (key.organization_name, key.package_segment, key.package_name) == ('org', 'MyPackage', 'my-package')
+    assert (key.name, key.filename, key.type) == ('file.csv', 'file.csv', ResourceObjectKeyType.UPLOAD)
+
+
+def test_v1_parses_stream_keys():
+    key = ResourceObjectKey.from_raw_key(f'1/org/pkg/stream/2023/06/26/{STREAM_FILE}')
+    assert key.type == ResourceObjectKeyType.STREAMING
+    assert (key.name, key.filename) == ('stream', STREAM_FILE)
+    assert key.ingestion_datetime == datetime(2023, 6, 26, 18, 42, 52)
+
+
+def test_unsupported_key():
+    with pytest.raises(ValueError):
+        ResourceObjectKey.from_raw_key('file.csv')
+
+
+def test_upgrade_v0_key():
+    key = upgrade_key(_ResourceObjectKeyV0.try_parse('org/pkg/file.csv'))
+    assert isinstance(key, _ResourceObjectKeyV1)
+    assert key.raw == '1/org/pkg/file.csv'
+    assert (key.organization_name, key.package_segment, key.name) == ('org', 'pkg', 'file.csv')
+
+
+def test_upgrade_latest_key_is_the_same_key():
+    key = ResourceObjectKey.from_raw_key('1/org/pkg/file.csv')
+    assert upgrade_key(key) is key
+
+
+def test_upgrade_stream_key_without_ingestion_time():
+    key = _ResourceObjectKeyV0.try_parse('org/pkg/stream/part-0001')
+    assert key.type == ResourceObjectKeyType.STREAMING
+    with pytest.raises(ValueError):
+        upgrade_key(key)
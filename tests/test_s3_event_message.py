@@ -0,0 +1,152 @@
+# -*- coding: utf-8 -*-
+import json
+import logging
+
+import pytest
+
+pytest.importorskip('ckan')
+
+from ckanext.cloudstorage.sync.s3_event_message import MessageAcknowledger, events_from_messages  # noqa: E402
+
+
+BUCKET = 'bucket'
+
+
+class _Message:
+    def __init__(self, message_id, body):
+        self.message_id = message_id
+        self.receipt_handle = f'receipt-{message_id}'
+        self.body = body
+
+    def __repr__(self):
+        return f'_Message({self.message_id!r})'
+
+
+class _Queue:
+    """Records the `DeleteMessageBatch` calls, failing the given receipts."""
+    def __init__(self, failing=()):
+        self.failing = set(failing)
+        self.batches = []
+
+    def delete_messages(self, Entries):
+        self.batches.append([entry['ReceiptHandle'] for entry in Entries])
+        return {
+            'Successful': [{'Id': e['Id']} for e in Entries if e['ReceiptHandle'] not in self.failing],
+            'Failed': [
+                {'Id': e['Id'], 'Code': 'ReceiptHandleIsInvalid', 'SenderFault': True}
+                for e in Entries if e['ReceiptHandle'] in self.failing
+            ],
+        }
+
+    @property
+    def deleted(self):
+        return [receipt for batch in self.batches for receipt in batch if receipt not in self.failing]
+
+
+def _record(key, version='2.1'):
+    return {
+        'eventVersion': version,
+        'eventSource': 'aws:s3',
+        'eventName': 'ObjectCreated:Put',
+        'eventTime': '2024-03-01T12:30:45.000Z',
+        's3': {
+            'bucket': {'name': BUCKET},
+            'object': {'key': key, 'size': 1, 'sequencer': '0A'},
+        },
+    }
+
+
+def _message(message_id, *records):
+    return _Message(message_id, json.dumps({'Records': list(records)}))
+
+
+def _handle(queue, messages):
+    acknowledger = MessageAcknowledger(queue)
+    events = list(events_from_messages(BUCKET, messages, acknowledger))
+    for event in events:
+        event.mark_received()
+    acknowledger.flush()
+    return events
+
+
+def test_deletes_in_batches_of_ten():
+    queue = _Queue()
+    messages = [_message(str(n), _record(f'1/org/pkg/file-{n}.csv')) for n in range(25)]
+
+    acknowledger = MessageAcknowledger(queue)
+    events = list(events_from_messages(BUCKET, messages, acknowledger))
+    assert queue.batches == []
+
+    for event in events[:10]:
+        event.mark_received()
+    # a full batch is sent right away
+    assert [len(batch) for batch in queue.batches] == [10]
+
+    for event in events[10:]:
+        event.mark_received()
+    acknowledger.flush()
+    # the rest once flushed, the last batch is partial
+    assert [len(batch) for batch in queue.batches] == [10, 10, 5]
+    assert sorted(queue.deleted) == sorted(message.receipt_handle for message in messages)
+
+
+def test_message_deleted_once_all_its_events_are_handled():
+    queue = _Queue()
+    message = _message('1', _record('1/org/pkg/a.csv'), _record('1/org/pkg/b.csv'))
+    acknowledger = MessageAcknowledger(queue)
+    first, second = events_from_messages(BUCKET, [message], acknowledger)
+
+    first.mark_received()
+    acknowledger.flush()
+    assert queue.deleted == []
+
+    second.mark_received()
+    acknowledger.flush()
+    assert queue.deleted == ['receipt-1']
+
+
+def test_failed_event_keeps_its_message():
+    queue = _Queue()
+    acknowledger = MessageAcknowledger(queue)
+    first, second = events_from_messages(
+        BUCKET, [_message('1', _record('1/org/pkg/a.csv'), _record('1/org/pkg/b.csv'))], acknowledger)
+    first.mark_error()
+    second.mark_received()
+    acknowledger.flush()
+    assert queue.deleted == []
+
+
+def test_messages_without_events_are_deleted():
+    queue = _Queue()
+    messages = [
+        _Message('test', json.dumps({'Event': 's3:TestEvent'})),
+        _message('folder', _record('1/org/pkg/')),
+        _message('other-bucket', dict(_record('1/org/pkg/a.csv'), s3={
+            'bucket': {'name': 'other'}, 'object': {'key': '1/org/pkg/a.csv', 'sequencer': '0A'}})),
+    ]
+    assert _handle(queue, messages) == []
+    assert sorted(queue.deleted) == ['receipt-folder', 'receipt-other-bucket', 'receipt-test']
+
+
+@pytest.mark.parametrize('message', [
+    _Message('invalid-json', 'not json'),
+    _Message('no-records', json.dumps({'Something': 'else'})),
+    _message('unsupported-key', _record('not a resource key')),
+    _message('unsupported-version', _record('1/org/pkg/a.csv', version='3.0')),
+    _message('partly-parsed', _record('1/org/pkg/a.csv'), _record('not a resource key')),
+])
+def test_unparsable_message_is_kept(message):
+    queue = _Queue()
+    _handle(queue, [message, _message('valid', _record('1/org/pkg/b.csv'))])
+    assert queue.deleted == ['receipt-valid']
+
+
+def test_partial_delete_failure_is_logged(caplog):
+    queue = _Queue(failing={'receipt-1'})
+    messages = [_message(str(n), _record(f'1/org/pkg/file-{n}.csv')) for n in range(3)]
+    with caplog.at_level(logging.WARNING):
+        _handle(queue, messages)
+
+    assert queue.batches == [['receipt-0', 'receipt-1', 'receipt-2']]
+    assert queue.deleted == ['receipt-0', 'receipt-2']
+    assert "unable to delete message _Message('1')" in caplog.text
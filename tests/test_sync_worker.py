@@ -0,0 +1,108 @@
+# -*- coding: utf-8 -*-
+import json
+import threading
+import time
+
+import pytest
+
+pytest.importorskip('ckan')
+
+from ckanext.cloudstorage.sync.local_queue import LocalQueue  # noqa: E402
+from ckanext.cloudstorage.sync.worker import SyncWorker  # noqa: E402
+
+
+BUCKET = 'bucket'
+
+
+def _body(*keys):
+    return json.dumps({'Records': [
+        {
+            'eventVersion': '2.1',
+            'eventSource': 'aws:s3',
+            'eventName': 'ObjectCreated:Put',
+            'eventTime': '2024-03-01T12:30:45.000Z',
+            's3': {
+                'bucket': {'name': BUCKET},
+                'object': {'key': key, 'size': 1, 'sequencer': '0A'},
+            },
+        }
+        for key in keys
+    ]})
+
+
+class _Handler:
+    """Marks every event received, or failed for the keys in `fail`."""
+    def __init__(self, fail=(), delay=0):
+        self.fail = set(fail)
+        self.delay = delay
+        self.keys = []
+
+    def __call__(self, events):
+        for event in events:
+            time.sleep(self.delay)
+            self.keys.append(event.object_key)
+            if event.object_key in self.fail:
+                event.mark_error()
+            else:
+                event.mark_received()
+
+
+def test_drain_handles_every_message():
+    queue = LocalQueue([_body(f'1/org/pkg/file-{n}.csv') for n in range(25)])
+    handler = _Handler()
+    worker = SyncWorker(queue, BUCKET, handler, wait_time=0)
+
+    assert worker.drain() == 25
+    assert len(handler.keys) == 25
+    assert len(queue) == 0
+
+
+def test_failed_event_keeps_its_message():
+    queue = LocalQueue([
+        _body('1/org/pkg/ok.csv'),
+        _body('1/org/pkg/ok-too.csv', '1/org/pkg/broken.csv'),
+    ])
+    worker = SyncWorker(queue, BUCKET, _Handler(fail={'1/org/pkg/broken.csv'}), wait_time=0, visibility_timeout=60)
+
+    assert worker.run_once() == 2
+    assert queue.deleted == ['1']
+    assert len(queue) == 1
+
+
+def test_visibility_is_extended_while_handling():
+    queue = LocalQueue([_body('1/org/pkg/slow.csv')])
+    redelivered = []
+
+    def handle(events):
+        for event in events:
+            # longer than the visibility timeout
+            time.sleep(1.5)
+            redelivered.extend(queue.receive_messages(MaxNumberOfMessages=10))
+            event.mark_received()
+
+    worker = SyncWorker(queue, BUCKET, handle, wait_time=0, visibility_timeout=1)
+    worker.run_once()
+
+    assert redelivered == []
+    assert len(queue) == 0
+
+
+def test_run_long_polls_until_stopped():
+    queue = LocalQueue()
+    handler = _Handler()
+    worker = SyncWorker(queue, BUCKET, handler, wait_time=1)
+    thread = threading.Thread(target=worker.run, daemon=True)
+    thread.start()
+
+    # sent while the worker is already waiting on an empty queue
+    time.sleep(0.2)
+    queue.send_message(MessageBody=_body('1/org/pkg/late.csv'))
+    deadline = time.monotonic() + 5
+    while len(queue) and time.monotonic() < deadline:
+        time.sleep(0.05)
+
+    worker.stop()
+    thread.join(timeout=5)
+    assert not thread.is_alive()
+    assert handler.keys == ['1/org/pkg/late.csv']
+    assert len(queue) == 0
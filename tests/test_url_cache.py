@@ -0,0 +1,112 @@
+# -*- coding: utf-8 -*-
+from types import SimpleNamespace
+
+import pytest
+
+pytest.importorskip('ckan')
+
+from ckanext.cloudstorage import url_cache  # noqa: E402
+from ckanext.cloudstorage.url_cache import PresignedUrlCache  # noqa: E402
+
+
+class _Redis:
+    """The redis commands used by the cache, without expiry."""
+    def __init__(self):
+        self.values = {}
+        self.ttls = {}
+
+    def get(self, key):
+        value = self.values.get(key)
+        return value.encode('utf-8') if isinstance(value, str) else value
+
+    def set(self, key, value, ex=None):
+        self.values[key] = value
+        self.ttls[key] = ex
+
+    def sadd(self, key, *members):
+        self.values.setdefault(key, set()).update(members)
+
+    def smembers(self, key):
+        return set(self.values.get(key, ()))
+
+    def ttl(self, key):
+        if key not in self.values:
+            return -2
+        return self.ttls.get(key) or -1
+
+    def expire(self, key, seconds):
+        self.ttls[key] = seconds
+
+    def delete(self, *keys):
+        for key in keys:
+            self.values.pop(key, None)
+            self.ttls.pop(key, None)
+
+    def scan_iter(self, match):
+        raise AssertionError('the keyspace is not scanned')
+
+    def pipeline(self, transaction=True):
+        return _Pipeline(self)
+
+
+class _Pipeline:
+    def __init__(self, redis):
+        self._redis = redis
+        self._calls = []
+
+    def __getattr__(self, name):
+        def call(*args, **kwargs):
+            self._calls.append((getattr(self._redis, name), args, kwargs))
+        return call
+
+    def execute(self):
+        return [method(*args, **kwargs) for method, args, kwargs in self._calls]
+
+
+@pytest.fixture
+def redis(monkeypatch):
+    redis = _Redis()
+    monkeypatch.setattr(url_cache, '_connect_to_redis', lambda: redis)
+    monkeypatch.setattr(url_cache, 'config', SimpleNamespace(
+        presigned_url_cache_size=100,
+        presigned_url_cache_redis=True,
+        presigned_url_min_validity=0.5,
+    ))
+    return redis
+
+
+def _sign(cache, path, expires_in=3600, content_type=None):
+    return cache.get_or_sign(path, content_type, expires_in, lambda: f'{path}?signed={expires_in}')
+
+
+def test_urls_are_shared_through_redis(redis):
+    _sign(PresignedUrlCache(), 'a.csv')
+
+    other_worker = PresignedUrlCache()
+    assert other_worker.get_or_sign('a.csv', None, 3600, lambda: 'signed again') == 'a.csv?signed=3600'
+
+
+def test_invalidate_deletes_the_indexed_urls_of_the_path(redis):
+    cache = PresignedUrlCache()
+    _sign(cache, 'a.csv')
+    _sign(cache, 'a.csv', content_type='text/csv')
+    _sign(cache, 'a.csv', expires_in=600)
+    _sign(cache, 'b.csv')
+
+    index = url_cache._redis_index_key('a.csv')
+    assert len(redis.smembers(index)) == 3
+    assert redis.ttl(index) == 1800
+
+    cache.invalidate('a.csv')
+    assert list(redis.values) == [
+        url_cache._redis_key(('b.csv', None, 3600, None)),
+        url_cache._redis_index_key('b.csv'),
+    ]
+    assert PresignedUrlCache().get_or_sign('a.csv', None, 3600, lambda: 'signed again') == 'signed again'
+
+
+def test_index_lives_as_long_as_its_longest_url(redis):
+    cache = PresignedUrlCache()
+    _sign(cache, 'a.csv', expires_in=7200)
+    _sign(cache, 'a.csv', expires_in=600)
+    assert redis.ttl(url_cache._redis_index_key('a.csv')) == 3600